@@ -0,0 +1,86 @@
+"""
+Cold-start benchmark: how long importing the entry points takes in a fresh interpreter.
+
+    python benchmarks/import_time.py [--repeat 5] [--top 10] [--json import_time.json] [statement ...]
+
+Each statement is timed in its own interpreter, so nothing is already imported, and the median of
+--repeat runs is reported together with the slowest imports (the timed modules and what they import
+directly) reported by `python -X importtime`.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_STATEMENTS = {
+    'runner': 'import runner',
+    'temperature runner': 'import temperature_experiment_runner',
+    'single provider': "import runner; from models.registry import get_registry; get_registry().wrapper_class('octoai')",
+    'all providers': 'from models import openai, gemini, anthropic, octai',
+}
+
+TIMER = "import time; _start = time.perf_counter()\n{statement}\nprint('elapsed', time.perf_counter() - _start)"
+
+
+def run(statement, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', TIMER.format(statement=statement)]
+    result = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{statement!r} failed:\n{result.stderr[-2000:]}")
+    elapsed = float(result.stdout.strip().splitlines()[-1].split()[1])
+    return elapsed, result.stderr
+
+
+def slowest_modules(importtime_output, top):
+    # lines look like "import time:  self [us] | cumulative | imported package"
+    modules = []
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # nested imports are indented two spaces per level, list the timed modules and their direct imports
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1:
+            modules.append((int(cumulative_us), '  ' * depth + name.strip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('statements', nargs='*', help='statements to time, defaults to the entry points')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='number of slowest imports to list')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    statements = {statement: statement for statement in args.statements} or DEFAULT_STATEMENTS
+    results = {}
+    for name, statement in statements.items():
+        try:
+            samples = [run(statement)[0] for _ in range(args.repeat)]
+            _, importtime_output = run(statement, importtime=True)
+        except RuntimeError as e:
+            print(f"{name}: {e}")
+            continue
+        results[name] = {
+            'statement': statement,
+            'median_s': statistics.median(samples),
+            'min_s': min(samples),
+            'slowest_imports': [{'module': module, 'cumulative_s': us / 1e6}
+                                for us, module in slowest_modules(importtime_output, args.top)]
+        }
+        print(f"{name}: median {results[name]['median_s']:.3f}s, min {results[name]['min_s']:.3f}s ({statement})")
+        for entry in results[name]['slowest_imports']:
+            print(f"    {entry['cumulative_s']:8.3f}s  {entry['module']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
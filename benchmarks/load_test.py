@@ -0,0 +1,178 @@
+"""
+Offline load test: runs the batch runner and the temperature sweep end to end against the mock
+provider (models/mock.py), so scheduler, rate limiter, cache and logging changes can be measured
+without API keys.
+
+    python benchmarks/load_test.py [--scenario all] [--articles 300] [--runs 3] [--latency-ms 50]
+                                   [--distribution lognormal] [--error-rate 0] [--rate-limit-rate 0]
+                                   [--concurrency 64] [--explanation-words 0] [--cache]
+                                   [--json load_test.json]
+
+For every scenario it reports the provider requests per second, the p50 and p99 latency of a
+request (response cache, rate limiter and provider call) and the CPU time the process spent per
+request. The mock only sleeps, so the CPU time is the framework's own overhead. Results files and
+the telemetry snapshot (helpers/telemetry.py) are written to a temporary directory.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def synthetic_data(count, words):
+    """
+    Articles of `words` words with a deterministic binary ground truth.
+    """
+    texts, labels = [], []
+    for index in range(count):
+        digest = hashlib.sha1(str(index).encode('utf-8')).hexdigest()
+        texts.append(f"Article {index}. " + ' '.join(digest[i % 40:i % 40 + 6] for i in range(words)))
+        labels.append(int(digest, 16) % 2)
+    return texts, labels
+
+
+def timed_model(settings):
+    from models.mock import MockModel
+
+    class TimedMockModel(MockModel):
+        """
+        Mock model recording the latency of every cached, rate-limited prediction.
+        """
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.latencies = []
+
+        async def acached_predict(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await super().acached_predict(*args, **kwargs)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+
+    return TimedMockModel('mock-model', settings=settings)
+
+
+def run_batch(model, texts, labels, runs):
+    import runner
+    roles = runner.config['variables']['prompt']['roles']
+    batch_config = {
+        'prompt_types': ['simple'],
+        'prompt_roles': roles[:1],
+        'response_types': ['binary', 'multiclass'],
+        'num_runs': runs,
+        'providers': ['mock'],
+        'multi_sample': False
+    }
+    runner.run_batch_experiments(texts, labels, {'mock': model}, batch_config)
+
+
+def run_temperature_sweep(model, texts, labels, runs):
+    import temperature_experiment_runner as sweep
+    from helpers.scheduler import ProviderScheduler
+    from helpers.helpers import prepare_prompt
+    prompt = prepare_prompt('role', sweep.config['variables']['prompt']['roles'][0], 'binary')
+    scheduler = ProviderScheduler()
+    for run_idx in range(1, runs + 1):
+        scheduler.add(sweep.sweep_job(model, 'mock', run_idx, texts, labels, prompt))
+    for job, result in scheduler.run():
+        if isinstance(result, Exception):
+            logging.error(f"{job.name} failed: {result}")
+
+
+SCENARIOS = {
+    'batch': run_batch,
+    'temperature': run_temperature_sweep,
+}
+
+
+def measure(name, scenario, settings, texts, labels, runs):
+    from helpers.result_sink import get_result_sink
+    model = timed_model(settings)
+    wall, cpu = time.perf_counter(), time.process_time()
+    scenario(model, texts, labels, runs)
+    # buffered results are part of the cost of a run
+    get_result_sink().flush()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    latencies = np.asarray(model.latencies or [0.0])
+    requests = max(model.calls, 1)
+    return {
+        'scenario': name,
+        'requests': model.calls,
+        'errors': model.errors,
+        'rate_limited': model.rate_limited,
+        'wall_s': wall,
+        'requests_per_s': model.calls / wall,
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'cpu_ms_per_request': cpu * 1000 / requests
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=['all'] + list(SCENARIOS), default='all')
+    parser.add_argument('--articles', type=int, default=300, help='synthetic articles')
+    parser.add_argument('--words', type=int, default=400, help='words per synthetic article')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--distribution', default='lognormal')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--explanation-words', type=int, default=0,
+                        help='words following the label of free-text answers, cut off by early-stopping streams')
+    parser.add_argument('--cache', action='store_true', help='keep the response cache and request journal enabled')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    # experiments.yml is read relative to the working directory when runner is imported
+    os.chdir(ROOT)
+    from helpers import config
+    import runner  # noqa: F401
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    os.chdir(workdir)
+    config['concurrency']['mock'] = args.concurrency
+    if not args.cache:
+        config['response_cache']['enabled'] = False
+        config['checkpoint']['enabled'] = False
+
+    settings = {
+        'latency_ms': args.latency_ms,
+        'latency_distribution': args.distribution,
+        'error_rate': args.error_rate,
+        'rate_limit_rate': args.rate_limit_rate,
+        'explanation_words': args.explanation_words,
+        'retry_after': 0
+    }
+    texts, labels = synthetic_data(args.articles, args.words)
+    scenarios = SCENARIOS if args.scenario == 'all' else {args.scenario: SCENARIOS[args.scenario]}
+    results = []
+    for name, scenario in scenarios.items():
+        result = measure(name, scenario, settings, texts, labels, args.runs)
+        results.append(result)
+        print(f"{name}: {result['requests']} requests in {result['wall_s']:.2f}s, "
+              f"{result['requests_per_s']:.1f} req/s, p50 {result['p50_ms']:.1f}ms, p99 {result['p99_ms']:.1f}ms, "
+              f"{result['cpu_ms_per_request']:.2f}ms CPU/request, {result['errors']} errors, "
+              f"{result['rate_limited']} rate limited")
+    from helpers.telemetry import get_telemetry
+    get_telemetry().export(os.path.join(workdir, 'telemetry'))
+    print(f"results and telemetry written to {workdir}")
+
+    if args.json:
+        with open(os.path.join(ROOT, args.json) if not os.path.isabs(args.json) else args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,51 @@
 import yaml
 import logging
 from datetime import datetime
+import os
 import sys
+import threading
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yml')
+# sections every module reading config.yml relies on
+REQUIRED_SECTIONS = ['variables', 'experiment_setup', 'return_files']
+
+_configs = {}
+_configs_lock = threading.Lock()
+
 
 class ConfigHandler:
     @staticmethod
     def load_config(config_path):
         try:
             with open(config_path, 'r') as file:
-                config = yaml.safe_load(file)
+                # the libyaml loader is considerably faster when PyYAML was built with it
+                config = yaml.load(file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
             return config
         except Exception as e:
             logging.error(f"Error loading configuration file: {e}")
             raise
 
+    @staticmethod
+    def get_config(config_path=CONFIG_PATH):
+        """
+        Load and validate a configuration file once per process, later calls return the same object.
+        """
+        path = os.path.abspath(config_path)
+        with _configs_lock:
+            if path not in _configs:
+                config = ConfigHandler.load_config(path)
+                ConfigHandler.validate_config(config)
+                if path == os.path.abspath(CONFIG_PATH):
+                    ConfigHandler.validate_sections(config, REQUIRED_SECTIONS)
+                _configs[path] = config
+            return _configs[path]
+
+    @staticmethod
+    def validate_sections(config, sections):
+        missing = [section for section in sections if section not in config]
+        if missing:
+            raise ValueError(f"Missing configuration sections: {', '.join(missing)}")
+
     @staticmethod
     def validate_config(config, parent_key=''):
         for key, value in config.items():
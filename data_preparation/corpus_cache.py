@@ -0,0 +1,351 @@
+import json
+import logging
+import os
+import pickle
+import shutil
+import weakref
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, builds are not locked there
+    fcntl = None
+
+from data_preparation import config
+
+CORPUS_VERSION = 1
+
+# columns stored as fixed-width string arrays, one entry per article
+STRING_COLUMNS = ['year', 'event', 'provider', 'title', 'stance']
+# variable-length columns stored as a UTF-8 blob plus offsets
+BLOB_COLUMNS = ['text', 'annotations']
+
+
+def pack_strings(strings):
+    """
+    Pack strings into one uint8 array of UTF-8 bytes and an offsets array, entry i being
+    data[offsets[i]:offsets[i + 1]]. Both arrays can be memory mapped.
+    """
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8) if encoded else np.zeros(0, dtype=np.uint8)
+    return data, offsets
+
+
+def unpack_string(data, offsets, i):
+    return data[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+
+
+def list_json_files(root_path):
+    """
+    List (year, relative path, absolute path) of every json file below the year folders of root_path,
+    in a deterministic order.
+    """
+    files = []
+    for year_folder in sorted(os.listdir(root_path)):
+        year_path = os.path.join(root_path, year_folder)
+        if not os.path.isdir(year_path):
+            continue
+        for root, dirs, names in os.walk(year_path):
+            dirs.sort()
+            for name in sorted(names):
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    files.append((year_folder, os.path.relpath(path, root_path), path))
+    return files
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def load_json(path):
+    # orjson is considerably faster on large corpora, the stdlib parser is the fallback
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def parse_article_record(year, path):
+    article = load_json(path)
+    return {
+        'year': year,
+        'file_name': os.path.basename(path),
+        'source': article['source'],
+        'title': article['title'],
+        'sentences': [sentence for paragraph in article['body-paragraphs'] for sentence in paragraph]
+    }
+
+
+def parse_annotation_record(year, path):
+    annotation = load_json(path)
+    return {
+        'year': year,
+        'file_name': os.path.basename(path),
+        'article_level_annotations': annotation.get('article-level-annotations', {}),
+        'phrase_level_annotations': annotation.get('phrase-level-annotations', [])
+    }
+
+
+def parse_record(kind, year, path):
+    parse = parse_article_record if kind == 'articles' else parse_annotation_record
+    return parse(year, path)
+
+
+def parse_records(entries, workers=None, processes=False):
+    """
+    Parse many BASIL files in parallel.
+
+    :param entries: List of (kind, year, path) with kind 'articles' or 'annotations'.
+    :param workers: Pool size, 1 parses serially in the calling thread.
+    :param processes: Use a process pool instead of threads, worthwhile when parsing dominates I/O.
+    :return: Parsed records in the order of entries.
+    """
+    if workers == 1 or len(entries) < 2:
+        return [parse_record(*entry) for entry in entries]
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    kinds, years, paths = zip(*entries)
+    with executor(max_workers=workers) as pool:
+        return list(pool.map(parse_record, kinds, years, paths, chunksize=64 if processes else 1))
+
+
+class Corpus:
+    """
+    Columnar, memory-mapped view of the compiled BASIL corpus with one row per article.
+
+    String columns (year, event, provider, title, stance) are NumPy arrays, the binary label is an
+    int8 array, and article texts, sentences and annotations are UTF-8 blobs with offset arrays.
+
+    :param temporary: The corpus owns its directory and removes it when closed or garbage collected.
+    """
+
+    def __init__(self, directory, mmap_mode='r', temporary=False):
+        self.directory = directory
+        self._finalizer = weakref.finalize(self, shutil.rmtree, directory, True) if temporary else None
+        load = lambda name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode)
+        for column in STRING_COLUMNS:
+            setattr(self, column, load(column))
+        self.label = load('label')
+        for column in BLOB_COLUMNS + ['sentence']:
+            setattr(self, f'{column}_data', load(f'{column}_data'))
+            setattr(self, f'{column}_offsets', load(f'{column}_offsets'))
+        # row i's sentences are sentence_offsets entries article_sentences[i]:article_sentences[i + 1]
+        self.article_sentences = load('article_sentences')
+
+    def __len__(self):
+        return len(self.label)
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def text(self, i):
+        return unpack_string(self.text_data, self.text_offsets, i)
+
+    def texts(self, indices=None):
+        indices = range(len(self)) if indices is None else indices
+        return [self.text(i) for i in indices]
+
+    def sentences(self, i):
+        return [unpack_string(self.sentence_data, self.sentence_offsets, j)
+                for j in range(self.article_sentences[i], self.article_sentences[i + 1])]
+
+    def annotations(self, i):
+        return json.loads(unpack_string(self.annotations_data, self.annotations_offsets, i))
+
+    def to_nested(self):
+        """
+        Rebuild the nested {year: {event: {provider: ...}}} structures returned by
+        prepare_article_data and prepare_annotation_data.
+        """
+        article_data = {}
+        annotation_data = {}
+        for i in range(len(self)):
+            year, event, provider = str(self.year[i]), str(self.event[i]), str(self.provider[i])
+            article_data.setdefault(year, {}).setdefault(event, {})[provider] = {
+                'sentences': self.sentences(i), 'title': str(self.title[i])
+            }
+            annotation_data.setdefault(year, {}).setdefault(event, {})[provider] = self.annotations(i)
+        return article_data, annotation_data
+
+
+class CorpusCache:
+    """
+    Compiles the BASIL articles and annotations trees into a Corpus on disk.
+
+    Parsed files are kept in a record store keyed by relative path together with their mtime and
+    size, so a rebuild only re-parses files that were added or changed since the last build. When
+    nothing changed, loading the corpus is a single memory-mapped load of the compiled arrays.
+    """
+
+    def __init__(self, articles_path, annotations_path, directory=None, workers=None):
+        corpus_config = config.get('corpus_cache') or {}
+        self.workers = workers
+        self.articles_path = articles_path
+        self.annotations_path = annotations_path
+        self.directory = directory or corpus_config.get('directory', '.cache/corpus')
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        self.records_path = os.path.join(self.directory, 'records.pkl')
+
+    def _scan(self):
+        files = {}
+        for kind, root_path in (('articles', self.articles_path), ('annotations', self.annotations_path)):
+            for year, relative_path, path in list_json_files(root_path):
+                files[f'{kind}/{relative_path}'] = (kind, year, path, file_signature(path))
+        return files
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path, 'r') as f:
+            return json.load(f)
+
+    def _fresh(self, manifest, files):
+        return (
+            manifest is not None
+            and manifest.get('version') == CORPUS_VERSION
+            and manifest.get('articles_path') == os.path.abspath(self.articles_path)
+            and manifest.get('annotations_path') == os.path.abspath(self.annotations_path)
+            and manifest.get('files') == {key: signature for key, (_, _, _, signature) in files.items()}
+        )
+
+    def load(self, check=True):
+        """
+        Load the compiled corpus, rebuilding it first if any source file changed.
+
+        :param check: Stat the source trees to detect changes. Without it an existing build is used as is.
+        """
+        manifest = self._read_manifest()
+        if manifest is not None and not check:
+            return Corpus(self.directory)
+        files = self._scan()
+        if not self._fresh(manifest, files):
+            os.makedirs(self.directory, exist_ok=True)
+            with self._build_lock():
+                # another process may have rebuilt it while this one waited for the lock
+                if not self._fresh(self._read_manifest(), files):
+                    self._build(files)
+        return Corpus(self.directory)
+
+    @contextmanager
+    def _build_lock(self):
+        with open(os.path.join(self.directory, 'build.lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _parse(self, changed):
+        keys = list(changed)
+        records = parse_records([changed[key][:3] for key in keys], workers=self.workers)
+        return {key: (changed[key][3], record) for key, record in zip(keys, records)}
+
+    def build(self, files=None):
+        """
+        Compile the corpus, holding the directory's build lock so concurrent builds don't interleave.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with self._build_lock():
+            self._build(files)
+
+    def _build(self, files=None):
+        files = files if files is not None else self._scan()
+        records = {}
+        if os.path.exists(self.records_path):
+            with open(self.records_path, 'rb') as f:
+                records = pickle.load(f)
+
+        changed = {key: entry for key, entry in files.items()
+                   if key not in records or records[key][0] != entry[3]}
+        records = {key: value for key, value in records.items() if key in files}
+        records.update(self._parse(changed))
+        logging.info(f"Compiling corpus: {len(changed)} of {len(files)} files parsed")
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.records_path + '.tmp', 'wb') as f:
+            pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.records_path + '.tmp', self.records_path)
+
+        self._write_columns(files, records)
+
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump({
+                'version': CORPUS_VERSION,
+                'articles_path': os.path.abspath(self.articles_path),
+                'annotations_path': os.path.abspath(self.annotations_path),
+                'files': {key: signature for key, (_, _, _, signature) in files.items()}
+            }, f)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def _write_columns(self, files, records):
+        # annotation files are named after their article file: <name>.json -> <name>_ann.json
+        annotations = {}
+        for key, (kind, year, path, signature) in files.items():
+            if kind == 'annotations':
+                record = records[key][1]
+                annotations[(record['year'], record['file_name'])] = record
+
+        columns = {column: [] for column in STRING_COLUMNS + BLOB_COLUMNS}
+        labels = []
+        sentences = []
+        article_sentences = [0]
+        binary2num = config['experiment_setup']['conversions']['binary2num']
+        for key, (kind, year, path, signature) in files.items():
+            if kind != 'articles':
+                continue
+            article = records[key][1]
+            annotation = annotations.get((article['year'], article['file_name'][:-5] + '_ann.json'))
+            if annotation is None:
+                logging.warning(f"No annotations for article {key}, skipping it")
+                continue
+            stance = annotation['article_level_annotations'].get('relative_stance', '')
+            columns['year'].append(article['year'])
+            columns['event'].append(article['file_name'][:-7])
+            columns['provider'].append(article['source'].lower())
+            columns['title'].append(article['title'])
+            columns['stance'].append(stance)
+            columns['text'].append(article['title'] + ' ' + ' '.join(article['sentences']))
+            columns['annotations'].append(json.dumps({
+                'article_level_annotations': annotation['article_level_annotations'],
+                'phrase_level_annotations': annotation['phrase_level_annotations']
+            }))
+            labels.append(binary2num['nonbiased'] if stance.lower() == 'center' else binary2num['biased'])
+            sentences.extend(article['sentences'])
+            article_sentences.append(len(sentences))
+
+        for column in STRING_COLUMNS:
+            self._save_column(column, np.array(columns[column], dtype=str))
+        self._save_column('label', np.array(labels, dtype=np.int8))
+        for column, values in [('text', columns['text']), ('annotations', columns['annotations']),
+                               ('sentence', sentences)]:
+            data, offsets = pack_strings(values)
+            self._save_column(f'{column}_data', data)
+            self._save_column(f'{column}_offsets', offsets)
+        self._save_column('article_sentences', np.array(article_sentences, dtype=np.int64))
+
+    def _save_column(self, name, array):
+        # written next to the column and swapped in, readers that memory-mapped the old file keep it intact
+        path = os.path.join(self.directory, f'{name}.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array)
+        os.replace(path + '.tmp', path)
+
+
+def load_corpus(articles_path, annotations_path, directory=None, check=True, workers=None):
+    return CorpusCache(articles_path, annotations_path, directory, workers).load(check=check)
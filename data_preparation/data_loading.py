@@ -1,150 +1,189 @@
 import os
-import json
 
-import random
-from sklearn.model_selection import train_test_split
+import tempfile
+import threading
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+
 from data_preparation import config
+from data_preparation.corpus_cache import Corpus, CorpusCache, load_corpus, load_json, list_json_files, parse_records
+from data_preparation.data_splits import split_event_non_overlapping, split_event_overlapping
 
-def load_json_files(folder_path):
-    data_list = []
+def load_json_files(folder_path, workers=None):
+    paths = []
     for root, dirs, files in os.walk(folder_path):
-        for file in files:
+        dirs.sort()
+        for file in sorted(files):
             if file.endswith('.json'):
-                with open(os.path.join(root, file), 'r') as f:
-                    data_list.append((file, json.load(f)))
-    return data_list
-
-annotation_sources = {}
-def prepare_article_data(articles_path):
-    article_data = {}
-    for year_folder in os.listdir(articles_path):
-        year_path = os.path.join(articles_path, year_folder)
-        if os.path.isdir(year_path):
-            article_data[year_folder] = {}
-            articles = load_json_files(year_path)
-            for file_name, article in articles:
-                #add a source to the annotations file using the article title before truncation
-                annotation_sources[file_name[:-5] + '_ann' + '.json'] = article['source']
-                article_name = file_name[:-7]  # Removing last two characters and .json
-                news_provider = article.get('source', 'unknown').lower()
-                # including the title in the sentences
-                title = article['title']
-                sentences = [sentence for paragraph in article['body-paragraphs'] for sentence in paragraph]
-                if article_name not in article_data[year_folder]:
-                    article_data[year_folder][article_name] = {}
-                if news_provider not in article_data[year_folder][article_name]:
-                    article_data[year_folder][article_name][news_provider] = {}
-
-                article_data[year_folder][article_name][news_provider]= {'sentences': sentences, 'title': title}
+                paths.append(os.path.join(root, file))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(zip((os.path.basename(path) for path in paths), pool.map(load_json, paths)))
+
+
+def year_folders(path):
+    return [year for year in sorted(os.listdir(path)) if os.path.isdir(os.path.join(path, year))]
+
+
+def join_basil_records(years, article_records, annotation_records):
+    """
+    Join parsed article and annotation records by (year, event, provider) into the nested
+    structures of prepare_article_data and prepare_annotation_data. An annotation file is named
+    after its article file (<name>.json -> <name>_ann.json) and takes the article's source.
+    """
+    article_data = {year: {} for year in years}
+    sources = {}
+    for article in article_records:
+        file_name = article['file_name']
+        sources[(article['year'], file_name[:-5] + '_ann' + '.json')] = article['source']
+        article_name = file_name[:-7]  # Removing last two characters and .json
+        news_provider = article.get('source', 'unknown').lower()
+        article_data[article['year']].setdefault(article_name, {})[news_provider] = {
+            'sentences': article['sentences'], 'title': article['title']
+        }
+
+    annotation_data = {year: {} for year in years}
+    for annotation in annotation_records:
+        file_name = annotation['file_name']
+        news_provider = sources[(annotation['year'], file_name)].lower()
+        annotation_name = file_name[:-11]  # Removing last two characters and .json
+        annotation_data[annotation['year']].setdefault(annotation_name, {})[news_provider] = {
+            'article_level_annotations': annotation['article_level_annotations'],
+            'phrase_level_annotations': annotation['phrase_level_annotations']
+        }
+    return article_data, annotation_data
+
+
+def load_basil(articles_path, annotations_path, workers=None, processes=False):
+    """
+    Read the BASIL article and annotation trees in one parallel pass.
+
+    :param workers: Size of the parsing pool.
+    :param processes: Parse in worker processes instead of threads.
+    :return: Tuple of (article_data, annotation_data) as returned by prepare_article_data and
+             prepare_annotation_data.
+    """
+    articles = [('articles', year, path) for year, _, path in list_json_files(articles_path)]
+    annotations = [('annotations', year, path) for year, _, path in list_json_files(annotations_path)]
+    records = parse_records(articles + annotations, workers=workers, processes=processes)
+    years = sorted(set(year_folders(articles_path)) | set(year_folders(annotations_path)))
+    return join_basil_records(years, records[:len(articles)], records[len(articles):])
+
+
+def prepare_article_data(articles_path, workers=None):
+    entries = [('articles', year, path) for year, _, path in list_json_files(articles_path)]
+    article_data, _ = join_basil_records(year_folders(articles_path), parse_records(entries, workers=workers), [])
     return article_data
 
-def prepare_annotation_data(annotations_path):
-    annotation_data = {}
-    for year_folder in os.listdir(annotations_path):
-        year_path = os.path.join(annotations_path, year_folder)
-        if os.path.isdir(year_path):
-            annotation_data[year_folder] = {}
-            annotations = load_json_files(year_path)
-            for file_name, annotation in annotations:
-                news_provider = annotation_sources[file_name].lower()
-                annotation_name = file_name[:-11]  # Removing last two characters and .json
-
-                article_level_annotations = annotation.get('article-level-annotations', {})
-                phrase_level_annotations = annotation.get('phrase-level-annotations', [])
-
-                if annotation_name not in annotation_data[year_folder]:
-                    annotation_data[year_folder][annotation_name] = {}
-                if news_provider not in annotation_data[year_folder][annotation_name]:
-                    annotation_data[year_folder][annotation_name][news_provider] = {}
-
-                annotation_data[year_folder][annotation_name][news_provider]['article_level_annotations'] = article_level_annotations
-                annotation_data[year_folder][annotation_name][news_provider]['phrase_level_annotations'] = phrase_level_annotations
-    return annotation_data
-
-
-def split_event_non_overlapping(articles, annotations, random_state=None, test_size=0.2):
-    # Group articles and annotations by event
-    train_articles = []
-    train_annotations = []
-    test_articles = []
-    test_annotations = []
-
-    grouped_articles = []
-    grouped_annotations = []
-
-
-    for year, articles_dict in articles.items():
-      for article_name, providers_dict in articles_dict.items():
-        grouped_articles.append(providers_dict)
-        grouped_annotations.append(annotations[year][article_name])
-
-    group_size = len(grouped_articles)
-    test_size = int(group_size * test_size)
-    train_size = group_size - test_size
-
-    indices = list(range(group_size))
-    random.shuffle(indices)
-
-    test_indices = indices[:test_size]
-    train_indices = indices[test_size:]
-
-    for i in train_indices:
-      for provider, article_data in grouped_articles[i].items():
-        train_articles.append({
-          'title': article_data['title'],
-          'sentences': article_data['sentences']
-        })
-        train_annotations.append(grouped_annotations[i][provider])
-
-    for i in test_indices:
-      for provider, article_data in grouped_articles[i].items():
-        test_articles.append({
-          'title': article_data['title'],
-          'sentences': article_data['sentences']
-        })
-        test_annotations.append(grouped_annotations[i][provider])
-    return np.array(train_articles), np.array(test_articles), np.array(train_annotations), np.array(test_annotations)
-
-
-def split_event_overlapping(articles, annotations, random_state=None ,test_size=0.2):
-    all_articles = []
-    all_annotations = []
-
-    for year, articles_dict in articles.items():
-        for article_name, providers_dict in articles_dict.items():
-            for provider, article_data in providers_dict.items():
-                all_articles.append({
-                    'title': article_data['title'],
-                    'sentences': article_data['sentences']
-                })
-                all_annotations.append({
-                    'article_level_annotations': annotations[year][article_name][provider]['article_level_annotations'],
-                    'phrase_level_annotations': annotations[year][article_name][provider]['phrase_level_annotations']
-                })
-
-    train_articles, test_articles, train_annotations, test_annotations = train_test_split(
-        all_articles, all_annotations, test_size=test_size, random_state=random_state
-    )
-
-    return np.array(train_articles), np.array(test_articles), np.array(train_annotations), np.array(test_annotations)
+
+def prepare_annotation_data(annotations_path, articles_path=None, workers=None):
+    """
+    :param articles_path: Articles tree the annotations belong to, their sources name the providers.
+                          Defaults to the 'articles' folder next to annotations_path.
+    """
+    if articles_path is None:
+        articles_path = os.path.join(os.path.dirname(os.path.normpath(annotations_path)), 'articles')
+    return load_basil(articles_path, annotations_path, workers=workers)[1]
+
+
+# corpora compiled without the corpus cache, keyed by their articles and annotations paths
+_temporary_corpora = {}
+_temporary_corpora_lock = threading.Lock()
+
+
+def _temporary_corpus(articles_path, annotations_path):
+    """
+    Compile the corpus into a temporary directory once per process, so that get_data and
+    get_sentence_data share it. The directory is removed when the process exits.
+    """
+    key = (os.path.abspath(articles_path), os.path.abspath(annotations_path))
+    with _temporary_corpora_lock:
+        if key not in _temporary_corpora:
+            directory = tempfile.mkdtemp(prefix='corpus_')
+            CorpusCache(articles_path, annotations_path, directory).build()
+            _temporary_corpora[key] = Corpus(directory, temporary=True)
+        return _temporary_corpora[key]
+
+
+def load_split(articles_path, annotations_path, event_overlapping=False, random_state=None, use_cache=None):
+    """
+    Load BASIL and split it.
+
+    :param use_cache: Reuse the compiled corpus of the corpus_cache section in config.yml, otherwise
+                      the corpus is compiled into a temporary directory once per process.
+    :return: Tuple of the corpus and its row indices, those of the train split followed by the test split.
+    """
+    if use_cache is None:
+        use_cache = (config.get('corpus_cache') or {}).get('enabled', False)
+    if use_cache:
+        # compiled corpus, only files changed since the last build are parsed again
+        corpus = load_corpus(articles_path, annotations_path)
+    else:
+        corpus = _temporary_corpus(articles_path, annotations_path)
+    split = split_event_overlapping if event_overlapping else split_event_non_overlapping
+    train, test = split(corpus, random_state)
+    # prompt based test
+    return corpus, np.concatenate((train, test))
+
 
 def format_annotations(ann, annotation_type):
     binary2num = config['experiment_setup']['conversions']['binary2num']
     return [binary2num['nonbiased'] if a['article_level_annotations']['relative_stance'].lower() == 'center' else binary2num['biased'] for a in ann]
-def get_data(articles_path, annotations_path, event_overlapping=False,random_state=None, destructure=True):
-    article_data = prepare_article_data(articles_path)
-    annotation_data = prepare_annotation_data(annotations_path)
-    if event_overlapping:
-        data = split_event_overlapping(article_data, annotation_data, random_state)
-    else:
-        data = split_event_non_overlapping(article_data, annotation_data, random_state)
-    train_articles, test_articles, train_annotations, test_annotations = data
-    # prompt based test
-    articles, annotations = np.concatenate((train_articles, test_articles)), np.concatenate(
-        (train_annotations, test_annotations))
-    articles = [a['title'] + ' ' + ' '.join(a['sentences']) for a in articles]
+
+
+def get_data(articles_path, annotations_path, event_overlapping=False,random_state=None, destructure=True, use_cache=None):
+    corpus, rows = load_split(articles_path, annotations_path, event_overlapping, random_state, use_cache)
+    articles = corpus.texts(rows)
     if destructure:
-        annotations = format_annotations(annotations, 'multiclass')
-    return articles, annotations
\ No newline at end of file
+        # the corpus's label column is format_annotations of the article-level annotations
+        annotations = corpus.label[rows].tolist()
+    else:
+        annotations = [corpus.annotations(i) for i in rows]
+    return articles, annotations
+
+
+def normalize_text(text):
+    return ' '.join(text.split()).lower()
+
+
+def phrase_sentences(sentences, phrases):
+    """
+    Map phrase-level annotations onto the sentences containing them. A phrase spanning several
+    sentences maps to each sentence it contains, phrases found in no sentence are left out.
+
+    :return: List of the sentence indices of each located phrase.
+    """
+    normalized = [normalize_text(sentence) for sentence in sentences]
+    located = []
+    for phrase in phrases:
+        text = normalize_text(phrase.get('txt') or phrase.get('text') or '')
+        if not text:
+            continue
+        indices = [i for i, sentence in enumerate(normalized) if text in sentence]
+        if not indices:
+            indices = [i for i, sentence in enumerate(normalized) if sentence and sentence in text]
+        if indices:
+            located.append(indices)
+    return located
+
+
+def get_sentence_data(articles_path, annotations_path, event_overlapping=False, random_state=None, use_cache=None):
+    """
+    Sentence-level counterpart of get_data, keeping the sentences of every article. A sentence is
+    biased when it contains a phrase-level annotation.
+
+    :return: Tuple of (articles, sentence labels, phrases): the sentences of each article, the
+             binary label of each sentence and the sentence indices of each annotated phrase.
+    """
+    corpus, rows = load_split(articles_path, annotations_path, event_overlapping, random_state, use_cache)
+    binary2num = config['experiment_setup']['conversions']['binary2num']
+    sentences, labels, phrases = [], [], []
+    for i in rows:
+        article_sentences = corpus.sentences(i)
+        located = phrase_sentences(article_sentences, corpus.annotations(i)['phrase_level_annotations'])
+        biased = {index for indices in located for index in indices}
+        sentences.append(article_sentences)
+        labels.append([binary2num['biased'] if j in biased else binary2num['nonbiased']
+                       for j in range(len(article_sentences))])
+        phrases.append(located)
+    return sentences, labels, phrases
@@ -1,73 +1,109 @@
+import math
 import random
-import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
-import random
-from sklearn.model_selection import train_test_split
 import numpy as np
 
-
-def split_event_non_overlapping(articles, annotations, test_size=0.2):
-    # Group articles and annotations by event
-    train_articles = []
-    train_annotations = []
-    test_articles = []
-    test_annotations = []
-
-    grouped_articles = []
-    grouped_annotations = []
-
-
-    for year, articles_dict in articles.items():
-      for article_name, providers_dict in articles_dict.items():
-        grouped_articles.append(providers_dict)
-        grouped_annotations.append(annotations[year][article_name])
-
-    group_size = len(grouped_articles)
-    test_size = int(group_size * test_size)
-    train_size = group_size - test_size
-
-    indices = list(range(group_size))
-    random.shuffle(indices)
-
-    test_indices = indices[:test_size]
-    train_indices = indices[test_size:]
-
-    for i in train_indices:
-      for provider, article_data in grouped_articles[i].items():
-        train_articles.append({
-          'title': article_data['title'],
-          'sentences': article_data['sentences']
-        })
-        train_annotations.append(grouped_annotations[i][provider])
-
-    for i in test_indices:
-      for provider, article_data in grouped_articles[i].items():
-        test_articles.append({
-          'title': article_data['title'],
-          'sentences': article_data['sentences']
-        })
-        test_annotations.append(grouped_annotations[i][provider])
-    return np.array(train_articles), np.array(test_articles), np.array(train_annotations), np.array(test_annotations)
-
-
-def split_event_overlapping(articles, annotations, test_size=0.2):
-    all_articles = []
-    all_annotations = []
-
-    for year, articles_dict in articles.items():
-        for article_name, providers_dict in articles_dict.items():
-            for provider, article_data in providers_dict.items():
-                all_articles.append({
-                    'title': article_data['title'],
-                    'sentences': article_data['sentences']
-                })
-                all_annotations.append({
-                    'article_level_annotations': annotations[year][article_name][provider]['article_level_annotations'],
-                    'phrase_level_annotations': annotations[year][article_name][provider]['phrase_level_annotations']
-                })
-
-    train_articles, test_articles, train_annotations, test_annotations = train_test_split(
-        all_articles, all_annotations, test_size=test_size, random_state=42
-    )
-
-    return np.array(train_articles), np.array(test_articles), np.array(train_annotations), np.array(test_annotations)
\ No newline at end of file
+from data_preparation.corpus_cache import Corpus
+
+# corpus of the current fold worker process, opened once by _open_corpus
+_worker_corpus = None
+
+
+def event_groups(corpus):
+    """
+    Group id of every row of the corpus, one group per (year, event), numbered in order of first
+    appearance.
+    """
+    keys = np.char.add(np.char.add(corpus.year.astype(str), '/'), corpus.event.astype(str))
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    # np.unique numbers the groups in sorted order, renumber them by first appearance
+    order = np.empty(len(first), dtype=np.int64)
+    order[np.argsort(first)] = np.arange(len(first))
+    return order[inverse]
+
+
+def _group_rows(groups, selected):
+    """
+    Rows of the selected groups, group by group in the order of selected.
+    """
+    if not len(selected):
+        return np.zeros(0, dtype=np.int64)
+    rows = np.argsort(groups, kind='stable')
+    starts = np.searchsorted(groups[rows], np.arange(int(groups.max()) + 2))
+    return np.concatenate([rows[starts[group]:starts[group + 1]] for group in selected])
+
+
+def split_event_non_overlapping(corpus, random_state=None, test_size=0.2):
+    """
+    Split the corpus by event, the articles of an event all going to the same side.
+
+    :return: Tuple of (train, test) row index arrays.
+    """
+    groups = event_groups(corpus)
+    group_count = int(groups.max()) + 1 if len(groups) else 0
+    test_count = int(group_count * test_size)
+    indices = list(range(group_count))
+    # a fixed random_state keeps item indices stable across restarts, which resuming relies on
+    random.Random(random_state).shuffle(indices)
+    return _group_rows(groups, indices[test_count:]), _group_rows(groups, indices[:test_count])
+
+
+def split_event_overlapping(corpus, random_state=None, test_size=0.2):
+    """
+    Split the articles at random, articles of the same event can end up on both sides. Draws the
+    same split as sklearn's train_test_split with the same random_state.
+
+    :return: Tuple of (train, test) row index arrays.
+    """
+    test_count = math.ceil(test_size * len(corpus))
+    permutation = np.random.RandomState(random_state).permutation(len(corpus))
+    return permutation[test_count:], permutation[:test_count]
+
+
+def event_kfold(corpus, n_splits=5, random_state=None):
+    """
+    Seeded k-fold cross-validation grouped by event: every event's articles are in the test set of
+    exactly one fold and never on both sides of a fold.
+
+    :return: List of (train, test) row index arrays, one per fold.
+    """
+    groups = event_groups(corpus)
+    group_count = int(groups.max()) + 1 if len(groups) else 0
+    if n_splits < 2 or n_splits > group_count:
+        raise ValueError(f"Cannot split {group_count} events into {n_splits} folds")
+    indices = list(range(group_count))
+    # seeded the same way as split_event_non_overlapping
+    random.Random(random_state).shuffle(indices)
+    folds = []
+    for test_groups in np.array_split(np.asarray(indices, dtype=np.int64), n_splits):
+        test = np.isin(groups, test_groups)
+        folds.append((np.flatnonzero(~test), np.flatnonzero(test)))
+    return folds
+
+
+def _open_corpus(directory):
+    global _worker_corpus
+    _worker_corpus = Corpus(directory)
+
+
+def _evaluate_fold(evaluate, fold, train, test):
+    return evaluate(_worker_corpus, fold, train, test)
+
+
+def evaluate_folds(corpus, folds, evaluate, workers=None):
+    """
+    Evaluate folds in parallel worker processes. Every worker memory-maps the compiled corpus from
+    its directory once, so only the fold's index arrays are sent to it and the articles are shared
+    through the page cache instead of being copied into each process.
+
+    :param folds: List of (train, test) row index arrays, e.g. from event_kfold.
+    :param evaluate: Picklable (module-level) function called with (corpus, fold number, train, test).
+    :param workers: Number of worker processes, 1 evaluates the folds in this process.
+    :return: The results of evaluate, in fold order.
+    """
+    if workers == 1:
+        return [evaluate(corpus, fold, train, test) for fold, (train, test) in enumerate(folds)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_open_corpus, initargs=(corpus.directory,)) as pool:
+        return list(pool.map(_evaluate_fold, [evaluate] * len(folds), range(len(folds)),
+                             [train for train, _ in folds], [test for _, test in folds]))
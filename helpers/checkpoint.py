@@ -0,0 +1,106 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from helpers import config
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class RequestJournal:
+    """
+    Durable per-request journal of completed predictions, keyed by (experiment, model, run, item index).
+
+    Every response is written as soon as it arrives, so an experiment that crashes or is killed
+    part way through only has to send the requests that are missing from the journal when restarted.
+    Each entry also stores a hash of the item's text, entries whose text no longer matches the item
+    at that index (e.g. after a different data split) are ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS journal ('
+                'experiment TEXT, model TEXT, run INTEGER, item INTEGER, text_hash TEXT, response TEXT, created REAL, '
+                'PRIMARY KEY (experiment, model, run, item))'
+            )
+
+    def record(self, experiment, model, run, item, text, response):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO journal (experiment, model, run, item, text_hash, response, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (experiment, model, run, item, text_hash(text), response, time.time())
+            )
+
+    def completed(self, experiment, model, texts):
+        """
+        Return the journaled responses of an experiment whose text still matches the current items.
+
+        :param texts: The experiment's items, indexed as in the journal.
+        :return: Dictionary mapping (run, item index) to the raw response.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT run, item, text_hash, response FROM journal WHERE experiment = ? AND model = ?',
+                (experiment, model)
+            ).fetchall()
+        completed = {}
+        stale = 0
+        for run, item, stored_hash, response in rows:
+            if item < len(texts) and stored_hash == text_hash(texts[item]):
+                completed[(run, item)] = response
+            else:
+                stale += 1
+        if stale:
+            logging.warning(f"Ignoring {stale} journal entries for {experiment} ({model}) that no longer match the data")
+        return completed
+
+    def clear(self, experiment, model):
+        with self._lock:
+            self._conn.execute('DELETE FROM journal WHERE experiment = ? AND model = ?', (experiment, model))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def experiment_key(params):
+    """
+    Identify an experiment in the journal, the prompt hash keeps edited prompts from reusing old responses.
+    """
+    prompt_hash = hashlib.sha1((params.get('prompt') or '').encode('utf-8')).hexdigest()[:12]
+    fine_tuned = 'ft' if params.get('fine_tuned', False) else 'nft'
+    return f"{params.get('experiment_name')}:{fine_tuned}:{prompt_hash}"
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """
+    Return the process-wide request journal configured in config.yml, or None if checkpointing is disabled.
+    """
+    global _journal
+    checkpoint_config = config.get('checkpoint') or {}
+    if not checkpoint_config.get('enabled', False):
+        return None
+    with _journal_lock:
+        if _journal is None:
+            _journal = RequestJournal(checkpoint_config.get('path', '.cache/journal.sqlite'))
+    return _journal
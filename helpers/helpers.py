@@ -1,42 +1,16 @@
 import logging
-import pandas as pd
 import os
-import numpy as np
 from datetime import datetime
-import re
 
 from helpers import config
+from helpers.parsing import LEGACY_PARSER
 
 def extract_single_word(response):
-    # Combine valid responses into a single regex pattern
-    valid_responses = ["conservative", "liberal", "Non-biased", "NonBiased", "Non Biased", "left", "right", "biased",
-                       "biased.", "Non Biased.", "NonBiased.", "center"]
-    pattern = r'\b(?:' + '|'.join(re.escape(word) for word in valid_responses) + r')\b'
-
-    # Search for the pattern in the response
-    match = re.search(pattern, response, re.IGNORECASE)
-
-    # If a match is found, process it
-    if match:
-        word = match.group(0).lower()
-        if word == "conservative":
-            return "right"
-        elif word == "liberal":
-            return "left"
-        elif word in ["center", "center."]:
-            return "center"
-        elif word in ["non-biased", "nonbiased", "non biased.", "nonbiased."]:
-            return "nonbiased"
-        elif word == "left":
-            return "left"
-        elif word == "right":
-            return "right"
-        elif word in ["biased", "biased."]:
-            return "biased"
-        else:
-            return word
-    # Return an empty string if no match is found
-    return "none"
+    """
+    Compatibility wrapper around the parser registry (helpers.parsing), returns the first label
+    mentioned in response or 'none'.
+    """
+    return LEGACY_PARSER.parse(response) or 'none'
 
 
 def generate_experiment_name(prompt_type, text_type, role, response_type):
@@ -0,0 +1,184 @@
+import math
+
+import numpy as np
+
+from helpers import config
+
+METRICS = ['accuracy', 'precision', 'recall', 'f1']
+
+
+def prediction_matrix(predictions):
+    """
+    Stack per-run predictions into an integer matrix of shape (runs, items), or (..., runs, items)
+    for several experiments at once.
+    """
+    return np.asarray(predictions, dtype=np.int64)
+
+
+def majority_vote(matrix):
+    """
+    Most common prediction per item over the runs axis (-2) of matrix.
+
+    Ties go to the value predicted first, as with Counter.most_common over the runs in order.
+    """
+    matrix = np.asarray(matrix)
+    runs = matrix.shape[-2]
+    classes = np.unique(matrix)
+    # (classes, ..., runs, items)
+    hits = matrix[np.newaxis] == classes.reshape((-1,) + (1,) * matrix.ndim)
+    counts = hits.sum(axis=-2)
+    first = np.where(hits.any(axis=-2), hits.argmax(axis=-2), runs)
+    # highest count first, earliest first occurrence among equal counts
+    winner = np.argmax(counts * (runs + 1) - first, axis=0)
+    return classes[winner]
+
+
+def _safe_divide(numerator, denominator):
+    # undefined ratios are 0, like sklearn's zero_division default
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    return np.divide(numerator, denominator, out=np.zeros(np.broadcast(numerator, denominator).shape),
+                     where=denominator != 0)
+
+
+def _class_counts(y_true, y_pred, label):
+    true_label = y_true == label
+    pred_label = y_pred == label
+    tp = (true_label & pred_label).sum(axis=-1)
+    fp = (~true_label & pred_label).sum(axis=-1)
+    fn = (true_label & ~pred_label).sum(axis=-1)
+    return tp, fp, fn
+
+
+def classification_metrics(y_true, y_pred, average='binary', pos_label=1, labels=None):
+    """
+    Accuracy, precision, recall and F1 over the last axis, for any number of leading (experiment or
+    resample) axes.
+
+    :param average: 'binary' scores pos_label only, 'macro' averages the per-label scores.
+    :param labels: Labels averaged by 'macro', defaults to every label in y_true and y_pred.
+    :return: Dictionary of metric arrays (floats when the inputs are one-dimensional).
+    """
+    y_true = np.asarray(y_true)
+    y_pred = np.asarray(y_pred)
+    accuracy = (y_true == y_pred).mean(axis=-1)
+    if average == 'binary':
+        tp, fp, fn = _class_counts(y_true, y_pred, pos_label)
+        precision = _safe_divide(tp, tp + fp)
+        recall = _safe_divide(tp, tp + fn)
+        f1 = _safe_divide(2 * tp, 2 * tp + fp + fn)
+    elif average == 'macro':
+        labels = np.union1d(np.unique(y_true), np.unique(y_pred)) if labels is None else labels
+        counts = [_class_counts(y_true, y_pred, label) for label in labels]
+        tp, fp, fn = (np.stack(values) for values in zip(*counts))
+        precision = _safe_divide(tp, tp + fp).mean(axis=0)
+        recall = _safe_divide(tp, tp + fn).mean(axis=0)
+        f1 = _safe_divide(2 * tp, 2 * tp + fp + fn).mean(axis=0)
+    else:
+        raise ValueError(f"Unknown average: {average}")
+    metrics = {'accuracy': accuracy, 'precision': precision, 'recall': recall, 'f1': f1}
+    return {name: value[()] if np.ndim(value) == 0 else value for name, value in metrics.items()}
+
+
+def run_agreement(matrix):
+    """
+    Mean pairwise agreement between runs: the probability that two different runs gave an item the
+    same prediction, averaged over items. 1.0 for a single run.
+    """
+    matrix = np.asarray(matrix)
+    runs = matrix.shape[-2]
+    if runs < 2:
+        return np.ones(matrix.shape[:-2])[()]
+    classes = np.unique(matrix)
+    counts = (matrix[np.newaxis] == classes.reshape((-1,) + (1,) * matrix.ndim)).sum(axis=-2)
+    agreement = (counts * (counts - 1)).sum(axis=0) / (runs * (runs - 1))
+    return agreement.mean(axis=-1)[()]
+
+
+def bootstrap_ci(y_true, y_pred, n_resamples=1000, confidence=0.95, random_state=None, average='binary',
+                 max_elements=10_000_000):
+    """
+    Percentile bootstrap confidence intervals of the classification metrics, resampling items.
+
+    All resamples are scored at once as a (resamples, items) matrix, in chunks of at most
+    max_elements entries to bound memory.
+
+    :return: Dictionary mapping each metric to its (low, high) bounds.
+    """
+    y_true = np.asarray(y_true)
+    y_pred = np.asarray(y_pred)
+    n = y_true.shape[-1]
+    if n == 0 or n_resamples <= 0:
+        return {name: (np.nan, np.nan) for name in METRICS}
+    rng = np.random.default_rng(random_state)
+    labels = np.union1d(np.unique(y_true), np.unique(y_pred)) if average == 'macro' else None
+    chunk = max(1, max_elements // n)
+    scores = {name: [] for name in METRICS}
+    for start in range(0, n_resamples, chunk):
+        indices = rng.integers(0, n, size=(min(chunk, n_resamples - start), n))
+        resampled = classification_metrics(y_true[indices], y_pred[indices], average=average, labels=labels)
+        for name in METRICS:
+            scores[name].append(resampled[name])
+    alpha = (1 - confidence) / 2
+    intervals = {}
+    for name in METRICS:
+        low, high = np.quantile(np.concatenate(scores[name]), [alpha, 1 - alpha])
+        intervals[name] = (float(low), float(high))
+    return intervals
+
+
+def paired_p_value(correct_a, correct_b):
+    """
+    Two-sided exact McNemar test of whether two classifiers scored on the same items differ in
+    accuracy. Only the items exactly one of them got right count.
+
+    :param correct_a: Boolean array, whether the first classifier got each item right.
+    :param correct_b: The same for the second classifier.
+    """
+    correct_a = np.asarray(correct_a, dtype=bool)
+    correct_b = np.asarray(correct_b, dtype=bool)
+    only_a = int((correct_a & ~correct_b).sum())
+    only_b = int((~correct_a & correct_b).sum())
+    discordant = only_a + only_b
+    if discordant == 0:
+        return 1.0
+    # binomial(discordant, 1/2) tail, in exact integers
+    tail = sum(math.comb(discordant, k) for k in range(min(only_a, only_b) + 1))
+    return min(1.0, 2 * tail / 2 ** discordant)
+
+
+def metric_settings():
+    metrics_config = config.get('metrics') or {}
+    return {
+        'n_resamples': metrics_config.get('bootstrap_resamples', 1000),
+        'confidence': metrics_config.get('confidence', 0.95),
+        'random_state': metrics_config.get('random_state')
+    }
+
+
+def evaluate(matrix, ground_truths, average=None):
+    """
+    Score an experiment from its (runs, items) prediction matrix: majority vote over the runs,
+    metrics of the vote, agreement between runs and bootstrap confidence intervals.
+
+    :param average: 'binary' or 'macro', by default binary unless there are labels other than 0 and 1.
+    :return: Dictionary with the majority vote 'predictions', the metrics, 'agreement' and
+             '<metric>_ci' (low, high) tuples.
+    """
+    matrix = prediction_matrix(matrix)
+    ground_truths = np.asarray(ground_truths, dtype=np.int64)
+    if matrix.shape[-1] == 0:
+        # every item failed, nothing to score
+        result = {'predictions': np.zeros(0, dtype=np.int64), 'agreement': np.nan}
+        result.update({name: np.nan for name in METRICS})
+        result.update({f'{name}_ci': (np.nan, np.nan) for name in METRICS})
+        return result
+    if average is None:
+        average = 'binary' if np.isin(np.union1d(matrix, ground_truths), [0, 1]).all() else 'macro'
+    predictions = majority_vote(matrix)
+    result = {'predictions': predictions, 'agreement': float(run_agreement(matrix))}
+    result.update({name: float(value) for name, value in
+                   classification_metrics(ground_truths, predictions, average=average).items()})
+    intervals = bootstrap_ci(ground_truths, predictions, average=average, **metric_settings())
+    result.update({f'{name}_ci': interval for name, interval in intervals.items()})
+    return result
@@ -0,0 +1,93 @@
+import logging
+import random
+
+import numpy as np
+
+from helpers import config
+from helpers.parsing import IndexedLabelParser, get_parser, format_numbered
+from helpers.rate_limiting import estimate_tokens
+
+# appended to the experiment prompt of packed requests
+PACKING_INSTRUCTIONS = (
+    "The text is a numbered list of separate news articles, one per line. Classify every article on its own "
+    "and answer with one label per article as a line '[<article number>] <label>', or in the requested JSON format."
+)
+
+
+def packing_config():
+    return config.get('packing') or {}
+
+
+def packed_prompt(prompt):
+    return prompt.rstrip() + '\n' + PACKING_INSTRUCTIONS
+
+
+def pack_texts(texts, prompt, budget, max_items=None):
+    """
+    Group texts, in order, into requests whose estimated input (the packed prompt plus the texts)
+    stays within `budget` tokens. A text too long to share a request gets one of its own.
+
+    :param max_items: Largest number of texts in one request, bounding the length of the answer.
+    :return: List of lists of text indices.
+    """
+    max_items = max_items or packing_config().get('max_items', 20)
+    overhead = estimate_tokens(packed_prompt(prompt), max_tokens=0)
+    packs = []
+    pack, used = [], overhead
+    for index, text in enumerate(texts):
+        # the '[n] ' prefix and newline of each line
+        tokens = estimate_tokens(text, max_tokens=0) + 2
+        if pack and (used + tokens > budget or len(pack) >= max_items):
+            packs.append(pack)
+            pack, used = [], overhead
+        pack.append(index)
+        used += tokens
+    if pack:
+        packs.append(pack)
+    return packs
+
+
+def packed_parser(params):
+    max_items = params.get('pack_max_items') or packing_config().get('max_items', 20)
+    return IndexedLabelParser(get_parser(params.get('classification_type', 'binary')), max_items)
+
+
+def format_pack(texts, pack):
+    # articles are classified line by line, line breaks inside an article would break the numbering
+    return format_numbered(' '.join(texts[index].split()) for index in pack)
+
+
+def drift_sample(size, params):
+    """
+    Item indices that are also classified unpacked to measure packing drift, the same every run of
+    an experiment so that resumed runs reuse the cached single-article responses. Empty unless a
+    drift sample is requested, as it costs a request per sampled item and run.
+    """
+    sample_size = params.get('pack_drift_sample')
+    if sample_size is None:
+        sample_size = packing_config().get('drift_sample', 0)
+    sample_size = min(size, sample_size)
+    return sorted(random.Random(params.get('experiment_name')).sample(range(size), sample_size))
+
+
+def packing_drift(responses, ground_truths, parser, num_runs):
+    """
+    Accuracy of the packed predictions minus the accuracy of unpacked predictions of the same items,
+    from the ('unpacked', run, index) responses of the drift sample, leaving out items whose packed
+    or unpacked request failed and items the packed answer missed, which were sent on their own
+    (marked by ('single', run, index) keys). None without a sample.
+    """
+    keys = [key[1:] for key in responses
+            if len(key) == 3 and key[0] == 'unpacked' and key[1] <= num_runs and key[1:] in responses
+            and ('single',) + key[1:] not in responses
+            and responses[key] is not None and responses[key[1:]] is not None]
+    if not keys:
+        return None
+    packed, _ = parser.to_values(parser.parse_many([responses[key] for key in keys]))
+    unpacked, _ = parser.to_values(parser.parse_many([responses[('unpacked',) + key] for key in keys]))
+    truths = np.asarray([ground_truths[index] for _, index in keys])
+    packed, unpacked = np.asarray(packed), np.asarray(unpacked)
+    drift = float(np.mean(packed == truths) - np.mean(unpacked == truths))
+    logging.info(f"Packing drift over {len(keys)} predictions: accuracy {drift:+.3f}, "
+                 f"packed and unpacked agree on {np.mean(packed == unpacked):.1%}")
+    return drift
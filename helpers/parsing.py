@@ -0,0 +1,230 @@
+import json
+import logging
+import re
+import threading
+
+from helpers import config
+
+
+class LabelParser:
+    """
+    Maps raw model responses onto one label set.
+
+    The alternation pattern over all labels and aliases is compiled once. Free-text responses take
+    the first label mentioned in them, structured responses (a JSON object with a 'label' field, or
+    a bare enum value) are matched exactly.
+    """
+    # output token budget of a structured response, None uses structured_max_tokens from config.yml
+    max_tokens = None
+    # whether a response labels several numbered items (IndexedLabelParser) rather than one text
+    indexed = False
+
+    def __init__(self, name, labels, aliases=None, values=None, failure_value=0):
+        """
+        :param name: Name of the label set, usually the classification type.
+        :param labels: Canonical labels, the values structured outputs are constrained to.
+        :param aliases: Dictionary mapping other spellings to a canonical label.
+        :param values: Dictionary mapping canonical labels to numeric predictions.
+        :param failure_value: Numeric prediction of responses that contain no label.
+        """
+        self.name = name
+        self.labels = list(labels)
+        self.values = values or {}
+        self.failure_value = failure_value
+        self.lookup = {label.lower(): label for label in self.labels}
+        self.lookup.update({alias.lower(): label for alias, label in (aliases or {}).items()})
+        # longest spellings first so 'non biased' wins over 'biased' at the same position
+        words = sorted(self.lookup, key=len, reverse=True)
+        self.pattern = re.compile(r'\b(?:' + '|'.join(re.escape(word) for word in words) + r')\b', re.IGNORECASE)
+
+    def parse(self, response):
+        """
+        :return: The canonical label of response, or None if it contains none.
+        """
+        if not response:
+            return None
+        stripped = response.strip()
+        if stripped.startswith('{'):
+            try:
+                stripped = str(json.loads(stripped).get('label', ''))
+            except (ValueError, AttributeError):
+                pass
+        label = self.lookup.get(stripped.strip(' ."\'').lower())
+        if label is not None:
+            return label
+        match = self.pattern.search(stripped)
+        return self.lookup[match.group(0).lower()] if match else None
+
+    def parse_many(self, responses):
+        """
+        Parse a list of responses, identical responses (common at low temperature) are parsed once.
+        """
+        parsed = {}
+        labels = []
+        for response in responses:
+            if response not in parsed:
+                parsed[response] = self.parse(response)
+            labels.append(parsed[response])
+        return labels
+
+    def to_values(self, labels):
+        """
+        Convert parsed labels to numeric predictions.
+
+        :return: Tuple of (values, number of parse failures).
+        """
+        values = [self.failure_value if label is None else self.values[label] for label in labels]
+        return values, sum(label is None for label in labels)
+
+    def json_schema(self):
+        """
+        JSON schema of a structured response, an object with a single enum-constrained 'label'.
+        """
+        return {
+            'type': 'object',
+            'properties': {'label': {'type': 'string', 'enum': self.labels}},
+            'required': ['label'],
+            'additionalProperties': False
+        }
+
+
+class IndexedLabelParser:
+    """
+    Parses responses labelling a numbered list of items (the sentences of one request), the
+    structured form is {"labels": [{"index": <item number>, "label": <label>}, ...]}. Free-text
+    responses are read line by line as '[<item number>] <label>'.
+    """
+    indexed = True
+    # a JSON entry per item, '{"index": 12, "label": "nonbiased"}, '
+    tokens_per_item = 16
+    line_pattern = re.compile(r'^\W*(\d+)\W+(.+)$')
+
+    def __init__(self, parser, max_items):
+        """
+        :param parser: LabelParser of the individual labels.
+        :param max_items: Largest number of items in one request, sizes the output token budget.
+        """
+        self.parser = parser
+        self.name = f'{parser.name}_indexed'
+        self.labels = parser.labels
+        self.max_tokens = self.tokens_per_item * max_items + structured_max_tokens()
+
+    def parse(self, response, size):
+        """
+        :return: List of the canonical labels of items 1 to size, None for items without one.
+        """
+        labels = [None] * size
+        if not response:
+            return labels
+        for index, label in self.entries(response):
+            if isinstance(index, int) and 1 <= index <= size and labels[index - 1] is None:
+                labels[index - 1] = self.parser.parse(str(label))
+        return labels
+
+    def entries(self, response):
+        stripped = response.strip()
+        if stripped.startswith(('{', '[')):
+            try:
+                data = json.loads(stripped)
+                if isinstance(data, dict):
+                    data = data.get('labels', [])
+                return [(entry.get('index'), entry.get('label')) for entry in data if isinstance(entry, dict)]
+            except (ValueError, AttributeError):
+                pass
+        entries = []
+        for line in stripped.splitlines():
+            match = self.line_pattern.match(line)
+            if match:
+                entries.append((int(match.group(1)), match.group(2)))
+        return entries
+
+    def to_values(self, labels):
+        return self.parser.to_values(labels)
+
+    def json_schema(self):
+        return {
+            'type': 'object',
+            'properties': {
+                'labels': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {
+                            'index': {'type': 'integer'},
+                            'label': {'type': 'string', 'enum': self.labels}
+                        },
+                        'required': ['index', 'label'],
+                        'additionalProperties': False
+                    }
+                }
+            },
+            'required': ['labels'],
+            'additionalProperties': False
+        }
+
+
+def format_numbered(items):
+    """
+    The items of an indexed request as lines '[<item number>] <item>', numbered from 1.
+    """
+    return '\n'.join(f'[{number}] {item}' for number, item in enumerate(items, start=1))
+
+
+_parsers = {}
+_parsers_lock = threading.Lock()
+
+
+def register_parser(parser):
+    with _parsers_lock:
+        _parsers[parser.name] = parser
+
+
+def get_parser(classification_type='binary'):
+    """
+    Return the parser of a classification type, built once from its label_sets entry in config.yml.
+    """
+    with _parsers_lock:
+        if classification_type not in _parsers:
+            label_set = (config.get('label_sets') or {}).get(classification_type)
+            if label_set is None:
+                raise ValueError(f"No label set configured for classification type {classification_type}")
+            conversions = config['experiment_setup']['conversions']['binary2num']
+            aliases = label_set.get('aliases') or {}
+            # aliases may map onto labels outside the structured enum, those are scored too
+            scored = set(label_set['labels']) | set(aliases.values())
+            _parsers[classification_type] = LabelParser(
+                classification_type,
+                label_set['labels'],
+                aliases=aliases,
+                values=label_set.get('values') or {label: conversions[label] for label in scored},
+                failure_value=conversions.get('none', 0)
+            )
+        return _parsers[classification_type]
+
+
+def structured_output_enabled(params):
+    """
+    Whether an experiment asks providers for enum-constrained structured responses, experiments
+    without a structured_output parameter follow the parsing section of config.yml.
+    """
+    enabled = params.get('structured_output')
+    if enabled is None:
+        enabled = (config.get('parsing') or {}).get('structured_output', False)
+    return enabled
+
+
+def structured_max_tokens():
+    return (config.get('parsing') or {}).get('structured_max_tokens', 32)
+
+
+def log_parse_failures(experiment_name, model_name, failures, total):
+    if failures:
+        logging.warning(f"{failures} of {total} responses of {experiment_name} ({model_name}) contained no label")
+
+
+# vocabulary of the original extract_single_word, the union of the binary and multiclass labels
+LEGACY_PARSER = LabelParser(
+    'legacy',
+    ['biased', 'nonbiased', 'center', 'left', 'right'],
+    aliases={'non-biased': 'nonbiased', 'non biased': 'nonbiased', 'conservative': 'right', 'liberal': 'left'}
+)
@@ -0,0 +1,251 @@
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from helpers import config
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations instead of blocking, so the same bucket can be
+    used from worker threads and from asyncio code. The balance may go negative, in which case
+    the caller has to wait until the bucket has refilled its share.
+
+    :param initial_share: Share of the capacity available at the start, so a cold start cannot send
+                          a whole minute's quota at once.
+    """
+
+    def __init__(self, per_minute, initial_share=0.1):
+        self.per_minute = per_minute
+        self.capacity = per_minute
+        self.tokens = per_minute * initial_share
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self):
+        return self.per_minute / 60.0
+
+    def set_rate(self, per_minute, now):
+        self.refill(now)
+        self.per_minute = per_minute
+        self.capacity = per_minute
+        self.tokens = min(self.tokens, self.capacity)
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """
+        Take amount tokens from the bucket and return how long the caller must wait before using them.
+        """
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class AdaptiveRateLimiter:
+    """
+    Process-wide requests-per-minute / tokens-per-minute limiter for a single provider.
+
+    The configured quota is the starting point; 429 responses halve the effective rate and pause
+    all callers for the Retry-After period, successful calls slowly restore it, and provider
+    rate-limit headers replace the configured limits with the ones the provider reports. A burst
+    of 429s for the same overload halves the rate once: 429s of requests sent before the last cut,
+    or within cut_interval seconds of it, only pause.
+    """
+
+    def __init__(self, name, requests_per_minute, tokens_per_minute=None, min_factor=0.1, recovery_step=0.05,
+                 recovery_every=20, cut_interval=1.0):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.min_factor = min_factor
+        self.recovery_step = recovery_step
+        self.recovery_every = recovery_every
+        self.cut_interval = cut_interval
+
+        self.factor = 1.0
+        self.paused_until = 0.0
+        self.last_cut = float('-inf')
+        self._successes = 0
+        self._lock = threading.Lock()
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def _apply_factor(self, now):
+        self._requests.set_rate(self.requests_per_minute * self.factor, now)
+        if self._tokens is not None:
+            self._tokens.set_rate(self.tokens_per_minute * self.factor, now)
+
+    def reserve(self, tokens=0):
+        """
+        Reserve capacity for one request using roughly `tokens` tokens.
+
+        :return: Number of seconds the caller has to wait before sending the request.
+        """
+        with self._lock:
+            now = time.monotonic()
+            delay = self._requests.reserve(1, now)
+            if self._tokens is not None and tokens:
+                delay = max(delay, self._tokens.reserve(tokens, now))
+            return max(delay, self.paused_until - now)
+
+    def acquire(self, tokens=0):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def on_success(self):
+        with self._lock:
+            if self.factor >= 1.0:
+                return
+            self._successes += 1
+            if self._successes % self.recovery_every == 0:
+                self.factor = min(1.0, self.factor + self.recovery_step)
+                self._apply_factor(time.monotonic())
+
+    def on_rate_limited(self, retry_after=None, sent_at=None):
+        """
+        :param sent_at: time.monotonic() when the rate-limited request was sent, requests sent before
+                        the last cut don't cut the rate again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if (sent_at is not None and sent_at < self.last_cut) or now - self.last_cut < self.cut_interval:
+                return
+            self.factor = max(self.min_factor, self.factor / 2)
+            self.last_cut = now
+            self._successes = 0
+            self._apply_factor(now)
+        logging.warning(f"Rate limited by {self.name}, throttling to {self.factor:.0%} of quota"
+                        + (f" and pausing for {retry_after:.1f}s" if retry_after else ''))
+
+    def update_from_headers(self, headers):
+        """
+        Adopt the limits reported by the provider and pause when the remaining quota is exhausted.
+        Understands the OpenAI (x-ratelimit-*) and Anthropic (anthropic-ratelimit-*) header formats.
+        """
+        if not headers:
+            return
+        limits = parse_rate_limit_headers(headers)
+        with self._lock:
+            now = time.monotonic()
+            changed = False
+            if limits.get('requests_limit') and limits['requests_limit'] != self.requests_per_minute:
+                self.requests_per_minute = limits['requests_limit']
+                changed = True
+            if limits.get('tokens_limit') and self.tokens_per_minute and limits['tokens_limit'] != self.tokens_per_minute:
+                self.tokens_per_minute = limits['tokens_limit']
+                changed = True
+            if changed:
+                self._apply_factor(now)
+            for kind in ('requests', 'tokens'):
+                if limits.get(f'{kind}_remaining') == 0 and limits.get(f'{kind}_reset'):
+                    self.paused_until = max(self.paused_until, now + limits[f'{kind}_reset'])
+
+
+_DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_reset(value):
+    """
+    Parse a reset/retry value into seconds. Accepts plain seconds ('2.5'), OpenAI durations
+    ('6m0s', '120ms'), RFC 3339 timestamps (Anthropic) and HTTP dates.
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    matches = _DURATION_PATTERN.findall(value)
+    if matches and ''.join(n + u for n, u in matches) == value:
+        return sum(float(n) * _DURATION_UNITS[u] for n, u in matches)
+    for parse in (lambda v: datetime.fromisoformat(v.replace('Z', '+00:00')), parsedate_to_datetime):
+        try:
+            moment = parse(value)
+            return max(0.0, (moment - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def _int_header(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_rate_limit_headers(headers):
+    limits = {}
+    for prefix in ('x-ratelimit-{field}-{kind}', 'anthropic-ratelimit-{kind}-{field}'):
+        for kind in ('requests', 'tokens'):
+            limit = _int_header(headers, prefix.format(field='limit', kind=kind))
+            remaining = _int_header(headers, prefix.format(field='remaining', kind=kind))
+            reset = parse_reset(headers.get(prefix.format(field='reset', kind=kind)))
+            if limit is not None:
+                limits[f'{kind}_limit'] = limit
+            if remaining is not None:
+                limits[f'{kind}_remaining'] = remaining
+            if reset is not None:
+                limits[f'{kind}_reset'] = reset
+    return limits
+
+
+def error_status(error):
+    """
+    HTTP status of a provider SDK error, None for errors without one.
+    """
+    status = getattr(error, 'status_code', None) or getattr(error, 'code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    # gRPC errors carry a StatusCode enum as code
+    return status if isinstance(status, int) else None
+
+
+def is_rate_limit_error(error):
+    return error_status(error) == 429 or type(error).__name__ in ('RateLimitError', 'ResourceExhausted')
+
+
+def retry_after_from_error(error):
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    return parse_reset(headers.get('retry-after'))
+
+
+def estimate_tokens(*texts, max_tokens=None):
+    """
+    Rough token count (4 characters per token) used to reserve tokens-per-minute capacity.
+    """
+    return sum(len(t) for t in texts if t) // 4 + (max_tokens or 16)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider):
+    """
+    Return the limiter shared by every thread calling `provider` (a model's product_name).
+    Providers without an entry in the rate_limits section of config.yml are not throttled.
+    """
+    with _limiters_lock:
+        if provider not in _limiters:
+            limits = (config.get('rate_limits') or {}).get(provider)
+            _limiters[provider] = AdaptiveRateLimiter(
+                provider,
+                requests_per_minute=limits['requests_per_minute'],
+                tokens_per_minute=limits.get('tokens_per_minute'),
+                cut_interval=limits.get('cut_interval', 1.0)
+            ) if limits else None
+        return _limiters[provider]
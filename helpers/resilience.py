@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from helpers import config
+from helpers.rate_limiting import error_status, is_rate_limit_error
+
+# HTTP statuses worth retrying: timeouts, conflicts, 429s and server errors (529 is Anthropic's "overloaded")
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+# SDK errors without a status code raised on connection failures and timeouts
+RETRYABLE_ERRORS = {'APIConnectionError', 'APITimeoutError', 'ConnectError', 'ConnectTimeout', 'ReadTimeout',
+                    'ReadError', 'RemoteProtocolError', 'ServiceUnavailable', 'DeadlineExceeded',
+                    'InternalServerError', 'ResourceExhausted'}
+# longest single sleep while waiting for an open circuit, so waiters notice a successful probe quickly
+POLL_INTERVAL = 1.0
+
+
+class RequestFailed(Exception):
+    """
+    A provider call that failed for good: retries exhausted, a non-retryable API error, or an open
+    circuit. The item it was for is marked as failed instead of being scored.
+    """
+
+
+class CircuitOpenError(RequestFailed):
+    pass
+
+
+def resilience_settings(provider=None):
+    """
+    The resilience section of config.yml with the overrides under providers.<provider> applied.
+    """
+    settings = dict(config.get('resilience') or {})
+    overrides = (settings.pop('providers', None) or {}).get(provider) or {}
+    return {**settings, **overrides}
+
+
+def is_retryable_error(error):
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)) or is_rate_limit_error(error):
+        return True
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES or status >= 500
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+
+def is_api_error(error):
+    """
+    Whether error is an error answer of the provider (e.g. a 400 for a rejected text), failing the
+    item, rather than a bug in the calling code, which should fail the experiment.
+    """
+    return is_retryable_error(error) or error_status(error) is not None
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0, rng=random):
+    """
+    Exponential backoff with full jitter: a random delay up to base * 2 ** attempt, at most cap seconds.
+    """
+    return rng.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Per-provider circuit breaker shared by every thread and event loop calling the provider.
+
+    After failure_threshold consecutive failed calls (timeouts, connection and server errors, not
+    429s) the circuit opens: the provider's scheduler queue pauses and calls wait until reset_timeout
+    has passed. Then a single probe call is let through, closing the circuit on success and opening
+    it again for twice as long (up to max_reset_timeout) on failure. Once a provider has been down for
+    give_up_after seconds, calls made while the circuit is open fail at once, so the remaining items
+    are marked as failed instead of waiting out the outage. Probes continue, and a successful one
+    closes the circuit again.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, max_reset_timeout=300, give_up_after=1800):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.give_up_after = give_up_after
+
+        self.failures = 0
+        self.reset_timeout = reset_timeout
+        self.opened_at = None
+        self.open_until = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def _given_up(self, now):
+        return self.give_up_after is not None and now - self.opened_at >= self.give_up_after
+
+    def remaining(self):
+        """
+        Seconds the provider's queue should stay paused, 0 while the circuit is closed or once the
+        provider has been given up on.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not self.is_open or self._given_up(now):
+                return 0.0
+            return max(0.0, self.open_until - now)
+
+    def before_call(self):
+        """
+        Check the circuit before a call.
+
+        :return: Seconds the caller has to wait before checking again, 0 when it may call now.
+        :raises CircuitOpenError: When the circuit is open and the provider has been given up on.
+        """
+        with self._lock:
+            if not self.is_open:
+                return 0.0
+            now = time.monotonic()
+            if now >= self.open_until:
+                # half open, this call is the probe and everybody else keeps waiting for its outcome
+                self.open_until = now + self.reset_timeout
+                self.probing = True
+                return 0.0
+            if self._given_up(now):
+                raise CircuitOpenError(f"Circuit of {self.name} open for {now - self.opened_at:.0f}s")
+            return self.open_until - now
+
+    def on_success(self):
+        with self._lock:
+            closed = self.is_open
+            self.failures = 0
+            self.opened_at = None
+            self.open_until = 0.0
+            self.probing = False
+            self.reset_timeout = self.base_reset_timeout
+        if closed:
+            logging.warning(f"Circuit of {self.name} closed, resuming requests")
+
+    def on_failure(self):
+        with self._lock:
+            now = time.monotonic()
+            self.failures += 1
+            if self.is_open:
+                if not self.probing:
+                    # a call already in flight when the circuit opened
+                    return
+                self.probing = False
+                self.reset_timeout = min(self.max_reset_timeout, self.reset_timeout * 2)
+            elif self.failures < self.failure_threshold:
+                return
+            else:
+                self.opened_at = now
+            self.open_until = now + self.reset_timeout
+            timeout = self.reset_timeout
+        logging.warning(f"Circuit of {self.name} open after {self.failures} consecutive failures, "
+                        f"pausing requests for {timeout:.0f}s")
+
+    def wait(self):
+        while (delay := self.before_call()) > 0:
+            time.sleep(min(delay, POLL_INTERVAL))
+
+    async def await_closed(self):
+        while (delay := self.before_call()) > 0:
+            await asyncio.sleep(min(delay, POLL_INTERVAL))
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(provider):
+    """
+    Return the circuit breaker shared by every caller of `provider` (a model's product_name).
+    """
+    with _breakers_lock:
+        if provider not in _breakers:
+            settings = resilience_settings(provider)
+            _breakers[provider] = CircuitBreaker(
+                provider,
+                failure_threshold=settings.get('failure_threshold', 5),
+                reset_timeout=settings.get('reset_timeout', 30),
+                max_reset_timeout=settings.get('max_reset_timeout', 300),
+                give_up_after=settings.get('give_up_after', 1800)
+            )
+        return _breakers[provider]
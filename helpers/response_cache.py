@@ -0,0 +1,216 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from helpers import config
+
+
+class ResponseCache:
+    """
+    On-disk, content-addressed cache of raw model responses.
+
+    Entries are keyed by a hash of the full request (provider, model, prompt, text and
+    generation parameters), so identical requests coming from reruns or from overlapping
+    experiment grids are only ever sent once. Concurrent identical requests from different
+    worker threads are merged into a single provider call.
+    """
+
+    def __init__(self, path, max_entries=None, max_age_days=None, deterministic_only=False, evict_every=1000):
+        """
+        :param path: Path of the SQLite database file.
+        :param max_entries: Maximum number of cached responses, least recently used entries are evicted first.
+        :param max_age_days: Entries older than this many days are treated as misses and evicted.
+        :param deterministic_only: Only cache calls made with temperature 0.
+        :param evict_every: Run eviction after this many insertions.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.deterministic_only = deterministic_only
+        self.evict_every = evict_every
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._db_lock = threading.Lock()
+        self._in_flight_lock = threading.Lock()
+        self._in_flight = {}
+        self._puts = 0
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        with self._db_lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, accessed REAL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.evict()
+
+    @staticmethod
+    def make_key(**request):
+        """
+        Hash the full request description into a cache key.
+        """
+        payload = json.dumps(request, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def cacheable(self, temperature):
+        return not self.deterministic_only or not temperature
+
+    def get(self, key):
+        now = time.time()
+        with self._db_lock:
+            row = self._conn.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            response, created = row
+            if self.max_age is not None and now - created > self.max_age:
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                return None
+            self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        return response
+
+    def put(self, key, model, response):
+        now = time.time()
+        with self._db_lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, model, response, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, model, response, now, now)
+            )
+            self._puts += 1
+            evict = self._puts % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop expired entries and trim the cache down to max_entries (least recently used first).
+        """
+        with self._db_lock:
+            if self.max_age is not None:
+                self._conn.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.max_age,))
+            if self.max_entries:
+                self._conn.execute(
+                    'DELETE FROM responses WHERE key IN ('
+                    'SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)
+                )
+
+    def get_or_compute(self, key, model, compute, cacheable=True):
+        """
+        Return the cached response for key, computing and storing it on a miss.
+
+        If another thread is already computing the same key, wait for its result instead of
+        issuing a second identical call.
+
+        :return: Tuple of (response, hit) where hit is True when no new call was made.
+        """
+        if not cacheable:
+            return compute(), False
+
+        response = self.get(key)
+        if response is not None:
+            return response, True
+
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not owner:
+            return future.result(), True
+
+        try:
+            # Another thread may have stored the response between our lookup and registration
+            response = self.get(key)
+            hit = response is not None
+            if not hit:
+                response = compute()
+                # Empty responses are provider failures, never cache them
+                if response:
+                    self.put(key, model, response)
+            future.set_result(response)
+            return response, hit
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.pop(key, None)
+
+    async def aget_or_compute(self, key, model, acompute, cacheable=True):
+        """
+        Async counterpart of get_or_compute, `acompute` is a coroutine function. In-flight requests
+        are merged with those of other event loops and worker threads.
+        """
+        if not cacheable:
+            return await acompute(), False
+
+        response = self.get(key)
+        if response is not None:
+            return response, True
+
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not owner:
+            return await asyncio.wrap_future(future), True
+
+        try:
+            response = self.get(key)
+            hit = response is not None
+            if not hit:
+                response = await acompute()
+                if response:
+                    self.put(key, model, response)
+            future.set_result(response)
+            return response, hit
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.pop(key, None)
+
+    def close(self):
+        with self._db_lock:
+            self._conn.close()
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Return the process-wide response cache configured in config.yml, or None if caching is disabled.
+    """
+    global _response_cache
+    cache_config = config.get('response_cache') or {}
+    if not cache_config.get('enabled', False):
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(
+                path=cache_config.get('path', '.cache/responses.sqlite'),
+                max_entries=cache_config.get('max_entries'),
+                max_age_days=cache_config.get('max_age_days'),
+                deterministic_only=cache_config.get('deterministic_only', False)
+            )
+            logging.info(f"Response cache opened at {_response_cache.path}")
+    return _response_cache
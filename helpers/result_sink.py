@@ -0,0 +1,295 @@
+import atexit
+import csv
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+from helpers import config
+from helpers.telemetry import timed
+
+_FLUSH = object()
+_CLOSE = object()
+
+
+class CsvWriter:
+    """
+    Appends to the CSV file of every destination. A file whose header doesn't match the columns,
+    e.g. one written before a column was added, is moved aside rather than appended to.
+    """
+
+    def __init__(self):
+        self.checked = set()
+
+    def check_header(self, destination, columns):
+        if destination in self.checked:
+            return
+        self.checked.add(destination)
+        if not os.path.exists(destination):
+            return
+        with open(destination, newline='') as f:
+            header = next(csv.reader(f), None)
+        if header is not None and header != list(columns):
+            stem, extension = os.path.splitext(destination)
+            rotated = f"{stem}_{time.strftime('%Y%m%d_%H%M%S')}{extension}"
+            os.replace(destination, rotated)
+            logging.warning(f"{destination} has different columns, moved it to {rotated} and starting a new file")
+
+    def write(self, destination, columns, rows):
+        directory = os.path.dirname(destination)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.check_header(destination, columns)
+        new_file = not os.path.exists(destination)
+        with open(destination, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(columns)
+            writer.writerows([row.get(column) for column in columns] for row in rows)
+
+    def close(self):
+        pass
+
+
+class ParquetWriter:
+    """
+    Keeps one open Parquet writer per destination, every flush appends a row group.
+    """
+
+    def __init__(self):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.writers = {}
+
+    def write(self, destination, columns, rows):
+        destination = os.path.splitext(destination)[0] + '.parquet'
+        table = self.pa.Table.from_pylist(
+            [{column: None if row.get(column) is None else str(row.get(column)) for column in columns}
+             for row in rows],
+            schema=self.pa.schema([(column, self.pa.string()) for column in columns])
+        )
+        if destination not in self.writers:
+            directory = os.path.dirname(destination)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.writers[destination] = self.pq.ParquetWriter(destination, table.schema)
+        self.writers[destination].write_table(table)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+
+class SqliteWriter:
+    """
+    Writes every destination into a table of one SQLite database, named after the destination path.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.tables = set()
+
+    @staticmethod
+    def table_name(destination):
+        return re.sub(r'\W', '_', os.path.splitext(destination)[0])
+
+    def write(self, destination, columns, rows):
+        table = self.table_name(destination)
+        quoted = ', '.join(f'"{column}"' for column in columns)
+        if table not in self.tables:
+            self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({quoted})')
+            self.tables.add(table)
+        placeholders = ', '.join('?' for _ in columns)
+        with self.conn:
+            self.conn.executemany(
+                f'INSERT INTO "{table}" ({quoted}) VALUES ({placeholders})',
+                [[None if row.get(column) is None else
+                  row.get(column) if isinstance(row.get(column), (int, float, str)) else str(row.get(column))
+                  for column in columns] for row in rows]
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+class StoreWriter:
+    """
+    Writes individual results into the normalized ResultStore, other destinations (overall results)
+    become plain tables of the same database.
+    """
+
+    def __init__(self, path):
+        from helpers.result_store import ResultStore
+        self.store = ResultStore(path)
+        self.tables = SqliteWriter(path)
+
+    def write(self, destination, columns, rows):
+        if 'Text' in columns and 'Prompt' in columns:
+            self.store.add(rows)
+        else:
+            self.tables.write(destination, columns, rows)
+
+    def close(self):
+        self.tables.close()
+        self.store.close()
+
+
+class ResultSink:
+    """
+    Thread-safe, buffered result writer.
+
+    Producers hand rows to a bounded queue and return immediately; a single background thread
+    groups them per destination and writes them in batches once a buffer reaches `buffer_rows` or
+    `flush_interval` seconds have passed. Since only that thread touches the files, rows from
+    concurrent experiments can't interleave.
+    """
+
+    def __init__(self, format='csv', buffer_rows=1000, flush_interval=5.0, queue_size=10000,
+                 sqlite_path='results.sqlite', store_path='results_store.sqlite'):
+        """
+        :param format: 'csv', 'parquet', 'sqlite' or 'store'.
+        :param buffer_rows: Rows buffered per destination before it is written.
+        :param flush_interval: Maximum seconds rows stay buffered.
+        :param queue_size: Maximum number of pending writes, producers block when it is full.
+        :param sqlite_path: Database file for the sqlite format.
+        :param store_path: Database file for the normalized store format.
+        """
+        self.format = format
+        self.buffer_rows = buffer_rows
+        self.flush_interval = flush_interval
+        self.sqlite_path = sqlite_path
+        self.store_path = store_path
+        self.errors = []
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._buffers = {}
+        self._columns = {}
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='result-sink', daemon=True)
+        self._thread.start()
+
+    def _create_writer(self):
+        if self.format == 'csv':
+            return CsvWriter()
+        if self.format == 'parquet':
+            return ParquetWriter()
+        if self.format == 'sqlite':
+            return SqliteWriter(self.sqlite_path)
+        if self.format == 'store':
+            return StoreWriter(self.store_path)
+        raise ValueError(f"Unknown result format: {self.format}")
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def write(self, destination, rows, columns=None):
+        """
+        Queue rows (dictionaries) for destination, a CSV path that other formats derive their target from.
+
+        :param columns: Column order, defaults to the keys of the first row written to destination.
+        """
+        if self._closed:
+            raise RuntimeError('ResultSink is closed')
+        rows = list(rows)
+        if rows:
+            self._queue.put((destination, rows, columns))
+
+    def flush(self):
+        """
+        Block until everything queued so far has been written.
+        """
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put((_FLUSH, done, None))
+        done.wait()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put((_CLOSE, None, None))
+        self._thread.join()
+
+    def _write_buffers(self, writer, destinations=None):
+        for destination in list(destinations if destinations is not None else self._buffers):
+            rows = self._buffers.pop(destination, None)
+            if not rows:
+                continue
+            try:
+                with timed('result_write_seconds', format=self.format):
+                    writer.write(destination, self._columns[destination], rows)
+            except Exception as e:
+                logging.error(f"Failed to write {len(rows)} results to {destination}: {e}")
+                self.errors.append(e)
+
+    def _run(self):
+        try:
+            writer = self._create_writer()
+        except Exception as e:
+            logging.error(f"Cannot write {self.format} results ({e}), falling back to csv")
+            writer = CsvWriter()
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                destination, rows, columns = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                destination = None
+
+            if destination is _FLUSH or destination is _CLOSE:
+                self._write_buffers(writer)
+                last_flush = time.monotonic()
+                if destination is _CLOSE:
+                    writer.close()
+                    return
+                # for flushes the rows slot carries the event the caller waits on
+                rows.set()
+                continue
+
+            if destination is not None:
+                if destination not in self._columns:
+                    self._columns[destination] = list(columns or rows[0].keys())
+                self._buffers.setdefault(destination, []).extend(rows)
+                if len(self._buffers[destination]) >= self.buffer_rows:
+                    self._write_buffers(writer, [destination])
+
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self._write_buffers(writer)
+                last_flush = time.monotonic()
+
+
+_result_sink = None
+_result_sink_lock = threading.Lock()
+
+
+def get_result_sink():
+    """
+    Return the process-wide result sink configured in the result_sink section of config.yml.
+    It is flushed and closed when the interpreter exits, a sink closed earlier is replaced by a new one.
+    """
+    global _result_sink
+    with _result_sink_lock:
+        if _result_sink is None or _result_sink.closed:
+            sink_config = config.get('result_sink') or {}
+            _result_sink = ResultSink(
+                format=sink_config.get('format', 'csv'),
+                buffer_rows=sink_config.get('buffer_rows', 1000),
+                flush_interval=sink_config.get('flush_interval', 5),
+                queue_size=sink_config.get('queue_size', 10000),
+                sqlite_path=sink_config.get('sqlite_path', 'results.sqlite'),
+                store_path=sink_config.get('store_path', 'results_store.sqlite')
+            )
+            atexit.register(_result_sink.close)
+        return _result_sink
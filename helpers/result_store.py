@@ -0,0 +1,175 @@
+import argparse
+import csv
+import gzip
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+
+from helpers import config
+
+# individual result fields stored on every prediction row, Text and Prompt are stored by reference
+PREDICTION_FIELDS = [
+    ('Experiment', 'experiment'), ('Run', 'run'), ('Model', 'model'), ('Prompt_Type', 'prompt_type'),
+    ('Prompt_Role', 'prompt_role'), ('FineTuned', 'fine_tuned'), ('Prediction', 'prediction'), ('Failed', 'failed'),
+    ('Ground_Truth', 'ground_truth'), ('Timestamp', 'timestamp'), ('Detection_Type', 'detection_type'),
+    ('Classification_Type', 'classification_type')
+]
+
+
+def content_id(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class ResultStore:
+    """
+    Normalized store of individual results.
+
+    Article texts and prompts are stored once in their own tables keyed by content hash, and each
+    prediction row only references them by id, instead of repeating the full text and prompt on
+    every row of every run, model and experiment.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._known = {'texts': set(), 'prompts': set()}
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS texts (id TEXT PRIMARY KEY, text TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS prompts (id TEXT PRIMARY KEY, prompt TEXT)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS predictions (experiment TEXT, run INTEGER, model TEXT, prompt_type TEXT, '
+                'prompt_role TEXT, prompt_id TEXT, text_id TEXT, fine_tuned INTEGER, prediction INTEGER, '
+                'failed INTEGER, ground_truth INTEGER, timestamp TEXT, detection_type TEXT, classification_type TEXT)'
+            )
+            columns = {row[1] for row in self.conn.execute('PRAGMA table_info(predictions)')}
+            if 'failed' not in columns:
+                # stores created before failed requests were flagged, their rows keep a NULL flag
+                self.conn.execute('ALTER TABLE predictions ADD COLUMN failed INTEGER')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS predictions_experiment ON predictions (experiment, model)')
+
+    def _reference(self, table, column, content):
+        """
+        Return the id of content, inserting it into table the first time it is seen.
+        """
+        key = content_id(content)
+        if key not in self._known[table]:
+            self.conn.execute(f'INSERT OR IGNORE INTO {table} (id, {column}) VALUES (?, ?)', (key, content))
+            self._known[table].add(key)
+        return key
+
+    def _row(self, entry, now):
+        row = {column: entry.get(field) for field, column in PREDICTION_FIELDS}
+        row['timestamp'] = str(row['timestamp'] or now)
+        row['fine_tuned'] = int(str(row['fine_tuned']).lower() in ('true', '1'))
+        # entries of CSV files written before failed requests were flagged have no Failed column
+        if row['failed'] not in (None, ''):
+            row['failed'] = int(str(row['failed']).lower() in ('true', '1'))
+        else:
+            row['failed'] = None
+        row['prompt_id'] = self._reference('prompts', 'prompt', str(entry.get('Prompt') or ''))
+        row['text_id'] = self._reference('texts', 'text', str(entry.get('Text') or ''))
+        return row
+
+    def add(self, entries):
+        """
+        Store individual result entries, dictionaries with the individual_return_file_columns keys.
+        """
+        now = datetime.now().isoformat(sep=' ')
+        with self._lock:
+            try:
+                with self.conn:
+                    rows = [self._row(entry, now) for entry in entries]
+                    if rows:
+                        columns = list(rows[0])
+                        placeholders = ', '.join('?' for _ in columns)
+                        self.conn.executemany(
+                            f'INSERT INTO predictions ({", ".join(columns)}) VALUES ({placeholders})',
+                            [[row[column] for column in columns] for row in rows]
+                        )
+            except BaseException:
+                # texts and prompts inserted by the rolled back transaction have to be inserted again
+                self._known = {table: set() for table in self._known}
+                raise
+        return len(entries)
+
+    def predictions(self, experiment=None, with_content=False):
+        """
+        Read prediction rows back as dictionaries, joined with their text and prompt if with_content.
+        """
+        query = 'SELECT p.*' + (', t.text, q.prompt' if with_content else '') + ' FROM predictions p'
+        if with_content:
+            query += ' JOIN texts t ON t.id = p.text_id JOIN prompts q ON q.id = p.prompt_id'
+        params = ()
+        if experiment is not None:
+            query += ' WHERE p.experiment = ?'
+            params = (experiment,)
+        with self._lock:
+            cursor = self.conn.execute(query, params)
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def export(self, directory):
+        """
+        Export the texts, prompts and predictions tables as gzip-compressed CSV files.
+
+        :return: List of written file paths.
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        with self._lock:
+            for table in ('texts', 'prompts', 'predictions'):
+                path = os.path.join(directory, f'{table}.csv.gz')
+                cursor = self.conn.execute(f'SELECT * FROM {table}')
+                with gzip.open(path, 'wt', newline='') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(d[0] for d in cursor.description)
+                    writer.writerows(cursor)
+                paths.append(path)
+        return paths
+
+    def import_individual_results(self, directory=None):
+        """
+        Import the CSV files written to individual_results/ by the CSV result format.
+
+        :return: Number of imported rows.
+        """
+        directory = directory or config['return_files']['individual_results_dir']
+        csv.field_size_limit(sys.maxsize)
+        imported = 0
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for file in sorted(files):
+                if not file.endswith('.csv'):
+                    continue
+                with open(os.path.join(root, file), 'r', newline='') as f:
+                    imported += self.add(list(csv.DictReader(f)))
+        logging.info(f"Imported {imported} individual results from {directory}")
+        return imported
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import individual results into, or export them from, the result store')
+    parser.add_argument('command', choices=['import', 'export'])
+    parser.add_argument('path', help='individual_results directory to import, or directory to export to')
+    parser.add_argument('--store', default=(config.get('result_sink') or {}).get('store_path', 'results_store.sqlite'))
+    args = parser.parse_args()
+
+    store = ResultStore(args.store)
+    if args.command == 'import':
+        print(f"Imported {store.import_individual_results(args.path)} rows into {args.store}")
+    else:
+        print('\n'.join(store.export(args.path)))
+    store.close()
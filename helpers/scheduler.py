@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from helpers import config
+from helpers.telemetry import get_telemetry, Progress, progress_enabled
+from helpers.resilience import get_circuit_breaker, POLL_INTERVAL
+
+
+class Job:
+    """
+    A unit of work for the scheduler, typically one experiment on one model.
+
+    :param name: Name used in progress logs.
+    :param provider: Provider whose queue and concurrency limit the requests go through.
+    :param requests: List of coroutine functions, each returning a dict of results keyed by e.g. (run, index).
+    :param finalize: Called with the merged results dict once every request has completed, its return
+                     value becomes the job's result.
+    :param extend: Optional, called with the merged results dict whenever the pending requests have
+                   completed, before finalize. The requests it returns are queued as well, so a job
+                   can decide from its results so far whether it needs more.
+    """
+
+    def __init__(self, name, provider, requests, finalize, extend=None):
+        self.name = name
+        self.provider = provider
+        # (time queued, request) pairs, the time is set when the scheduler queues the requests
+        self.pending = deque((None, request) for request in requests)
+        self.total = len(self.pending)
+        self.finalize = finalize
+        self.extend = extend
+        self.results = {}
+        self.outstanding = 0
+        self.completed = 0
+        self.error = None
+        self.result = None
+        self.finished = False
+
+    @property
+    def drained(self):
+        return not self.pending or self.error is not None
+
+
+class ProviderScheduler:
+    """
+    Runs the requests of many jobs with one queue per provider.
+
+    Each provider gets its own pool of workers sized by the concurrency section of config.yml, so
+    providers never wait on each other. Within a provider the workers take requests round-robin
+    from every job that still has work, so concurrent experiments share the provider's capacity
+    fairly instead of the first submitted experiment starving the rest. While a provider's circuit
+    breaker is open its workers pause, and the other providers keep running.
+    """
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency if concurrency is not None else (config.get('concurrency') or {})
+        self.jobs = []
+        self.on_complete = None
+        self.progress = None
+        self._queues = {}
+        # set whenever a provider queue gets new requests or a job finishes, wakes idle workers
+        self._changed = {}
+
+    def limit(self, provider):
+        return self.concurrency.get(provider, self.concurrency.get('default', 8))
+
+    def add(self, job):
+        self.jobs.append(job)
+        # requests wait in the provider queue from the moment the job is queued
+        now = time.perf_counter()
+        job.pending = deque((now, request) for _, request in job.pending)
+        self._queues.setdefault(job.provider, deque()).append(job)
+        return job
+
+    def _next_request(self, provider):
+        queue = self._queues[provider]
+        while queue:
+            job = queue.popleft()
+            if job.drained:
+                continue
+            queued_at, request = job.pending.popleft()
+            # rotate the job to the back so the next worker serves a different experiment
+            queue.append(job)
+            return job, queued_at, request
+        return None, None, None
+
+    def _unfinished(self, provider):
+        return any(not job.finished for job in self.jobs if job.provider == provider)
+
+    async def _drained(self, job):
+        # the job's requests so far have all completed: queue the ones it asks for next or finish it
+        if job.error is None and job.extend is not None:
+            try:
+                requests = await asyncio.to_thread(job.extend, job.results)
+            except Exception as e:
+                job.error = e
+                requests = None
+            if requests:
+                now = time.perf_counter()
+                job.pending.extend((now, request) for request in requests)
+                job.total += len(requests)
+                if self.progress is not None:
+                    self.progress.total += len(requests)
+                if job not in self._queues[job.provider]:
+                    self._queues[job.provider].append(job)
+                self._changed[job.provider].set()
+                return
+        await self._complete(job)
+
+    async def _complete(self, job):
+        job.finished = True
+        self._changed[job.provider].set()
+        if job.error is None:
+            try:
+                job.result = await asyncio.to_thread(job.finalize, job.results)
+            except Exception as e:
+                job.error = e
+        if job.error is not None:
+            logging.error(f"Job {job.name} failed: {job.error}")
+        if self.on_complete is not None:
+            await asyncio.to_thread(self.on_complete, job, job.error if job.error is not None else job.result)
+
+    async def _worker(self, provider):
+        breaker = get_circuit_breaker(provider)
+        while True:
+            while (pause := breaker.remaining()) > 0:
+                await asyncio.sleep(min(pause, POLL_INTERVAL))
+            job, queued_at, request = self._next_request(provider)
+            if job is None:
+                if not self._unfinished(provider):
+                    return
+                # a job still running its last requests may queue more
+                self._changed[provider].clear()
+                await self._changed[provider].wait()
+                continue
+            job.outstanding += 1
+            get_telemetry().observe('queue_wait_seconds', time.perf_counter() - queued_at, provider=provider)
+            try:
+                job.results.update(await request())
+            except Exception as e:
+                if job.error is None:
+                    job.error = e
+                    job.pending.clear()
+            finally:
+                job.outstanding -= 1
+                job.completed += 1
+            if job.error is None:
+                logging.info(f"Progression: {job.name} {job.completed} / {job.total}")
+            if self.progress is not None:
+                self.progress.advance()
+            if job.drained and job.outstanding == 0 and not job.finished:
+                await self._drained(job)
+
+    async def arun(self, on_complete=None):
+        """
+        Run every added job to completion.
+
+        :param on_complete: Optional callable invoked with (job, result) as soon as each job finishes.
+        :return: List of (job, result) tuples in submission order, result is the exception for failed jobs.
+        """
+        self.on_complete = on_complete
+        self._changed = {provider: asyncio.Event() for provider in self._queues}
+        if progress_enabled():
+            self.progress = Progress(sum(job.total for job in self.jobs))
+        for job in self.jobs:
+            if job.total == 0:
+                await self._drained(job)
+        await asyncio.gather(*(
+            self._worker(provider)
+            for provider in self._queues
+            for _ in range(self.limit(provider))
+        ))
+        if self.progress is not None:
+            self.progress.close()
+        return [(job, job.error if job.error is not None else job.result) for job in self.jobs]
+
+    def run(self, on_complete=None):
+        return asyncio.run(self.arun(on_complete))
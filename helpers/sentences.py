@@ -0,0 +1,91 @@
+import math
+
+import numpy as np
+
+from helpers import config
+from helpers.parsing import IndexedLabelParser, get_parser, format_numbered
+
+# appended to the experiment prompt of sentence-level experiments
+SENTENCE_INSTRUCTIONS = (
+    "The text is a numbered list of consecutive sentences from one news article. Classify every sentence "
+    "on its own, using the other listed sentences only as context, and answer with one label per sentence as a line "
+    "'[<sentence number>] <label>', or in the requested JSON format."
+)
+
+
+def sentences_per_request(params):
+    return params.get('sentences_per_request') or (config.get('sentences') or {}).get('per_request', 20)
+
+
+def sentence_prompt(prompt):
+    return prompt.rstrip() + '\n' + SENTENCE_INSTRUCTIONS
+
+
+def batch_sentences(articles, size):
+    """
+    Split the sentences of each article into requests of at most `size` sentences. Requests never
+    mix articles, and an article is split into near-equal parts rather than leaving a short tail.
+
+    :param articles: List of articles, each a list of sentences.
+    :return: List of (article index, index of the first sentence, number of sentences).
+    """
+    batches = []
+    for article, sentences in enumerate(articles):
+        parts = max(1, math.ceil(len(sentences) / size))
+        bounds = np.linspace(0, len(sentences), parts + 1).round().astype(int)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if end > start:
+                batches.append((article, int(start), int(end - start)))
+    return batches
+
+
+def sentence_params(articles, sentence_labels, phrases, size):
+    """
+    Parameters of a sentence-level experiment over `articles`: the request texts (numbered batches
+    of sentences) plus what finalize_experiment needs to score every sentence.
+
+    :param articles: List of articles, each a list of sentences.
+    :param sentence_labels: Ground truth of each sentence, one list per article.
+    :param phrases: Sentences of each annotated phrase, one list of sentence-index lists per article.
+    :param size: Maximum number of sentences per request.
+    """
+    batches = batch_sentences(articles, size)
+    # sentences are numbered across the whole dataset, in article order
+    offsets = np.cumsum([0] + [len(sentences) for sentences in articles])
+    return {
+        'texts': [format_numbered(articles[article][start:start + count]) for article, start, count in batches],
+        'sentence_batches': batches,
+        'sentences': [sentence for sentences in articles for sentence in sentences],
+        'ground_truths': [label for labels in sentence_labels for label in labels],
+        'phrase_sentences': [[int(offsets[article]) + index for index in phrase]
+                             for article, article_phrases in enumerate(phrases) for phrase in article_phrases],
+        'sentences_per_request': size,
+        'detection_type': 'sentence'
+    }
+
+
+def sentence_parser(params):
+    return IndexedLabelParser(get_parser(params.get('classification_type', 'binary')), sentences_per_request(params))
+
+
+def parse_sentence_batches(parser, batches, responses):
+    """
+    Labels of every sentence from the responses to its batches, None for sentences a response left out.
+    """
+    labels = []
+    for (_, _, count), response in zip(batches, responses):
+        labels.extend(parser.parse(response, count))
+    return labels
+
+
+def phrase_recall(predictions, phrase_sentences, positive=1):
+    """
+    Share of annotated phrases lying in a sentence predicted as biased, None without phrases.
+
+    :param predictions: Prediction of each sentence (the majority vote over runs).
+    :param phrase_sentences: Sentence indices of each phrase.
+    """
+    if not phrase_sentences:
+        return None
+    predictions = np.asarray(predictions)
+    return float(np.mean([bool(np.any(predictions[phrase] == positive)) for phrase in phrase_sentences]))
@@ -0,0 +1,101 @@
+import contextvars
+from contextlib import contextmanager
+
+from helpers import config
+from helpers.rate_limiting import estimate_tokens
+from helpers.telemetry import get_telemetry, current_labels, first_token, first_label
+from helpers.usage import record_usage
+
+# parser of the experiment the current request belongs to, free-text streams stop at its first label
+_parser = contextvars.ContextVar('stream_parser', default=None)
+
+
+def streaming_config():
+    return config.get('streaming') or {}
+
+
+def streaming_enabled(labels=None):
+    """
+    Whether a request is streamed. Structured responses are short and capped already, only
+    free-text responses are streamed.
+    """
+    return labels is None and streaming_config().get('enabled', False)
+
+
+@contextmanager
+def stream_labels(parser):
+    """
+    Stop the free-text streams of the requests made inside the block at the first label of `parser`.
+    """
+    token = _parser.set(parser if streaming_config().get('early_stop', True) else None)
+    try:
+        yield
+    finally:
+        _parser.reset(token)
+
+
+class LabelStream:
+    """
+    Collects a streamed response chunk by chunk and tells the wrapper when it can close the stream.
+
+    A label counts once the character after it has arrived, so that 'left' is not taken from
+    'leftist'. Responses that look like JSON are read to the end. The collected text runs up to
+    just past the first label, so parsing it later gives the same label as the full response would.
+    """
+
+    def __init__(self, stop=True):
+        """
+        :param stop: Whether to stop at the first label of the current experiment's parser
+                     (see stream_labels), otherwise the whole response is collected.
+        """
+        self.parser = _parser.get() if stop else None
+        self.parts = []
+        self.chunks = 0
+        self.label = None
+        self.stopped = False
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    def feed(self, chunk):
+        """
+        Add a chunk of text.
+
+        :return: True once the response contains a complete label and the stream can be closed.
+        """
+        if not chunk:
+            return False
+        first_token()
+        self.parts.append(chunk)
+        self.chunks += 1
+        if self.parser is None:
+            return False
+        text = self.text
+        stripped = text.lstrip()
+        if not stripped or stripped[0] in '{[':
+            return False
+        match = self.parser.pattern.search(text)
+        if match is None or match.end() >= len(text):
+            return False
+        self.label = self.parser.lookup[match.group(0).lower()]
+        self.stopped = True
+        first_label()
+        return True
+
+    def close(self, input_text, prompt, usage_recorded):
+        """
+        Record the stream's telemetry once it is done. Streams closed early carry no usage, their
+        tokens are estimated (one output token per chunk).
+
+        :param usage_recorded: Whether the wrapper recorded the provider's usage of the response.
+        :return: The collected text.
+        """
+        telemetry = get_telemetry()
+        labels = current_labels()
+        telemetry.increment('streamed_chunks', self.chunks, **labels)
+        if self.stopped:
+            telemetry.increment('early_stops', **labels)
+        if not usage_recorded:
+            record_usage(input_tokens=estimate_tokens(prompt, input_text, max_tokens=0), output_tokens=self.chunks)
+        return self.text
@@ -0,0 +1,323 @@
+import bisect
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from helpers import config
+
+# upper bounds of the latency histogram buckets in seconds, the last bucket is unbounded
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+# labels (provider, model, experiment) of the requests made in the current context
+_labels = contextvars.ContextVar('telemetry_labels', default={})
+# the provider call in flight in the current context, so streaming wrappers can report its first token
+_request = contextvars.ContextVar('telemetry_request', default=None)
+
+
+def telemetry_config():
+    return config.get('telemetry') or {}
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram in the Prometheus layout, quantiles are interpolated within buckets.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-2]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)}
+        }
+
+
+class Telemetry:
+    """
+    Process-wide histograms and counters keyed by metric name and labels.
+
+    Recorded metrics: request_seconds (provider calls), first_token_seconds and first_label_seconds
+    (streaming calls), queue_wait_seconds (scheduler), rate_limit_wait_seconds, parse_seconds,
+    result_log_seconds (queueing rows for the result sink), result_write_seconds (sink writes), and
+    the counters requests, request_errors, retries, failed_requests, input_tokens,
+    cached_input_tokens, output_tokens, cost_usd, streamed_chunks and early_stops.
+    """
+
+    def __init__(self, enabled=True, prefix='media_bias'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        if not self.enabled or not amount:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'timestamp': datetime.now().isoformat(),
+                'histograms': [dict(name=name, labels=dict(labels), **histogram.as_dict())
+                               for (name, labels), histogram in sorted(self._histograms.items())],
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self._counters.items())]
+            }
+
+    def prometheus(self):
+        """
+        The snapshot in the Prometheus text exposition format.
+        """
+        def label_text(labels, **extra):
+            pairs = list(labels) + list(extra.items())
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in pairs) + '}'
+
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                metric = f'{self.prefix}_{name}'
+                if metric not in typed:
+                    lines.append(f'# TYPE {metric} histogram')
+                    typed.add(metric)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{metric}_bucket{label_text(labels, le=le)} {cumulative}')
+                lines.append(f'{metric}_sum{label_text(labels)} {histogram.sum}')
+                lines.append(f'{metric}_count{label_text(labels)} {histogram.count}')
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = f'{self.prefix}_{name}_total'
+                if metric not in typed:
+                    lines.append(f'# TYPE {metric} counter')
+                    typed.add(metric)
+                lines.append(f'{metric}{label_text(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, directory=None):
+        """
+        Write the snapshot as JSON and Prometheus text files named after the current time.
+
+        :return: Paths of the two files.
+        """
+        directory = directory or telemetry_config().get('directory', 'telemetry')
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.join(directory, f"telemetry_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+        with open(name + '.json', 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        with open(name + '.prom', 'w') as f:
+            f.write(self.prometheus())
+        logging.info(f"Telemetry written to {name}.json and {name}.prom")
+        return name + '.json', name + '.prom'
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def get_telemetry():
+    """
+    Return the process-wide telemetry, configured by the telemetry section of config.yml.
+    """
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = Telemetry(enabled=telemetry_config().get('enabled', True))
+        return _telemetry
+
+
+def current_labels(**labels):
+    return {**_labels.get(), **labels}
+
+
+@contextmanager
+def telemetry_scope(**labels):
+    """
+    Label the telemetry of the requests made inside the block, e.g. with provider, model and experiment.
+    """
+    token = _labels.set(current_labels(**labels))
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+@contextmanager
+def timed(name, **labels):
+    """
+    Observe the duration of the block in histogram `name`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        get_telemetry().observe(name, time.perf_counter() - start, **current_labels(**labels))
+
+
+@contextmanager
+def track_request(**labels):
+    """
+    Record one provider call: its duration, whether it failed, and the time to its first token and
+    first label when the wrapper reports them with first_token and first_label.
+    """
+    labels = current_labels(**labels)
+    telemetry = get_telemetry()
+    request = {'start': time.perf_counter(), 'marks': set(), 'labels': labels}
+    token = _request.set(request)
+    try:
+        yield
+    except Exception:
+        telemetry.increment('request_errors', **labels)
+        raise
+    finally:
+        _request.reset(token)
+        telemetry.increment('requests', **labels)
+        telemetry.observe('request_seconds', time.perf_counter() - request['start'], **labels)
+
+
+def _mark(name):
+    request = _request.get()
+    if request is not None and name not in request['marks']:
+        request['marks'].add(name)
+        get_telemetry().observe(name, time.perf_counter() - request['start'], **request['labels'])
+
+
+def first_token():
+    """
+    Called by streaming wrappers when the first chunk of a response arrives.
+    """
+    _mark('first_token_seconds')
+
+
+def first_label():
+    """
+    Called when a streamed response contains a complete label (helpers/streaming.py).
+    """
+    _mark('first_label_seconds')
+
+
+def estimate_cost(model_name, input_tokens=0, output_tokens=0, cached_tokens=0, cache_write_tokens=0):
+    """
+    Estimated cost in USD from the per-million-token prices under pricing in config.yml, None for
+    models without prices. input_tokens includes the cached and cache-write tokens.
+    """
+    prices = (config.get('pricing') or {}).get(model_name)
+    if not prices:
+        return None
+    uncached = max(0, input_tokens - cached_tokens - cache_write_tokens)
+    return (uncached * prices.get('input', 0)
+            + cached_tokens * prices.get('cached_input', prices.get('input', 0))
+            + cache_write_tokens * prices.get('cache_write', prices.get('input', 0))
+            + output_tokens * prices.get('output', 0)) / 1e6
+
+
+def record_tokens(input_tokens=0, output_tokens=0, cached_tokens=0, cache_write_tokens=0):
+    telemetry = get_telemetry()
+    labels = current_labels()
+    telemetry.increment('input_tokens', input_tokens, **labels)
+    telemetry.increment('cached_input_tokens', cached_tokens, **labels)
+    telemetry.increment('output_tokens', output_tokens, **labels)
+    cost = estimate_cost(labels.get('model'), input_tokens or 0, output_tokens or 0, cached_tokens or 0,
+                         cache_write_tokens or 0)
+    if cost is not None:
+        telemetry.increment('cost_usd', cost, **labels)
+
+
+class Progress:
+    """
+    Live progress line with throughput and ETA, redrawn at most every `interval` seconds.
+    """
+
+    def __init__(self, total, interval=1.0, stream=None):
+        self.total = total
+        self.done = 0
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.start = time.monotonic()
+        self._last = 0.0
+
+    def advance(self, count=1):
+        self.done += count
+        now = time.monotonic()
+        if now - self._last >= self.interval or self.done >= self.total:
+            self._last = now
+            self.stream.write('\r' + self.render(now))
+            self.stream.flush()
+
+    def render(self, now=None):
+        elapsed = (now or time.monotonic()) - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        remaining = (self.total - self.done) / rate if rate > 0 else None
+        eta = time.strftime('%H:%M:%S', time.gmtime(remaining)) if remaining is not None else '--:--:--'
+        share = self.done / self.total if self.total else 1.0
+        return f"{self.done}/{self.total} requests ({share:.1%}), {rate:.1f} req/s, ETA {eta}"
+
+    def close(self):
+        self.stream.write('\r' + self.render() + '\n')
+        self.stream.flush()
+
+
+def progress_enabled():
+    return telemetry_config().get('progress', False)
@@ -0,0 +1,104 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+
+from helpers import config
+from helpers.telemetry import record_tokens
+
+# usage key of the experiment the current request belongs to, copied into tasks and worker threads
+_current_key = contextvars.ContextVar('usage_key', default=None)
+
+
+class Usage:
+    """
+    Token usage of one experiment. input_tokens counts the whole prompt, cached_tokens the part of
+    it served from the provider's prompt cache and cache_write_tokens the part written to it.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.cache_write_tokens = 0
+        self.output_tokens = 0
+
+    def add(self, input_tokens=0, output_tokens=0, cached_tokens=0, cache_write_tokens=0):
+        self.requests += 1
+        self.input_tokens += input_tokens or 0
+        self.output_tokens += output_tokens or 0
+        self.cached_tokens += cached_tokens or 0
+        self.cache_write_tokens += cache_write_tokens or 0
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'input_tokens': self.input_tokens,
+            'cached_tokens': self.cached_tokens,
+            'cache_write_tokens': self.cache_write_tokens,
+            'output_tokens': self.output_tokens
+        }
+
+
+class UsageTracker:
+    """
+    Process-wide token usage per experiment. Wrappers report the usage of every response with
+    record_usage, which adds it to the experiment whose usage_scope the request runs in.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usage = {}
+
+    def record(self, key, **tokens):
+        with self._lock:
+            self._usage.setdefault(key, Usage()).add(**tokens)
+
+    def get(self, key):
+        with self._lock:
+            return self._usage.get(key) or Usage()
+
+    def merge(self, key, requests=0, **tokens):
+        """
+        Add usage totals recorded elsewhere, e.g. by the workers of a distributed run.
+        """
+        with self._lock:
+            usage = self._usage.setdefault(key, Usage())
+            usage.requests += requests
+            for name, value in tokens.items():
+                setattr(usage, name, getattr(usage, name) + (value or 0))
+
+    def pop(self, key):
+        with self._lock:
+            return self._usage.pop(key, None) or Usage()
+
+
+_tracker = UsageTracker()
+
+
+def get_usage_tracker():
+    return _tracker
+
+
+@contextmanager
+def usage_scope(key):
+    """
+    Attribute the usage of the requests made inside the block to `key`.
+    """
+    token = _current_key.set(key)
+    try:
+        yield
+    finally:
+        _current_key.reset(token)
+
+
+def record_usage(input_tokens=0, output_tokens=0, cached_tokens=0, cache_write_tokens=0):
+    record_tokens(input_tokens=input_tokens, output_tokens=output_tokens, cached_tokens=cached_tokens,
+                  cache_write_tokens=cache_write_tokens)
+    key = _current_key.get()
+    if key is not None:
+        _tracker.record(key, input_tokens=input_tokens, output_tokens=output_tokens, cached_tokens=cached_tokens,
+                        cache_write_tokens=cache_write_tokens)
+
+
+def prompt_caching_config():
+    return config.get('prompt_caching') or {}
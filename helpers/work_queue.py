@@ -0,0 +1,300 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from helpers import config
+from helpers.checkpoint import text_hash
+
+USAGE_FIELDS = ('requests', 'input_tokens', 'cached_tokens', 'cache_write_tokens', 'output_tokens')
+
+
+def work_queue_config():
+    return config.get('work_queue') or {}
+
+
+def data_hash(texts):
+    """
+    Fingerprint of an experiment's items, so workers that loaded different data don't mix their responses.
+    """
+    digest = hashlib.sha1()
+    for text in texts:
+        digest.update(text_hash(text).encode('ascii'))
+    return digest.hexdigest()
+
+
+class WorkUnit:
+    """
+    One claimed unit of work: items start to stop (exclusive) of one run of an experiment on one model.
+    """
+
+    def __init__(self, id, experiment, model, provider, run, start, stop, attempts):
+        self.id = id
+        self.experiment = experiment
+        self.model = model
+        self.provider = provider
+        self.run = run
+        self.start = start
+        self.stop = stop
+        self.attempts = attempts
+
+    @property
+    def items(self):
+        return {(self.run, index) for index in range(self.start, self.stop)}
+
+    def __repr__(self):
+        return f"{self.experiment} ({self.model}) run {self.run} items {self.start}-{self.stop}"
+
+
+class WorkQueue:
+    """
+    Queue of experiment work units in a SQLite database that several worker processes, on one or
+    several machines sharing the file, claim work from (see worker.py).
+
+    Every experiment on a model is split into (run, chunk of items) units. A worker leases the
+    units it claims for lease_seconds and renews the lease while it is working on them, so the
+    units of a worker that died become claimable again once their lease has run out. Units that
+    failed max_attempts times are given up on and their items count as failed requests. The
+    responses and token usage of completed units are stored alongside, for the process collecting
+    the results of finished experiments.
+
+    The database uses the rollback journal rather than WAL, which needs shared memory between the
+    processes and so does not work across machines. Leases compare wall clock times, the clocks of
+    the machines should be synchronized.
+    """
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        with self._transaction() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS experiments ('
+                'experiment TEXT, model TEXT, provider TEXT, data_hash TEXT, units INTEGER, collected_by TEXT, '
+                'collected REAL, PRIMARY KEY (experiment, model))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS units ('
+                'id INTEGER PRIMARY KEY, experiment TEXT, model TEXT, provider TEXT, run INTEGER, start INTEGER, '
+                'stop INTEGER, state TEXT, worker TEXT, lease_until REAL, attempts INTEGER DEFAULT 0, error TEXT, '
+                + ', '.join(f'{field} INTEGER DEFAULT 0' for field in USAGE_FIELDS) + ', '
+                'UNIQUE (experiment, model, run, start))'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS units_claim ON units (provider, state, lease_until)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'experiment TEXT, model TEXT, key TEXT, response TEXT, PRIMARY KEY (experiment, model, key))'
+            )
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so two workers can't claim the same unit
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def submit(self, experiment, model, provider, texts, runs, chunk_size):
+        """
+        Queue the units of an experiment, units already in the queue are kept as they are.
+
+        :param texts: The experiment's request items, split into chunks of chunk_size.
+        :return: Number of newly queued units.
+        """
+        fingerprint = data_hash(texts)
+        chunks = [(start, min(start + chunk_size, len(texts))) for start in range(0, len(texts), chunk_size)]
+        with self._transaction() as conn:
+            row = conn.execute('SELECT data_hash FROM experiments WHERE experiment = ? AND model = ?',
+                               (experiment, model)).fetchone()
+            if row is not None and row[0] != fingerprint:
+                raise ValueError(f"{experiment} ({model}) is already queued for different data")
+            conn.execute('INSERT OR IGNORE INTO experiments (experiment, model, provider, data_hash, units) '
+                         'VALUES (?, ?, ?, ?, ?)', (experiment, model, provider, fingerprint, runs * len(chunks)))
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT OR IGNORE INTO units (experiment, model, provider, run, start, stop, state) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(experiment, model, provider, run, start, stop, 'pending')
+                 for run in range(1, runs + 1) for start, stop in chunks]
+            )
+            return conn.total_changes - before
+
+    def data_hash(self, experiment, model):
+        with self._lock:
+            row = self._conn.execute('SELECT data_hash FROM experiments WHERE experiment = ? AND model = ?',
+                                     (experiment, model)).fetchone()
+        return row[0] if row else None
+
+    def claim(self, worker, provider, experiments):
+        """
+        Lease the next pending unit of provider, or one whose lease has expired.
+
+        :param experiments: (experiment, model) pairs the worker can run.
+        :return: The claimed WorkUnit, None when there is nothing to claim.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                'SELECT id, experiment, model, provider, run, start, stop, attempts FROM units '
+                "WHERE provider = ? AND (state = 'pending' OR (state = 'leased' AND lease_until < ?)) "
+                'ORDER BY id', (provider, now)
+            ).fetchall()
+            for row in rows:
+                unit = WorkUnit(*row)
+                if (unit.experiment, unit.model) not in experiments:
+                    continue
+                if unit.attempts >= self.max_attempts:
+                    # its workers keep dying on it
+                    conn.execute("UPDATE units SET state = 'failed', lease_until = NULL, error = ? WHERE id = ?",
+                                 (f'lease expired {unit.attempts} times', unit.id))
+                    logging.error(f"Giving up on {unit} after {unit.attempts} expired leases")
+                    continue
+                conn.execute("UPDATE units SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                             'WHERE id = ?', (worker, now + self.lease_seconds, unit.id))
+                unit.attempts += 1
+                return unit
+        return None
+
+    def renew(self, worker, unit_ids):
+        """
+        Extend the leases the worker still holds on unit_ids.
+        """
+        if not unit_ids:
+            return
+        with self._transaction() as conn:
+            conn.executemany("UPDATE units SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                             [(time.time() + self.lease_seconds, unit_id, worker) for unit_id in unit_ids])
+
+    def complete(self, worker, unit, responses, usage=None):
+        """
+        Store the responses of a unit and mark it done, provided the worker still holds its lease.
+        Once the lease ran out and another worker claimed the unit, or the unit was given up on,
+        the late copy is dropped so its responses and usage are not recorded twice.
+
+        :param responses: Dictionary mapping response keys, e.g. (run, item index), to raw responses.
+        :param usage: Token usage of the unit's requests (a Usage).
+        :return: Whether the unit was completed.
+        """
+        usage = usage.as_dict() if usage is not None else {}
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE units SET state = 'done', lease_until = NULL, "
+                + ', '.join(f'{field} = ?' for field in USAGE_FIELDS)
+                + " WHERE id = ? AND worker = ? AND state = 'leased'",
+                (*(usage.get(field, 0) for field in USAGE_FIELDS), unit.id, worker)
+            )
+            if cursor.rowcount != 1:
+                logging.warning(f"{unit} is no longer leased by {worker}, dropping its responses")
+                return False
+            conn.executemany(
+                'INSERT OR REPLACE INTO responses (experiment, model, key, response) VALUES (?, ?, ?, ?)',
+                [(unit.experiment, unit.model, json.dumps(list(key)), response) for key, response in responses.items()]
+            )
+        return True
+
+    def fail(self, worker, unit, error):
+        """
+        Release a unit the worker could not finish, giving up on it after max_attempts claims.
+        """
+        state = 'failed' if unit.attempts >= self.max_attempts else 'pending'
+        with self._transaction() as conn:
+            conn.execute("UPDATE units SET state = ?, lease_until = NULL, error = ? "
+                         "WHERE id = ? AND worker = ? AND state = 'leased'", (state, str(error), unit.id, worker))
+        if state == 'failed':
+            logging.error(f"Giving up on {unit} after {unit.attempts} attempts: {error}")
+
+    def unfinished(self, experiments=None):
+        """
+        Number of units still pending or leased, of the given (experiment, model) pairs or of all experiments.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT experiment, model, COUNT(*) FROM units WHERE state IN ('pending', 'leased') "
+                'GROUP BY experiment, model'
+            ).fetchall()
+        return sum(count for experiment, model, count in rows
+                   if experiments is None or (experiment, model) in experiments)
+
+    def claim_collection(self, worker, experiment, model):
+        """
+        Claim the collection of an experiment whose units are all finished and that nobody collected yet.
+        """
+        with self._transaction() as conn:
+            unfinished = conn.execute(
+                "SELECT COUNT(*) FROM units WHERE experiment = ? AND model = ? AND state IN ('pending', 'leased')",
+                (experiment, model)
+            ).fetchone()[0]
+            if unfinished:
+                return False
+            cursor = conn.execute(
+                'UPDATE experiments SET collected_by = ?, collected = ? '
+                'WHERE experiment = ? AND model = ? AND collected_by IS NULL', (worker, time.time(), experiment, model)
+            )
+            return cursor.rowcount == 1
+
+    def release_collection(self, experiment, model):
+        with self._transaction() as conn:
+            conn.execute('UPDATE experiments SET collected_by = NULL, collected = NULL '
+                         'WHERE experiment = ? AND model = ?', (experiment, model))
+
+    def responses(self, experiment, model):
+        """
+        :return: Dictionary mapping response keys (tuples) to the stored responses of an experiment.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT key, response FROM responses WHERE experiment = ? AND model = ?',
+                                      (experiment, model)).fetchall()
+        return {tuple(json.loads(key)): response for key, response in rows}
+
+    def usage(self, experiment, model):
+        """
+        :return: Token usage totals (USAGE_FIELDS) of the completed units of an experiment.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT ' + ', '.join(f'COALESCE(SUM({field}), 0)' for field in USAGE_FIELDS)
+                + ' FROM units WHERE experiment = ? AND model = ?', (experiment, model)
+            ).fetchone()
+        return dict(zip(USAGE_FIELDS, row))
+
+    def status(self):
+        """
+        :return: One dictionary per experiment with its unit counts per state and who collected it.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT e.experiment, e.model, e.provider, e.collected_by, '
+                "SUM(u.state = 'pending'), SUM(u.state = 'leased'), SUM(u.state = 'done'), SUM(u.state = 'failed') "
+                'FROM experiments e JOIN units u ON u.experiment = e.experiment AND u.model = e.model '
+                'GROUP BY e.experiment, e.model ORDER BY e.experiment, e.model'
+            ).fetchall()
+        names = ('experiment', 'model', 'provider', 'collected_by', 'pending', 'leased', 'done', 'failed')
+        return [dict(zip(names, row)) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_work_queue():
+    """
+    Open the work queue configured in the work_queue section of config.yml.
+    """
+    queue_config = work_queue_config()
+    return WorkQueue(queue_config.get('path', '.cache/work_queue.sqlite'),
+                     lease_seconds=queue_config.get('lease_seconds', 300),
+                     max_attempts=queue_config.get('max_attempts', 3))
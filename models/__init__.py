@@ -1,3 +1,10 @@
-from . import gemini, octai, openai, anthropic
+import importlib
 
-__all__ = [gemini, octai, openai, anthropic]
+# provider modules import their SDK, so they are only imported when first accessed
+__all__ = ['gemini', 'octai', 'openai', 'anthropic', 'mock']
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
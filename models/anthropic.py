@@ -1,37 +1,167 @@
 from .base_models import BaseModel
-import logging
+from .registry import http_client
+from helpers.usage import record_usage, prompt_caching_config
+from helpers.streaming import LabelStream, streaming_enabled
+import json
 
 import anthropic
 
 # ANTHRIPIC_API_KEY = os.environ('ANTHROPIC_API_KEY')
 
 class ClaudeAI(BaseModel):
-    def __init__(self, api_key, model_name):
-        super().__init__(api_key=api_key, model_name=model_name)
-        self.client = anthropic.Anthropic(api_key=api_key)
+    temperature = 0
+    max_tokens = 1000
+    shares_async_client = True
+
+    def __init__(self, api_key, model_name, client=None, async_client_factory=None, **defaults):
+        super().__init__(api_key=api_key, model_name=model_name, async_client_factory=async_client_factory,
+                         **defaults)
+        self.client = client or self.build_client(api_key)
         self.product_name = 'claudeai'
 
-    def predict_single(self, text, prompt, fine_tuned=False, no_labels=2):
-        try:
-            message = self.client.messages.create(
-                model=self.model_name,
-                max_tokens=1000,
-                temperature=0,
-                system=prompt,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": text
-                            }
-                        ]
-                    }
-                ]
+    @staticmethod
+    def build_client(api_key, http=None):
+        # retries are left to the shared resilience policy
+        return anthropic.Anthropic(api_key=api_key, max_retries=0,
+                                   http_client=http_client(http, anthropic.DefaultHttpxClient))
+
+    @staticmethod
+    def build_async_client(api_key, http=None):
+        return anthropic.AsyncAnthropic(api_key=api_key, max_retries=0,
+                                        http_client=http_client(http, anthropic.DefaultAsyncHttpxClient))
+
+    def create_async_client(self):
+        return self.build_async_client(self.api_key)
+
+    def request_params(self, text, prompt, temperature, labels=None):
+        params = dict(
+            model=self.model_name,
+            max_tokens=self.max_tokens,
+            temperature=temperature,
+            system=self.system_blocks(prompt),
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": text
+                        }
+                    ]
+                }
+            ]
+        )
+        if labels is not None:
+            # forcing a single classification tool constrains the answer to the label enum
+            params['max_tokens'] = self.output_tokens(labels)
+            params['tools'] = [{
+                'name': 'classify',
+                'description': 'Record the label of the text.',
+                'input_schema': labels.json_schema()
+            }]
+            params['tool_choice'] = {'type': 'tool', 'name': 'classify'}
+        return params
+
+    @staticmethod
+    def system_blocks(prompt):
+        # marking the system prompt caches the tools and system prefix shared by every request
+        block = {'type': 'text', 'text': prompt}
+        if prompt_caching_config().get('enabled', True):
+            block['cache_control'] = {'type': 'ephemeral'}
+        return [block]
+
+    @staticmethod
+    def observe_usage(message, output_tokens=None):
+        usage = getattr(message, 'usage', None)
+        if usage is not None:
+            cached = getattr(usage, 'cache_read_input_tokens', 0) or 0
+            written = getattr(usage, 'cache_creation_input_tokens', 0) or 0
+            record_usage(
+                input_tokens=usage.input_tokens + cached + written,
+                output_tokens=usage.output_tokens if output_tokens is None else output_tokens,
+                cached_tokens=cached,
+                cache_write_tokens=written
             )
-            return message.content[0].text
 
-        except Exception as e:
-            logging.error(e)
-            return 'none'
+    @staticmethod
+    def message_text(message):
+        # a forced tool call comes back as a tool_use block, returned as its JSON input
+        for block in message.content:
+            if block.type == 'tool_use':
+                return json.dumps(block.input)
+        return message.content[0].text
+
+    @staticmethod
+    def stream_event(event, stream, state):
+        """
+        Take in one streamed event, returns True once the stream can be closed. The input usage comes
+        with message_start, the output tokens with message_delta at the end of the stream.
+        """
+        if event.type == 'message_start':
+            state['message'] = event.message
+        elif event.type == 'message_delta':
+            state['output_tokens'] = event.usage.output_tokens
+        elif event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+            return stream.feed(event.delta.text)
+        return False
+
+    def close_stream(self, text, prompt, stream, state):
+        if 'message' in state:
+            # streams closed early end before message_delta, one output token per text chunk
+            self.observe_usage(state['message'], state.get('output_tokens', stream.chunks))
+        return stream.close(text, prompt, usage_recorded='message' in state)
+
+    def predict_stream(self, text, prompt, temperature):
+        raw = self.client.messages.with_raw_response.create(
+            stream=True, **self.request_params(text, prompt, temperature))
+        self.observe_rate_limit_headers(raw.headers)
+        events = raw.parse()
+        stream, state = LabelStream(), {}
+        try:
+            for event in events:
+                if self.stream_event(event, stream, state):
+                    break
+        finally:
+            events.close()
+        return self.close_stream(text, prompt, stream, state)
+
+    async def apredict_stream(self, text, prompt, temperature):
+        raw = await self.async_client.messages.with_raw_response.create(
+            stream=True, **self.request_params(text, prompt, temperature))
+        self.observe_rate_limit_headers(raw.headers)
+        events = await raw.parse()
+        stream, state = LabelStream(), {}
+        try:
+            async for event in events:
+                if self.stream_event(event, stream, state):
+                    break
+        finally:
+            await events.close()
+        return self.close_stream(text, prompt, stream, state)
+
+    def batch_request(self, request_id, text, prompt, temperature=None, labels=None):
+        temperature = self.temperature if temperature is None else temperature
+        return {'custom_id': request_id, 'params': self.request_params(text, prompt, temperature, labels)}
+
+    def predict_single(self, text, prompt, fine_tuned=False, no_labels=2, temperature=None, labels=None):
+        # errors propagate to the shared retry policy and circuit breaker (helpers/resilience.py)
+        temperature = self.temperature if temperature is None else temperature
+        if streaming_enabled(labels):
+            return self.predict_stream(text, prompt, temperature)
+        raw = self.client.messages.with_raw_response.create(
+            **self.request_params(text, prompt, temperature, labels))
+        self.observe_rate_limit_headers(raw.headers)
+        message = raw.parse()
+        self.observe_usage(message)
+        return self.message_text(message)
+
+    async def apredict_single(self, text, prompt, fine_tuned=False, no_labels=2, temperature=None, labels=None):
+        temperature = self.temperature if temperature is None else temperature
+        if streaming_enabled(labels):
+            return await self.apredict_stream(text, prompt, temperature)
+        raw = await self.async_client.messages.with_raw_response.create(
+            **self.request_params(text, prompt, temperature, labels))
+        self.observe_rate_limit_headers(raw.headers)
+        message = await raw.parse()
+        self.observe_usage(message)
+        return self.message_text(message)
@@ -1,138 +1,339 @@
-from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
-
+import asyncio
 import logging
-import random
+import threading
 import time
+import weakref
 
-from collections import Counter
+from helpers.response_cache import get_response_cache
+from helpers.rate_limiting import get_rate_limiter, is_rate_limit_error, retry_after_from_error, estimate_tokens
+from helpers.resilience import RequestFailed, get_circuit_breaker, resilience_settings, backoff_delay
+from helpers.resilience import is_api_error, is_retryable_error
+from helpers.parsing import structured_max_tokens
+from helpers.telemetry import get_telemetry, track_request, timed
+from . import experiments
 
-from helpers.helpers import *
-from helpers.result_logging import *
 
-binary2num = config['experiment_setup']['conversions']['binary2num']
 class BaseModel:
-    def __init__(self, api_key, model_name):
+    # default generation parameters, overridden by each provider wrapper
+    product_name = None
+    temperature = 0
+    max_tokens = None
+    # whether apredict_samples can get several completions from a single request
+    supports_multi_sample = False
+    # whether one async SDK client can serve every model of the provider (see models.registry)
+    shares_async_client = False
+    # set by wrappers whose request layout changed, so cached responses of the old layout aren't reused
+    request_format = None
+
+    def __init__(self, api_key, model_name, async_client_factory=None, temperature=None, max_tokens=None):
+        """
+        :param async_client_factory: Returns the async client for the running loop, used instead of
+                                     create_async_client to share a client between wrappers.
+        :param temperature: Default temperature, overriding the wrapper's class default.
+        :param max_tokens: Default output token limit, overriding the wrapper's class default.
+        """
         self.api_key = api_key
         self.model_name = model_name
+        if temperature is not None:
+            self.temperature = temperature
+        if max_tokens is not None:
+            self.max_tokens = max_tokens
+        self._async_client_factory = async_client_factory
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._async_clients_lock = threading.Lock()
 
-    def predict_single(self, text, prompt, fine_tune=False, no_labels=2):
+    def predict_single(self, text, prompt, fine_tune=False, no_labels=2, temperature=None, labels=None):
+        """
+        :param labels: LabelParser to constrain the response to with the provider's structured output,
+                       None for a free-text response. Wrappers without structured output ignore it.
+        """
         pass
 
+    async def apredict_single(self, text, prompt, fine_tuned=False, no_labels=2, temperature=None, labels=None):
+        # wrappers without a native async client fall back to a worker thread
+        return await asyncio.to_thread(self.predict_single, text, prompt, fine_tuned, no_labels, temperature, labels)
+
+    def create_async_client(self):
+        return None
+
+    @property
+    def async_client(self):
+        """
+        Async SDK client bound to the running event loop. Async HTTP clients cannot be shared between
+        loops, and every thread calling run_experiment runs its own loop.
+        """
+        loop = asyncio.get_running_loop()
+        with self._async_clients_lock:
+            if loop not in self._async_clients:
+                self._async_clients[loop] = (self._async_client_factory or self.create_async_client)()
+            return self._async_clients[loop]
+
+    def observe_rate_limit_headers(self, headers):
+        limiter = get_rate_limiter(self.product_name)
+        if limiter is not None:
+            limiter.update_from_headers(headers)
+
+    def output_tokens(self, labels=None):
+        if labels is None:
+            return self.max_tokens
+        return labels.max_tokens or structured_max_tokens()
+
+    def limited_predict(self, text, prompt, fine_tuned=False, temperature=None, labels=None):
+        """
+        Call predict_single with the provider's resilience policy (see alimited_call). Sync calls are
+        timed out by the SDK client's HTTP timeout (http_clients in config.yml).
+
+        :raises RequestFailed: When the call failed for good.
+        """
+        limiter = get_rate_limiter(self.product_name)
+        breaker = get_circuit_breaker(self.product_name)
+        settings = resilience_settings(self.product_name)
+        retries = settings.get('retries', 5)
+        tokens = estimate_tokens(prompt, text, max_tokens=self.output_tokens(labels))
+        for attempt in range(retries + 1):
+            breaker.wait()
+            if limiter is not None:
+                with timed('rate_limit_wait_seconds', provider=self.product_name, model=self.model_name):
+                    limiter.acquire(tokens)
+            sent_at = time.monotonic()
+            try:
+                with track_request(provider=self.product_name, model=self.model_name):
+                    response = self.predict_single(text, prompt, fine_tuned, temperature=temperature, labels=labels)
+            except Exception as e:
+                time.sleep(self.retry_delay(e, attempt, retries, settings, limiter, breaker, sent_at))
+                continue
+            breaker.on_success()
+            if limiter is not None:
+                limiter.on_success()
+            return response
+
+    async def alimited_call(self, call, tokens):
+        """
+        Await call() with the provider's resilience policy (resilience in config.yml): wait while the
+        provider's circuit is open and for capacity of its shared rate limiter, time the call out,
+        and retry timeouts, 429s and server errors with jittered exponential backoff.
+
+        :raises RequestFailed: When the call failed for good.
+        """
+        limiter = get_rate_limiter(self.product_name)
+        breaker = get_circuit_breaker(self.product_name)
+        settings = resilience_settings(self.product_name)
+        retries = settings.get('retries', 5)
+        for attempt in range(retries + 1):
+            await breaker.await_closed()
+            if limiter is not None:
+                delay = limiter.reserve(tokens)
+                get_telemetry().observe('rate_limit_wait_seconds', max(delay, 0), provider=self.product_name,
+                                        model=self.model_name)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            sent_at = time.monotonic()
+            try:
+                with track_request(provider=self.product_name, model=self.model_name):
+                    response = await asyncio.wait_for(call(), settings.get('timeout'))
+            except Exception as e:
+                await asyncio.sleep(self.retry_delay(e, attempt, retries, settings, limiter, breaker, sent_at))
+                continue
+            breaker.on_success()
+            if limiter is not None:
+                limiter.on_success()
+            return response
+
+    def retry_delay(self, error, attempt, retries, settings, limiter, breaker, sent_at=None):
+        """
+        Seconds to back off after a failed call before the next attempt: jittered exponential
+        backoff, or the provider's Retry-After if that is longer. 429s also throttle the rate
+        limiter, other retryable errors count towards opening the circuit.
+
+        :param sent_at: time.monotonic() when the failed call was sent.
+
+        :raises RequestFailed: For non-retryable API errors and once the retries are exhausted.
+                               Errors that are not provider errors are re-raised as they are.
+        """
+        if not is_api_error(error):
+            raise error
+        delay = backoff_delay(attempt, settings.get('backoff_base', 1), settings.get('backoff_max', 30))
+        if is_rate_limit_error(error):
+            # many 429s carry no Retry-After, they still have to back off
+            retry_after = retry_after_from_error(error)
+            if limiter is not None:
+                limiter.on_rate_limited(retry_after, sent_at)
+            delay = max(delay, retry_after or 0)
+        elif is_retryable_error(error):
+            breaker.on_failure()
+        if not is_retryable_error(error) or attempt == retries:
+            raise RequestFailed(f"{type(error).__name__}: {error}") from error
+        self.count_retry()
+        return delay
+
+    def count_retry(self):
+        get_telemetry().increment('retries', provider=self.product_name, model=self.model_name)
+
+    def request_failed(self, error):
+        """
+        Log a request that failed for good, its item is marked as failed with a None response.
+        """
+        logging.info(f"Request to {self.model_name} failed: {error}")
+        get_telemetry().increment('failed_requests', provider=self.product_name, model=self.model_name)
+        return None
+
+    async def afailed_as_none(self, awaitable):
+        try:
+            return await awaitable
+        except RequestFailed as e:
+            return self.request_failed(e)
+
+    async def alimited_predict(self, text, prompt, fine_tuned=False, temperature=None, labels=None):
+        return await self.alimited_call(
+            lambda: self.apredict_single(text, prompt, fine_tuned, temperature=temperature, labels=labels),
+            estimate_tokens(prompt, text, max_tokens=self.output_tokens(labels))
+        )
+
+    async def apredict_samples(self, text, prompt, n, fine_tuned=False, temperature=None, labels=None):
+        """
+        Return n completions for one prompt. Wrappers whose provider can sample several completions
+        in one request (supports_multi_sample) override this.
+        """
+        return await asyncio.gather(*(
+            self.apredict_single(text, prompt, fine_tuned, temperature=temperature, labels=labels) for _ in range(n)
+        ))
+
+    async def acached_samples(self, text, prompt, runs, fine_tuned=False, temperature=None, labels=None):
+        """
+        Get one sample per run for a single text, asking for all missing samples in one request where
+        the provider supports it and in parallel requests otherwise. Samples are cached under the same
+        per-run keys as acached_predict, so both modes share cache entries.
+
+        :param runs: Run numbers to sample for.
+        :return: Dictionary mapping each run to its raw response.
+        """
+        temperature = self.temperature if temperature is None else temperature
+        cache = get_response_cache()
+        cacheable = cache is not None and cache.cacheable(temperature)
+        responses = {}
+        if cacheable:
+            for run in runs:
+                response = cache.get(self.cache_key(cache, text, prompt, fine_tuned, temperature, run, labels))
+                if response is not None:
+                    responses[run] = response
+
+        missing = [run for run in runs if run not in responses]
+        if not missing:
+            return responses
+        if not temperature:
+            # deterministic calls give the same answer every run, one completion is enough
+            samples = [await self.afailed_as_none(
+                self.alimited_predict(text, prompt, fine_tuned, temperature, labels))] * len(missing)
+        elif self.supports_multi_sample:
+            samples = await self.afailed_as_none(self.alimited_call(
+                lambda: self.apredict_samples(text, prompt, len(missing), fine_tuned, temperature=temperature,
+                                              labels=labels),
+                estimate_tokens(prompt, text, max_tokens=(self.output_tokens(labels) or 16) * len(missing))
+            )) or [None] * len(missing)
+        else:
+            samples = await asyncio.gather(*(
+                self.afailed_as_none(self.alimited_predict(text, prompt, fine_tuned, temperature, labels))
+                for _ in missing
+            ))
+
+        for run, sample in zip(missing, samples):
+            responses[run] = sample
+            if cacheable and sample:
+                cache.put(self.cache_key(cache, text, prompt, fine_tuned, temperature, run, labels), self.model_name,
+                          sample)
+        return responses
+
+    def cache_key(self, cache, text, prompt, fine_tuned, temperature, sample, labels=None):
+        request = dict(
+            provider=self.product_name,
+            model=self.model_name,
+            prompt=prompt,
+            text=text,
+            temperature=temperature,
+            max_tokens=self.max_tokens,
+            fine_tuned=fine_tuned,
+            sample=sample if temperature else 0
+        )
+        if self.request_format is not None:
+            request['request_format'] = self.request_format
+        if labels is not None:
+            # structured responses differ from free-text ones, free-text keys stay as they were
+            request['labels'] = labels.labels
+            request['max_tokens'] = self.output_tokens(labels)
+        return cache.make_key(**request)
+
+    def cached_predict(self, text, prompt, fine_tuned=False, temperature=None, sample=0, labels=None):
+        """
+        Call predict_single through the shared response cache.
+
+        :param sample: Index of the sample for non-deterministic calls, so that separate runs at
+                       temperature > 0 stay independent samples while reruns still hit the cache.
+        :return: Tuple of (response, hit), hit is True when no provider call was made. The response
+                 is None when the request failed for good (see limited_predict).
+        """
+        temperature = self.temperature if temperature is None else temperature
+        cache = get_response_cache()
+        try:
+            if cache is None:
+                return self.limited_predict(text, prompt, fine_tuned, temperature=temperature, labels=labels), False
+
+            return cache.get_or_compute(
+                self.cache_key(cache, text, prompt, fine_tuned, temperature, sample, labels), self.model_name,
+                lambda: self.limited_predict(text, prompt, fine_tuned, temperature=temperature, labels=labels),
+                cacheable=cache.cacheable(temperature)
+            )
+        except RequestFailed as e:
+            return self.request_failed(e), False
+
+    async def acached_predict(self, text, prompt, fine_tuned=False, temperature=None, sample=0, labels=None):
+        """
+        Call apredict_single through the shared response cache, see cached_predict. The response of a
+        request that failed for good is None.
+        """
+        temperature = self.temperature if temperature is None else temperature
+        cache = get_response_cache()
+        try:
+            if cache is None:
+                return await self.alimited_predict(text, prompt, fine_tuned, temperature=temperature,
+                                                   labels=labels), False
+
+            return await cache.aget_or_compute(
+                self.cache_key(cache, text, prompt, fine_tuned, temperature, sample, labels), self.model_name,
+                lambda: self.alimited_predict(text, prompt, fine_tuned, temperature=temperature, labels=labels),
+                cacheable=cache.cacheable(temperature)
+            )
+        except RequestFailed as e:
+            return self.request_failed(e), False
+
     def predict(self, texts, prompt, fine_tuned=False, no_labels=2):
         predictions = []
         for text in texts:
-            prediction = self.predict_single(text, prompt, fine_tuned, no_labels)
+            prediction, _ = self.cached_predict(text, prompt, fine_tuned)
             predictions.append(prediction)
         return predictions
 
-    def run_experiment(self, params, sleep_time=0.4):
-        # Extract parameters from the dictionary
-        experiment_name = params.get('experiment_name')
-        prompt = params.get('prompt')
-        prompt_type = params.get('prompt_type')
-        prompt_role = params.get('prompt_role')
-        texts = params.get('texts')
-        ground_truths = params.get('ground_truths')
-        detection_type = params.get('detection_type', 'article')
-        num_runs = params.get('num_runs', 1)
-        fine_tuned = params.get('fine_tuned', False)
-        classification_type = params.get('classification_type', 'binary')
-
-        all_predictions = []
-        all_individual_results = []
-        logging.info("Prompt: %s", prompt)
-
-        for run in range(1, num_runs + 1):
-            preds = []
-            size = len(texts)
-            progress_counter = 0
-
-            for text, ground_truth in zip(texts, ground_truths):
-                # Get the result (Mock prediction as placeholder)
-                result = self.predict_single(text, prompt, fine_tuned)
-
-                time.sleep(sleep_time)
-                result = extract_single_word(result)
-                try:
-                    result = binary2num[result.lower()]
-                    preds.append(result)
-                except Exception as e:
-                    result = 0
-                    preds.append(result)
-                    logging.warning("Invalid result from %s in prompt %s for experiment %s", e, prompt, experiment_name)
-
-                # Convert ground truth if needed
-                if isinstance(ground_truth, str):
-                    ground_truth = binary2num[ground_truth]
-
-                entry_dict_individual = {
-                    'Experiment': experiment_name,
-                    'Run': run,
-                    'Model': self.model_name,
-                    'Prompt_Type': prompt_type,
-                    'Prompt_Role': prompt_role,
-                    'Prompt': prompt,
-                    'Text': text,
-                    'FineTuned': fine_tuned,
-                    'Prediction': result,
-                    'Ground_Truth': ground_truth,
-                    'Detection_Type': detection_type,
-                    'Classification_Type': classification_type
-                }
-                all_individual_results.append(entry_dict_individual)
-
-                logging.info(f"Progression: {progress_counter} / {size}")
-                progress_counter += 1
-
-            all_predictions.append(preds)
-
-        # Transpose the list of lists to group predictions for each test case across all runs
-        transposed_predictions = list(zip(*all_predictions))
-
-        # Get the most common prediction for each test case
-        most_common_predictions = [Counter(preds).most_common(1)[0][0] for preds in transposed_predictions]
-
-        predictions = most_common_predictions
-
-        try:
-            accuracy = accuracy_score(ground_truths, predictions)
-            precision = precision_score(ground_truths, predictions, average='binary')
-            recall = recall_score(ground_truths, predictions, average='binary')
-            f1 = f1_score(ground_truths, predictions, average='binary')
-        except Exception as e:
-            logging.error(e)
-            accuracy = accuracy_score(ground_truths, predictions)
-            precision, recall, f1 = 0, 0, 0
-
-        overall_metrics = {
-            'accuracy': accuracy,
-            'precision': precision,
-            'recall': recall,
-            'f1': f1
+    def batch_request(self, request_id, text, prompt, temperature=None, labels=None):
+        """
+        One line of a batch job input file. Defaults to the OpenAI chat completions batch format,
+        which the local batch backend also understands. Structured output is left to the wrappers.
+        """
+        temperature = self.temperature if temperature is None else temperature
+        body = {
+            'model': self.model_name,
+            'messages': [
+                {'role': 'system', 'content': prompt},
+                {'role': 'user', 'content': text}
+            ],
+            'temperature': temperature
         }
+        if self.max_tokens:
+            body['max_tokens'] = self.max_tokens
+        return {'custom_id': request_id, 'method': 'POST', 'url': '/v1/chat/completions', 'body': body}
 
-        entry_dict_overall = {
-            'Experiment': experiment_name,
-            'Run': num_runs,
-            'Model': self.model_name,
-            'Prompt_Type': prompt_type,
-            'Prompt_Role': prompt_role,
-            'Prompt': prompt,
-            'Fine_Tuned': fine_tuned,
-            'Classification_Type': classification_type,
-            'Detection_Type': detection_type,
-            'Accuracy': overall_metrics['accuracy'],
-            'Precision': overall_metrics['precision'],
-            'Recall': overall_metrics['recall'],
-            'F1-Score': overall_metrics['f1'],
-            'No_Runs': num_runs
-        }
+    def run_experiment(self, params):
+        # experiments are broken into requests and scored by models.experiments, wrappers only make the calls
+        return experiments.run_experiment(self, params)
 
-        # Save overall and individual results in CSV format
-        logging.info(
-            f'Logged overall results for experiment {experiment_name}, model: {self.model_name}, prompt: {prompt}')
-        save_results(all_individual_results, self.model_name, prompt_type, prompt_role, classification_type, fine_tuned)
-        return entry_dict_overall
 
 # Fine-Tuned Model Class
 class FineTunedModel(BaseModel):
@@ -155,4 +356,4 @@ class FineTunedModel(BaseModel):
         pass
 
     def run_experiment(self, params):
-        pass
\ No newline at end of file
+        pass
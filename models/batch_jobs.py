@@ -0,0 +1,402 @@
+import abc
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from helpers import config
+from helpers.checkpoint import experiment_key
+from helpers.work_queue import data_hash
+from models.experiments import completed_responses, experiment_labels, journal_response, finalize_experiment
+
+# Batch job states reported by every backend
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+
+def custom_id(experiment_index, run, index):
+    # Anthropic only accepts [a-zA-Z0-9_-]{1,64} as custom ids
+    return f"e{experiment_index}-r{run}-i{index}"
+
+
+def parse_custom_id(value):
+    experiment_index, run, index = (int(part[1:]) for part in value.split('-'))
+    return experiment_index, run, index
+
+
+def request_messages(body):
+    """
+    Extract the (system prompt, user text) pair from an OpenAI chat or Anthropic messages request body.
+    """
+    if 'system' in body:
+        content = body['messages'][0]['content']
+        text = content if isinstance(content, str) else ''.join(part['text'] for part in content)
+        system = body['system']
+        if not isinstance(system, str):
+            system = ''.join(part['text'] for part in system)
+        return system, text
+    messages = {message['role']: message['content'] for message in body['messages']}
+    return messages.get('system', ''), messages.get('user', '')
+
+
+class BatchBackend(abc.ABC):
+    """
+    Interface of an asynchronous batch endpoint: submit a JSONL file of requests, poll the job,
+    then fetch the raw responses keyed by custom id.
+    """
+
+    @abc.abstractmethod
+    def submit(self, input_path):
+        """
+        :return: The job id.
+        """
+
+    @abc.abstractmethod
+    def poll(self, job_id):
+        """
+        :return: RUNNING, COMPLETED or FAILED.
+        """
+
+    @abc.abstractmethod
+    def results(self, job_id):
+        """
+        :return: Dictionary mapping custom ids to raw response texts.
+        """
+
+
+class OpenAIBatchBackend(BatchBackend):
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, input_path):
+        with open(input_path, 'rb') as f:
+            batch_file = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h'
+        )
+        return batch.id
+
+    def poll(self, job_id):
+        status = self.client.batches.retrieve(job_id).status
+        if status == 'completed':
+            return COMPLETED
+        if status in ('failed', 'expired', 'cancelled'):
+            return FAILED
+        return RUNNING
+
+    def results(self, job_id):
+        batch = self.client.batches.retrieve(job_id)
+        responses = {}
+        if batch.output_file_id is None:
+            return responses
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get('response') or {}
+            if response.get('status_code') == 200:
+                responses[record['custom_id']] = response['body']['choices'][0]['message']['content']
+        return responses
+
+
+class AnthropicBatchBackend(BatchBackend):
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, input_path):
+        with open(input_path, 'r') as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        return self.client.messages.batches.create(requests=requests).id
+
+    def poll(self, job_id):
+        batch = self.client.messages.batches.retrieve(job_id)
+        return COMPLETED if batch.processing_status == 'ended' else RUNNING
+
+    def results(self, job_id):
+        from models.anthropic import ClaudeAI
+        responses = {}
+        for entry in self.client.messages.batches.results(job_id):
+            if entry.result.type == 'succeeded':
+                # structured and sentence requests are answered with a tool_use block
+                responses[entry.custom_id] = ClaudeAI.message_text(entry.result.message)
+        return responses
+
+
+class LocalBatchBackend(BatchBackend):
+    """
+    File-based stand-in for the provider batch endpoints, used to exercise the whole
+    submit/poll/ingest pipeline offline.
+
+    Jobs are directories holding the submitted input and, once processed, an output file in the
+    OpenAI batch output format. Each request is answered by `responder(system_prompt, text)`; the
+    default responder picks a label deterministically from a hash of the request.
+    """
+
+    def __init__(self, directory, responder=None, delay=0):
+        """
+        :param directory: Directory in which job folders are created.
+        :param responder: Callable (system prompt, text) -> response text.
+        :param delay: Seconds a job stays running before it is processed.
+        """
+        self.directory = directory
+        self.responder = responder or self.default_responder
+        self.delay = delay
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def default_responder(system, text):
+        labels = ['biased', 'nonbiased']
+        digest = hashlib.sha1((system + text).encode('utf-8')).digest()
+        return labels[digest[0] % len(labels)]
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.directory, job_id)
+
+    def submit(self, input_path):
+        job_id = f"local_{uuid.uuid4().hex[:12]}"
+        os.makedirs(self._job_dir(job_id))
+        shutil.copy(input_path, os.path.join(self._job_dir(job_id), 'input.jsonl'))
+        with open(os.path.join(self._job_dir(job_id), 'submitted'), 'w') as f:
+            f.write(str(time.time()))
+        return job_id
+
+    def _process(self, job_id):
+        job_dir = self._job_dir(job_id)
+        output_path = os.path.join(job_dir, 'output.jsonl')
+        with open(os.path.join(job_dir, 'input.jsonl'), 'r') as f, open(output_path + '.tmp', 'w') as out:
+            for line in f:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                body = request.get('body') or request.get('params')
+                content = self.responder(*request_messages(body))
+                out.write(json.dumps({
+                    'custom_id': request['custom_id'],
+                    'response': {'status_code': 200, 'body': {'choices': [{'message': {'content': content}}]}}
+                }) + '\n')
+        os.replace(output_path + '.tmp', output_path)
+
+    def poll(self, job_id):
+        job_dir = self._job_dir(job_id)
+        if not os.path.isdir(job_dir):
+            return FAILED
+        if os.path.exists(os.path.join(job_dir, 'output.jsonl')):
+            return COMPLETED
+        with open(os.path.join(job_dir, 'submitted'), 'r') as f:
+            submitted = float(f.read())
+        if time.time() - submitted < self.delay:
+            return RUNNING
+        self._process(job_id)
+        return COMPLETED
+
+    def results(self, job_id):
+        responses = {}
+        with open(os.path.join(self._job_dir(job_id), 'output.jsonl'), 'r') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    responses[record['custom_id']] = record['response']['body']['choices'][0]['message']['content']
+        return responses
+
+
+def get_batch_backend(model):
+    """
+    Pick the batch backend for a model from the batch_jobs section of config.yml, or None when its
+    provider has no batch endpoint.
+    """
+    batch_config = config.get('batch_jobs') or {}
+    if batch_config.get('backend', 'provider') == 'local':
+        return LocalBatchBackend(os.path.join(batch_config.get('directory', 'batch_jobs'), 'local_backend'))
+    if model.product_name == 'chatgpt':
+        return OpenAIBatchBackend(model.client)
+    if model.product_name == 'claudeai':
+        return AnthropicBatchBackend(model.client)
+    return None
+
+
+class BatchJobRunner:
+    """
+    Runs an experiment grid through provider batch endpoints instead of synchronous calls.
+
+    All requests of the grid are serialized into one JSONL file per model, submitted, polled until
+    done and mapped back into the same individual/overall results run_experiment produces. The
+    state (input files, job ids, finalized experiments) is kept in a manifest so an interrupted run
+    resumes polling the submitted jobs instead of submitting them again, and experiments already
+    finalized are not finalized and logged a second time. Every item and run is its own request,
+    pack_tokens and multi_sample only apply to the online scheduler.
+    """
+
+    def __init__(self, experiments, directory=None, backend_factory=get_batch_backend, poll_interval=None):
+        """
+        :param experiments: List of (model, params) pairs, params as passed to run_experiment.
+        :param directory: Directory for batch input files and the manifest.
+        :param backend_factory: Callable model -> BatchBackend or None.
+        :param poll_interval: Seconds between status checks.
+        """
+        batch_config = config.get('batch_jobs') or {}
+        self.experiments = experiments
+        self.backend_factory = backend_factory
+        self.poll_interval = poll_interval if poll_interval is not None else batch_config.get('poll_interval', 60)
+
+        grid_hash = hashlib.sha1(json.dumps([
+            [model.model_name, params.get('experiment_name'), params.get('prompt'), params.get('num_runs', 1),
+             data_hash(params.get('texts'))]
+            for model, params in experiments
+        ]).encode('utf-8')).hexdigest()[:12]
+        self.directory = os.path.join(directory or batch_config.get('directory', 'batch_jobs'), grid_hash)
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest = self._load_manifest()
+        self._backends = {}
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+            manifest.setdefault('finalized', [])
+            return manifest
+        return {'jobs': {}, 'finalized': []}
+
+    def _save_manifest(self):
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def _model_key(self, model):
+        return f"{model.product_name}_{model.model_name}".replace('/', '_').replace(':', '_')
+
+    def _experiment_key(self, model, params):
+        return f"{self._model_key(model)}/{experiment_key(params)}"
+
+    def finalized(self, model, params):
+        return self._experiment_key(model, params) in self.manifest['finalized']
+
+    def backend(self, model):
+        key = self._model_key(model)
+        if key not in self._backends:
+            self._backends[key] = self.backend_factory(model)
+        return self._backends[key]
+
+    def batchable(self):
+        return [(i, model, params) for i, (model, params) in enumerate(self.experiments)
+                if self.backend(model) is not None]
+
+    def prepare(self):
+        """
+        Serialize every request not yet journaled into one batch input file per model. Models with
+        every request journaled get no job, finalized experiments are left out.
+        """
+        requests = {}
+        ignored = set()
+        for experiment_index, model, params in self.batchable():
+            key = self._model_key(model)
+            if key in self.manifest['jobs'] or self.finalized(model, params):
+                continue
+            ignored.update(name for name in ('pack_tokens', 'multi_sample') if params.get(name))
+            completed = completed_responses(model, params)
+            labels = experiment_labels(params)
+            lines = requests.setdefault(key, [])
+            for run in range(1, params.get('num_runs', 1) + 1):
+                for index, text in enumerate(params.get('texts')):
+                    if (run, index) in completed:
+                        continue
+                    request = model.batch_request(custom_id(experiment_index, run, index), text, params.get('prompt'),
+                                                  labels=labels)
+                    lines.append(json.dumps(request) + '\n')
+        if ignored:
+            logging.warning(f"Batch jobs send one request per item and run, ignoring {', '.join(sorted(ignored))}")
+        for key, lines in requests.items():
+            if not lines:
+                continue
+            path = os.path.join(self.directory, f'{key}.jsonl')
+            with open(path, 'w') as f:
+                f.writelines(lines)
+            self.manifest['jobs'][key] = {'input': path, 'job_id': None, 'status': None}
+        self._save_manifest()
+
+    def submit(self):
+        for experiment_index, model, params in self.batchable():
+            job = self.manifest['jobs'].get(self._model_key(model))
+            if job is None or job['job_id'] is not None:
+                continue
+            job['job_id'] = self.backend(model).submit(job['input'])
+            job['status'] = RUNNING
+            logging.info(f"Submitted batch job {job['job_id']} for {model.model_name}")
+            self._save_manifest()
+
+    def poll(self, wait=True):
+        """
+        Update the status of every submitted job, waiting until all of them have finished if `wait`.
+
+        :return: True when no job is still running.
+        """
+        while True:
+            running = 0
+            for experiment_index, model, params in self.batchable():
+                job = self.manifest['jobs'].get(self._model_key(model))
+                if job is None or job['status'] != RUNNING:
+                    continue
+                job['status'] = self.backend(model).poll(job['job_id'])
+                if job['status'] == RUNNING:
+                    running += 1
+                else:
+                    logging.info(f"Batch job {job['job_id']} for {model.model_name}: {job['status']}")
+            self._save_manifest()
+            if not running or not wait:
+                return not running
+            logging.info(f"Waiting for {running} batch jobs")
+            time.sleep(self.poll_interval)
+
+    def ingest(self):
+        """
+        Map the batch results back to their experiments and finalize them, recording every
+        finalized experiment in the manifest.
+
+        :return: List of (model, params, overall results) for every batchable experiment not
+                 finalized by an earlier call.
+        """
+        results = {}
+        for experiment_index, model, params in self.batchable():
+            job = self.manifest['jobs'].get(self._model_key(model))
+            if job is not None and job['status'] == COMPLETED and job['job_id'] not in results:
+                results[job['job_id']] = self.backend(model).results(job['job_id'])
+
+        responses = {}
+        for job_responses in results.values():
+            for request_id, response in job_responses.items():
+                experiment_index, run, index = parse_custom_id(request_id)
+                responses.setdefault(experiment_index, {})[(run, index)] = response
+
+        overall = []
+        for experiment_index, model, params in self.batchable():
+            if self.finalized(model, params):
+                logging.info(f"{params.get('experiment_name')} ({model.model_name}) was finalized already, skipping it")
+                continue
+            experiment_responses = completed_responses(model, params)
+            experiment_responses.update(responses.get(experiment_index, {}))
+            for (run, index), response in experiment_responses.items():
+                journal_response(model, params, run, index, response)
+            expected = params.get('num_runs', 1) * len(params.get('texts'))
+            if len(experiment_responses) < expected:
+                logging.error(f"Batch results for {params.get('experiment_name')} ({model.model_name}) are incomplete: "
+                              f"{len(experiment_responses)} / {expected}, the missing requests are resubmitted next run")
+                # the received responses are journaled, forget the job so prepare() batches only the rest
+                self.manifest['jobs'].pop(self._model_key(model), None)
+                continue
+            overall.append((model, params, finalize_experiment(model, params, experiment_responses)))
+            self.manifest['finalized'].append(self._experiment_key(model, params))
+            self._save_manifest()
+        self._save_manifest()
+        return overall
+
+    def run(self):
+        self.prepare()
+        self.submit()
+        self.poll(wait=True)
+        return self.ingest()
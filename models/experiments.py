@@ -0,0 +1,409 @@
+import asyncio
+import logging
+import threading
+import weakref
+from contextlib import contextmanager
+
+import numpy as np
+
+from helpers import config
+from helpers.result_logging import save_results
+from helpers.scheduler import Job
+from helpers.checkpoint import get_journal, experiment_key
+from helpers.metrics import evaluate
+from helpers.parsing import get_parser, structured_output_enabled, log_parse_failures
+from helpers.usage import get_usage_tracker, usage_scope
+from helpers.streaming import stream_labels
+from helpers.telemetry import telemetry_scope, timed, Progress, progress_enabled
+from helpers.sentences import sentence_parser, parse_sentence_batches, phrase_recall
+from helpers.packing import pack_texts, packed_prompt, packed_parser, format_pack, drift_sample, packing_drift
+
+# experiments on a model (a BaseModel wrapper, see base_models.py): breaking them into requests, running
+# them and scoring their responses
+
+binary2num = config['experiment_setup']['conversions']['binary2num']
+
+_semaphores = weakref.WeakKeyDictionary()
+_semaphores_lock = threading.Lock()
+
+
+def provider_semaphore(provider):
+    """
+    Return the semaphore bounding the number of in-flight requests to `provider` on the running
+    event loop, sized by the concurrency section of config.yml.
+    """
+    loop = asyncio.get_running_loop()
+    with _semaphores_lock:
+        semaphores = _semaphores.setdefault(loop, {})
+        if provider not in semaphores:
+            limits = config.get('concurrency') or {}
+            semaphores[provider] = asyncio.Semaphore(limits.get(provider, limits.get('default', 8)))
+        return semaphores[provider]
+
+
+def completed_responses(model, params):
+    """
+    Responses of the experiment on model already recorded in the request journal by an earlier, interrupted run.
+    """
+    journal = get_journal()
+    if journal is None:
+        return {}
+    completed = journal.completed(experiment_key(params), model.model_name, params.get('texts'))
+    if completed:
+        logging.info(f"Resuming {params.get('experiment_name')} ({model.model_name}) "
+                     f"with {len(completed)} journaled predictions")
+    return completed
+
+
+def journal_response(model, params, run, index, response):
+    journal = get_journal()
+    if journal is not None and response:
+        journal.record(experiment_key(params), model.model_name, run, index, params.get('texts')[index], response)
+
+
+def experiment_labels(params):
+    """
+    The parser whose labels an experiment's responses are constrained to, None for free-text responses.
+    Sentence-level experiments always ask for indexed labels, a free-text answer to a batch of
+    sentences cannot be mapped back to them reliably.
+    """
+    if params.get('detection_type') == 'sentence':
+        return sentence_parser(params)
+    if not structured_output_enabled(params):
+        return None
+    return get_parser(params.get('classification_type', 'binary'))
+
+
+def usage_key(model, params):
+    return experiment_key(params), model.model_name
+
+
+@contextmanager
+def request_scope(model, params, usage=None):
+    """
+    Attribute the token usage and telemetry of the requests made inside the block to the experiment,
+    and stop their free-text streams at the experiment's first label.
+
+    :param usage: Usage key to record the tokens under, the experiment's usage_key by default.
+    """
+    with usage_scope(usage or usage_key(model, params)), telemetry_scope(
+            provider=model.product_name, model=model.model_name, experiment=params.get('experiment_name')), \
+            stream_labels(get_parser(params.get('classification_type', 'binary'))):
+        yield
+
+
+def experiment_requests(model, params, completed=None, items=None, usage=None):
+    """
+    Break an experiment into individual requests, skipping those already in `completed`.
+
+    :param items: Only build the requests of these (run, item index) keys, e.g. one work unit of
+                  a distributed run (see worker.py). All items by default.
+    :param usage: Usage key of the requests, see request_scope.
+    :return: List of coroutine functions, each returning {(run, item index): raw response}.
+    """
+    prompt = params.get('prompt')
+    texts = params.get('texts')
+    num_runs = params.get('num_runs', 1)
+    fine_tuned = params.get('fine_tuned', False)
+    completed = completed or {}
+    if items is not None:
+        # everything outside the scope counts as done
+        completed = {**{(run, index): None for run in range(1, num_runs + 1) for index in range(len(texts))
+                        if (run, index) not in items}, **completed}
+    if params.get('pack_tokens') and params.get('detection_type', 'article') == 'article':
+        return packed_requests(model, params, completed, items, usage)
+    journal = get_journal()
+    key = experiment_key(params)
+    labels = experiment_labels(params)
+
+    def request(run, index, text):
+        async def send():
+            with request_scope(model, params, usage):
+                response, _ = await model.acached_predict(text, prompt, fine_tuned, sample=run, labels=labels)
+            if journal is not None and response:
+                journal.record(key, model.model_name, run, index, text, response)
+            return {(run, index): response}
+        return send
+
+    def multi_sample_request(runs, index, text):
+        async def send():
+            with request_scope(model, params, usage):
+                responses = await model.acached_samples(text, prompt, runs, fine_tuned, labels=labels)
+            if journal is not None:
+                for run, response in responses.items():
+                    if response:
+                        journal.record(key, model.model_name, run, index, text, response)
+            return {(run, index): response for run, response in responses.items()}
+        return send
+
+    if params.get('multi_sample', False):
+        # one request per item carrying all of its missing runs as samples
+        requests = []
+        for index, text in enumerate(texts):
+            runs = [run for run in range(1, num_runs + 1) if (run, index) not in completed]
+            if runs:
+                requests.append(multi_sample_request(runs, index, text))
+        return requests
+
+    return [
+        request(run, index, text)
+        for run in range(1, num_runs + 1)
+        for index, text in enumerate(texts)
+        if (run, index) not in completed
+    ]
+
+
+def packed_requests(model, params, completed, items=None, usage=None):
+    """
+    Requests of an experiment packing as many texts into each request as fit its pack_tokens
+    budget, answered with one label per text. Texts a packed answer leaves out or mislabels are
+    sent again on their own and marked with ('single', run, index) keys, and the drift sample
+    (pack_drift_sample) is also classified unpacked under ('unpacked', run, index) keys. Packing
+    replaces multi_sample.
+    """
+    prompt = params.get('prompt')
+    texts = params.get('texts')
+    num_runs = params.get('num_runs', 1)
+    fine_tuned = params.get('fine_tuned', False)
+    journal = get_journal()
+    key = experiment_key(params)
+    labels = experiment_labels(params)
+    packed = packed_parser(params)
+    pack_prompt = packed_prompt(prompt)
+
+    async def single(run, index):
+        response, _ = await model.acached_predict(texts[index], prompt, fine_tuned, sample=run, labels=labels)
+        return response
+
+    def request(run, pack):
+        async def send():
+            with request_scope(model, params, usage):
+                results, missing = {}, pack
+                if len(pack) > 1:
+                    response, _ = await model.acached_predict(format_pack(texts, pack), pack_prompt, fine_tuned,
+                                                              sample=run, labels=packed)
+                    parsed = packed.parse(response, len(pack))
+                    results = {(run, index): label for index, label in zip(pack, parsed) if label is not None}
+                    missing = [index for index, label in zip(pack, parsed) if label is None]
+                    if missing:
+                        logging.info(f"Packed answer of {params.get('experiment_name')} ({model.model_name}) "
+                                     f"missed {len(missing)} of {len(pack)} texts, sending them on their own")
+                # texts without a label in the packed answer, and texts too long to share a request
+                singles = await asyncio.gather(*(single(run, index) for index in missing))
+                results.update({(run, index): response for index, response in zip(missing, singles)})
+            if journal is not None:
+                for (_, index), response in results.items():
+                    if response:
+                        journal.record(key, model.model_name, run, index, texts[index], response)
+            # items answered on their own have no packed prediction to measure drift with
+            results.update({('single', run, index): '' for index in missing})
+            return results
+        return send
+
+    def unpacked_request(run, index):
+        async def send():
+            with request_scope(model, params, usage):
+                return {('unpacked', run, index): await single(run, index)}
+        return send
+
+    requests = []
+    sample = drift_sample(len(texts), params)
+    for run in range(1, num_runs + 1):
+        pending = [index for index in range(len(texts)) if (run, index) not in completed]
+        for pack in pack_texts([texts[index] for index in pending], prompt, params['pack_tokens'],
+                               params.get('pack_max_items')):
+            requests.append(request(run, [pending[position] for position in pack]))
+        requests.extend(unpacked_request(run, index) for index in sample if items is None or (run, index) in items)
+    return requests
+
+
+def experiment_job(model, params):
+    """
+    Wrap an experiment on model as a scheduler job, queued on the model's provider.
+    """
+    completed = completed_responses(model, params)
+    job = Job(
+        name=f"{params.get('experiment_name')} ({model.model_name})",
+        provider=model.product_name,
+        requests=experiment_requests(model, params, completed),
+        finalize=lambda responses: finalize_experiment(model, params, responses)
+    )
+    job.results.update(completed)
+    return job
+
+
+async def arun_experiment(model, params):
+    """
+    Run an experiment with many requests in flight at once, bounded by the provider's
+    concurrency limit (concurrency in config.yml) and its shared rate limiter.
+    """
+    experiment_name = params.get('experiment_name')
+    logging.info("Prompt: %s", params.get('prompt'))
+    semaphore = provider_semaphore(model.product_name)
+    responses = completed_responses(model, params)
+    requests = experiment_requests(model, params, responses)
+    size = len(requests)
+    progress_counter = 0
+    progress = Progress(size) if progress_enabled() else None
+
+    async def run_request(request):
+        nonlocal progress_counter
+        async with semaphore:
+            response = await request()
+        progress_counter += 1
+        logging.info(f"Progression: {experiment_name} {progress_counter} / {size}")
+        if progress is not None:
+            progress.advance()
+        return response
+
+    for response in await asyncio.gather(*(run_request(request) for request in requests)):
+        responses.update(response)
+    if progress is not None:
+        progress.close()
+    return finalize_experiment(model, params, responses)
+
+
+def run_experiment(model, params):
+    return asyncio.run(arun_experiment(model, params))
+
+
+def parse_run(params, responses, run):
+    """
+    Labels of the items of one run, the sentences for sentence-level experiments whose requests
+    each carry a batch of them.
+    """
+    run_responses = [responses.get((run, index)) for index in range(len(params.get('texts')))]
+    if params.get('detection_type') == 'sentence':
+        return parse_sentence_batches(sentence_parser(params), params.get('sentence_batches'), run_responses)
+    return get_parser(params.get('classification_type', 'binary')).parse_many(run_responses)
+
+
+def failed_items(params, responses):
+    """
+    Boolean (runs, items) matrix of the items whose request failed for good (a None response),
+    for sentence-level experiments every sentence of a failed batch.
+    """
+    num_runs = params.get('num_runs', 1)
+    requests = range(len(params.get('texts')))
+    if params.get('detection_type') == 'sentence':
+        sizes = [count for _, _, count in params.get('sentence_batches')]
+        return np.array([[responses.get((run, index)) is None for index in requests for _ in range(sizes[index])]
+                         for run in range(1, num_runs + 1)], dtype=bool)
+    return np.array([[responses.get((run, index)) is None for index in requests]
+                     for run in range(1, num_runs + 1)], dtype=bool)
+
+
+def finalize_experiment(model, params, responses):
+    """
+    Turn the raw responses of an experiment into individual and overall results.
+
+    :param params: The experiment parameters passed to run_experiment.
+    :param responses: Dictionary mapping (run, request index) to the raw model response.
+    :return: The overall results entry for the experiment.
+    """
+    experiment_name = params.get('experiment_name')
+    prompt = params.get('prompt')
+    prompt_type = params.get('prompt_type')
+    prompt_role = params.get('prompt_role')
+    detection_type = params.get('detection_type', 'article')
+    # items are scored one by one, a sentence-level request covers several of them
+    texts = params.get('sentences') if detection_type == 'sentence' else params.get('texts')
+    ground_truths = params.get('ground_truths')
+    num_runs = params.get('num_runs', 1)
+    fine_tuned = params.get('fine_tuned', False)
+    classification_type = params.get('classification_type', 'binary')
+
+    all_predictions = []
+    all_individual_results = []
+    parser = get_parser(classification_type)
+    parse_failures = 0
+    failed = failed_items(params, responses)
+
+    for run in range(1, num_runs + 1):
+        with timed('parse_seconds', provider=model.product_name, model=model.model_name, experiment=experiment_name):
+            labels = parse_run(params, responses, run)
+            preds, _ = parser.to_values(labels)
+        parse_failures += sum(label is None and not item_failed for label, item_failed in zip(labels, failed[run - 1]))
+
+        for index, (text, ground_truth, result) in enumerate(zip(texts, ground_truths, preds)):
+            # Convert ground truth if needed
+            if isinstance(ground_truth, str):
+                ground_truth = binary2num[ground_truth]
+
+            entry_dict_individual = {
+                'Experiment': experiment_name,
+                'Run': run,
+                'Model': model.model_name,
+                'Prompt_Type': prompt_type,
+                'Prompt_Role': prompt_role,
+                'Prompt': prompt,
+                'Text': text,
+                'FineTuned': fine_tuned,
+                'Prediction': None if failed[run - 1, index] else result,
+                'Failed': bool(failed[run - 1, index]),
+                'Ground_Truth': ground_truth,
+                'Detection_Type': detection_type,
+                'Classification_Type': classification_type
+            }
+            all_individual_results.append(entry_dict_individual)
+
+        all_predictions.append(preds)
+
+    # majority vote over the (runs x items) prediction matrix, metrics with bootstrap confidence intervals;
+    # items whose request failed in any run are left out rather than scored as failure_value predictions
+    ground_truths = [binary2num[gt] if isinstance(gt, str) else gt for gt in ground_truths]
+    scored = ~failed.any(axis=0)
+    if not scored.all():
+        logging.warning(f"{experiment_name} ({model.model_name}): {int((~scored).sum())} of {len(scored)} items "
+                        f"left out of the scores after failed requests")
+    overall_metrics = evaluate(np.asarray(all_predictions)[:, scored], np.asarray(ground_truths)[scored])
+    votes = np.full(len(texts), -1)
+    votes[scored] = overall_metrics['predictions']
+    phrases = params.get('phrase_sentences')
+    if phrases:
+        phrases = [phrase for phrase in phrases if scored[phrase].all()]
+    drift = packing_drift(responses, ground_truths, parser, num_runs)
+    # tokens sent by this process, responses served from the cache or journal cost none
+    usage = get_usage_tracker().pop(usage_key(model, params))
+
+    entry_dict_overall = {
+        'Experiment': experiment_name,
+        'Run': num_runs,
+        'Model': model.model_name,
+        'Prompt_Type': prompt_type,
+        'Prompt_Role': prompt_role,
+        'Prompt': prompt,
+        'Fine_Tuned': fine_tuned,
+        'Classification_Type': classification_type,
+        'Detection_Type': detection_type,
+        'Accuracy': overall_metrics['accuracy'],
+        'Precision': overall_metrics['precision'],
+        'Recall': overall_metrics['recall'],
+        'F1-Score': overall_metrics['f1'],
+        'Accuracy_CI_Low': overall_metrics['accuracy_ci'][0],
+        'Accuracy_CI_High': overall_metrics['accuracy_ci'][1],
+        'Precision_CI_Low': overall_metrics['precision_ci'][0],
+        'Precision_CI_High': overall_metrics['precision_ci'][1],
+        'Recall_CI_Low': overall_metrics['recall_ci'][0],
+        'Recall_CI_High': overall_metrics['recall_ci'][1],
+        'F1_CI_Low': overall_metrics['f1_ci'][0],
+        'F1_CI_High': overall_metrics['f1_ci'][1],
+        'Run_Agreement': overall_metrics['agreement'],
+        'Phrase_Recall': phrase_recall(votes, phrases),
+        'Packing_Drift': drift,
+        'No_Runs': num_runs,
+        'Parse_Failures': parse_failures,
+        'Failed_Items': int((~scored).sum()),
+        'Requests': usage.requests,
+        'Input_Tokens': usage.input_tokens,
+        'Cached_Input_Tokens': usage.cached_tokens,
+        'Output_Tokens': usage.output_tokens
+    }
+    log_parse_failures(experiment_name, model.model_name, parse_failures, num_runs * len(texts) - int(failed.sum()))
+
+    # Save overall and individual results in CSV format
+    logging.info(
+        f'Logged overall results for experiment {experiment_name}, model: {model.model_name}, prompt: {prompt}')
+    save_results(all_individual_results, model.model_name, prompt_type, prompt_role, classification_type, fine_tuned,
+                 detection_type)
+    return entry_dict_overall
@@ -1,21 +1,185 @@
 from .base_models import BaseModel
+from helpers.rate_limiting import estimate_tokens
+from helpers.usage import record_usage, prompt_caching_config
+import datetime
+import logging
+import math
+import threading
+import time
+
 import google.generativeai as genai
+
+
+def gemini_schema(schema):
+    if isinstance(schema, dict):
+        return {key: gemini_schema(value) for key, value in schema.items() if key != 'additionalProperties'}
+    return schema
+
+
 class Gemini(BaseModel):
-    def __init__(self, api_key, model_name):
-        super().__init__(api_key=api_key, model_name=model_name)
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(model_name)
+    temperature = 0.25
+    max_tokens = 3
+    supports_multi_sample = True
+    # the prompt is sent as system instruction, responses of the old 'prompt:text' requests aren't reused
+    request_format = 'system_instruction'
+
+    def __init__(self, api_key, model_name, client=None, async_client_factory=None, **defaults):
+        super().__init__(api_key=api_key, model_name=model_name, async_client_factory=async_client_factory,
+                         **defaults)
+        self.client = client or self.build_client(api_key)
         self.product_name = 'gemini'
+        self._prompt_models = {}
+        self._context_caches = {}
+        self._prompt_models_lock = threading.Lock()
+
+    @staticmethod
+    def build_client(api_key, http=None):
+        # the SDK keeps one process-wide client configured here, it has no httpx pool to tune
+        genai.configure(api_key=api_key)
+        return genai
+
+    def create_async_client(self):
+        # the async gRPC channel is created per model instance and bound to the event loop using it,
+        # so every loop keeps its own models, one per prompt
+        return {}
+
+    def context_cache(self, prompt):
+        """
+        Explicit context cache holding prompt, for prompts long enough for Gemini to accept one
+        (gemini_min_tokens under prompt_caching in config.yml). None when the prompt is too short.
+        The cache's TTL (gemini_ttl) is extended once less than a tenth of it is left, and the cache
+        created again if that fails, so grids running longer than the TTL keep a live cache.
+        """
+        caching = prompt_caching_config()
+        if not caching.get('enabled', True):
+            return None
+        # prompt -> (cache, monotonic time after which it is refreshed)
+        entry = self._context_caches.get(prompt)
+        now = time.monotonic()
+        if entry is not None and now < entry[1]:
+            return entry[0]
+        if entry is None and estimate_tokens(prompt) < caching.get('gemini_min_tokens', 32768):
+            self._context_caches[prompt] = (None, math.inf)
+            return None
+
+        ttl = caching.get('gemini_ttl', 3600)
+        cache = entry[0] if entry is not None else None
+        if cache is not None:
+            try:
+                cache.update(ttl=datetime.timedelta(seconds=ttl))
+            except Exception as e:
+                logging.warning(f"Cannot extend the Gemini context cache, creating a new one: {e}")
+                cache = None
+        if cache is None:
+            try:
+                cache = self.client.caching.CachedContent.create(
+                    model=self.model_name,
+                    system_instruction=prompt,
+                    ttl=datetime.timedelta(seconds=ttl)
+                )
+            except Exception as e:
+                logging.warning(f"Cannot create a Gemini context cache, sending the prompt as system instruction: {e}")
+                self._context_caches[prompt] = (None, math.inf)
+                return None
+        self._context_caches[prompt] = (cache, now + ttl * 0.9)
+        return cache
 
-    def predict_single(self, text, prompt, fine_tune=False, no_labels=2, temperature=0.25):
-        result = self.model.generate_content(
-            prompt + ':' + text,
-            generation_config=genai.GenerationConfig(
-                max_output_tokens=3,
-                temperature=temperature
+    def prompt_model(self, prompt, models):
+        """
+        The model serving prompt from models (a dictionary of (context cache, model) per prompt), with
+        the prompt as its system instruction so it forms a static prefix separate from the text. The
+        model is built again when its context cache had to be recreated.
+        """
+        with self._prompt_models_lock:
+            cache = self.context_cache(prompt)
+            if prompt not in models or models[prompt][0] is not cache:
+                if cache is not None:
+                    models[prompt] = (cache, self.client.GenerativeModel.from_cached_content(cache))
+                else:
+                    models[prompt] = (None, self.client.GenerativeModel(self.model_name, system_instruction=prompt))
+            return models[prompt][1]
+
+    def generation_config(self, temperature, candidate_count=None, labels=None):
+        if labels is not None and labels.indexed:
+            # JSON list of indexed labels, Gemini's schema dialect has no additionalProperties
+            return genai.GenerationConfig(
+                max_output_tokens=self.output_tokens(labels),
+                temperature=temperature,
+                candidate_count=candidate_count,
+                response_mime_type='application/json',
+                response_schema=gemini_schema(labels.json_schema())
+            )
+        if labels is not None:
+            # enum mode, the response is exactly one of the labels
+            return genai.GenerationConfig(
+                max_output_tokens=self.max_tokens,
+                temperature=temperature,
+                candidate_count=candidate_count,
+                response_mime_type='text/x.enum',
+                response_schema={'type': 'STRING', 'enum': labels.labels}
             )
+        return genai.GenerationConfig(
+            max_output_tokens=self.max_tokens,
+            temperature=temperature,
+            candidate_count=candidate_count
         )
+
+    def output_tokens(self, labels=None):
+        # enum responses are a single label and fit in the regular output budget
+        if labels is not None and labels.indexed:
+            return labels.max_tokens
+        return self.max_tokens
+
+    @staticmethod
+    def observe_usage(result):
+        usage = getattr(result, 'usage_metadata', None)
+        if usage is not None:
+            record_usage(
+                input_tokens=getattr(usage, 'prompt_token_count', 0),
+                output_tokens=getattr(usage, 'candidates_token_count', 0),
+                cached_tokens=getattr(usage, 'cached_content_token_count', 0)
+            )
+
+    @staticmethod
+    def result_text(result):
+        """
+        Text of a response, '' when the answer was blocked (a response without a label, counted as a
+        parse failure). API errors propagate to the shared retry policy.
+        """
         try:
             return result.text
-        except Exception as e:
+        except ValueError as e:
+            logging.info(f"Gemini response without text: {e}")
             return ''
+
+    def predict_single(self, text, prompt, fine_tune=False, no_labels=2, temperature=None, labels=None):
+        temperature = self.temperature if temperature is None else temperature
+        result = self.prompt_model(prompt, self._prompt_models).generate_content(
+            text,
+            generation_config=self.generation_config(temperature, labels=labels)
+        )
+        self.observe_usage(result)
+        return self.result_text(result)
+
+    async def apredict_single(self, text, prompt, fine_tune=False, no_labels=2, temperature=None, labels=None):
+        temperature = self.temperature if temperature is None else temperature
+        result = await self.prompt_model(prompt, self.async_client).generate_content_async(
+            text,
+            generation_config=self.generation_config(temperature, labels=labels)
+        )
+        self.observe_usage(result)
+        return self.result_text(result)
+
+    async def apredict_samples(self, text, prompt, n, fine_tune=False, temperature=None, labels=None):
+        temperature = self.temperature if temperature is None else temperature
+        result = await self.prompt_model(prompt, self.async_client).generate_content_async(
+            text,
+            generation_config=self.generation_config(temperature, candidate_count=n, labels=labels)
+        )
+        self.observe_usage(result)
+        samples = []
+        for candidate in result.candidates:
+            # candidates blocked by the safety filters have no parts
+            samples.append(''.join(part.text for part in candidate.content.parts))
+        # blocked candidates may be missing entirely
+        return samples + [''] * (n - len(samples))
@@ -0,0 +1,194 @@
+from .base_models import BaseModel
+from helpers import config
+from helpers.parsing import get_parser
+from helpers.rate_limiting import estimate_tokens
+from helpers.usage import record_usage
+from helpers.streaming import LabelStream, streaming_enabled
+import asyncio
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+
+
+class MockError(Exception):
+    """
+    A failed mock request, with the status code the provider SDK errors carry.
+    """
+
+    def __init__(self, message, status_code=500, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = MockResponse(status_code, {'retry-after': str(retry_after)} if retry_after else {})
+
+
+class MockResponse:
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+
+
+class MockModel(BaseModel):
+    """
+    Local stand-in for a provider, answering without network access or API keys so that the
+    scheduler, rate limiter, caches and result logging can be exercised and benchmarked offline
+    (see benchmarks/load_test.py).
+
+    The label of a text is a deterministic function of the seed and the text, every response
+    format the wrappers produce is supported (free text, structured {"label": ...} and indexed
+    label lists). Latency, failures, 429s and streaming follow mock_provider in config.yml, free-text
+    answers can be padded with explanation_words to exercise early-stopping streams.
+    """
+    temperature = 0
+    max_tokens = 4
+    supports_multi_sample = True
+    shares_async_client = True
+    latency_distributions = ('constant', 'uniform', 'exponential', 'lognormal')
+    # used for settings missing from mock_provider in config.yml
+    default_settings = {
+        'seed': 0,
+        'latency_distribution': 'lognormal',
+        'latency_ms': 300,
+        'latency_spread': 0.5,
+        'error_rate': 0.0,
+        'rate_limit_rate': 0.0,
+        'retry_after': 1,
+        'stream_chunks': 1,
+        'explanation_words': 0,
+        'label_noise': 0.5
+    }
+
+    def __init__(self, model_name, api_key=None, client=None, async_client_factory=None, settings=None, **defaults):
+        """
+        :param settings: Overrides of the mock_provider settings in config.yml.
+        """
+        super().__init__(api_key=api_key, model_name=model_name, async_client_factory=async_client_factory,
+                         **defaults)
+        self.product_name = 'mock'
+        self.settings = {**(config.get('mock_provider') or {}), **(settings or {})}
+        if self.setting('latency_distribution') not in self.latency_distributions:
+            raise ValueError(f"Unknown latency distribution: {self.setting('latency_distribution')}")
+        self._random = random.Random(self.setting('seed'))
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def setting(self, name):
+        return self.settings.get(name, self.default_settings[name])
+
+    @staticmethod
+    def build_client(api_key, http=None):
+        return None
+
+    @staticmethod
+    def build_async_client(api_key, http=None):
+        return None
+
+    def latency(self):
+        """
+        Seconds one request takes, drawn from the configured distribution around latency_ms.
+        """
+        median = self.setting('latency_ms') / 1000
+        spread = self.setting('latency_spread')
+        distribution = self.setting('latency_distribution')
+        with self._lock:
+            if distribution == 'constant':
+                return median
+            if distribution == 'uniform':
+                return self._random.uniform(median * (1 - spread), median * (1 + spread))
+            if distribution == 'exponential':
+                return self._random.expovariate(math.log(2) / median) if median else 0
+            return self._random.lognormvariate(math.log(median), spread) if median else 0
+
+    def outcome(self):
+        """
+        Draw whether a request fails, with a 429 or another error, raising the error it fails with.
+        """
+        with self._lock:
+            self.calls += 1
+            draw = self._random.random()
+            if draw < self.setting('rate_limit_rate'):
+                self.rate_limited += 1
+                raise MockError('Mock rate limit exceeded', status_code=429, retry_after=self.setting('retry_after'))
+            if draw < self.setting('rate_limit_rate') + self.setting('error_rate'):
+                self.errors += 1
+                raise MockError('Mock server error')
+
+    def label(self, text, label_set, temperature):
+        """
+        Deterministic label of text, replaced by a random one with probability temperature * label_noise.
+        """
+        digest = hashlib.sha1(f"{self.setting('seed')}:{text}".encode('utf-8')).digest()
+        with self._lock:
+            if temperature and self._random.random() < temperature * self.setting('label_noise'):
+                return self._random.choice(label_set)
+        return label_set[digest[0] % len(label_set)]
+
+    def respond(self, text, prompt, temperature, labels=None):
+        if labels is not None and labels.indexed:
+            items = [line.split('] ', 1)[-1] for line in text.splitlines()]
+            return json.dumps({'labels': [{'index': number, 'label': self.label(item, labels.labels, temperature)}
+                                          for number, item in enumerate(items, start=1)]})
+        if labels is not None:
+            return json.dumps({'label': self.label(text, labels.labels, temperature)})
+        # free-text prompts name their label set
+        label_set = get_parser('multiclass' if 'left' in prompt.lower() else 'binary').labels
+        label = self.label(text, label_set, temperature)
+        words = self.setting('explanation_words')
+        return f"{label}. " + ' '.join(['because'] * words) if words else label
+
+    def chunks(self, response):
+        count = max(1, min(self.setting('stream_chunks'), len(response)))
+        size = math.ceil(len(response) / count)
+        return [response[start:start + size] for start in range(0, len(response), size)]
+
+    def observe_usage(self, text, prompt, response):
+        record_usage(input_tokens=estimate_tokens(prompt, text, max_tokens=0),
+                     output_tokens=estimate_tokens(response, max_tokens=0) + 1)
+
+    def predict_single(self, text, prompt, fine_tune=False, no_labels=2, temperature=None, labels=None):
+        temperature = self.temperature if temperature is None else temperature
+        latency = self.latency()
+        self.outcome()
+        response = self.respond(text, prompt, temperature, labels)
+        time.sleep(latency)
+        self.observe_usage(text, prompt, response)
+        return response
+
+    async def astream(self, text, prompt, temperature=None, labels=None):
+        """
+        Yield the response in stream_chunks pieces, half of the latency passing before the first one.
+        """
+        temperature = self.temperature if temperature is None else temperature
+        latency = self.latency()
+        self.outcome()
+        response = self.respond(text, prompt, temperature, labels)
+        chunks = self.chunks(response)
+        await asyncio.sleep(latency / 2)
+        for chunk in chunks:
+            yield chunk
+            await asyncio.sleep(latency / 2 / len(chunks))
+        self.observe_usage(text, prompt, response)
+
+    async def apredict_single(self, text, prompt, fine_tuned=False, no_labels=2, temperature=None, labels=None):
+        chunks = self.astream(text, prompt, temperature, labels)
+        stream = LabelStream(stop=streaming_enabled(labels))
+        try:
+            async for chunk in chunks:
+                if stream.feed(chunk):
+                    break
+        finally:
+            await chunks.aclose()
+        return stream.close(text, prompt, usage_recorded=not stream.stopped)
+
+    async def apredict_samples(self, text, prompt, n, fine_tuned=False, temperature=None, labels=None):
+        temperature = self.temperature if temperature is None else temperature
+        latency = self.latency()
+        self.outcome()
+        samples = [self.respond(text, prompt, temperature, labels) for _ in range(n)]
+        await asyncio.sleep(latency)
+        self.observe_usage(text, prompt, ''.join(samples))
+        return samples
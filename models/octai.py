@@ -1,17 +1,40 @@
 from .base_models import BaseModel
-from octoai.client import OctoAI
+from .registry import http_client
+from helpers.usage import record_usage
+from helpers.streaming import LabelStream, streaming_enabled
+from octoai.client import OctoAI, AsyncOctoAI
 from octoai.text_gen import ChatMessage
 import time
 
+import httpx
+
 class OctAI(BaseModel):
-    def __init__(self, model_name, api_key):
-        super().__init__(api_key=api_key, model_name=model_name)
-        self.client = OctoAI(api_key=api_key)
+    temperature = 1.5
+    max_tokens = 4
+    shares_async_client = True
+
+    def __init__(self, model_name, api_key, client=None, async_client_factory=None, **defaults):
+        super().__init__(api_key=api_key, model_name=model_name, async_client_factory=async_client_factory,
+                         **defaults)
+        # the client and its connection pool are thread-safe, every call iterates its own stream
+        self.client = client or self.build_client(api_key)
         self.product_name = 'octoai'
 
-    def predict_single(self, text, prompt, fine_tune=False, no_labels=2, temperature=1.5):
-        result = self.client.text_gen.create_chat_completion_stream(
-            max_tokens=4,
+    @staticmethod
+    def build_client(api_key, http=None):
+        return OctoAI(api_key=api_key, httpx_client=http_client(http, httpx.Client))
+
+    @staticmethod
+    def build_async_client(api_key, http=None):
+        return AsyncOctoAI(api_key=api_key, httpx_client=http_client(http, httpx.AsyncClient))
+
+    def create_async_client(self):
+        return self.build_async_client(self.api_key)
+
+    def request_params(self, text, prompt, temperature, labels=None):
+        # no structured output, but a batch of indexed labels needs its larger output budget
+        return dict(
+            max_tokens=labels.max_tokens if labels is not None and labels.indexed else self.max_tokens,
             messages=[
                 ChatMessage(
                     content=prompt,
@@ -26,5 +49,38 @@ class OctAI(BaseModel):
             presence_penalty=0,
             temperature=temperature
         )
-        response = [i.choices[0].delta.content if i.choices[0].delta.content else '' for i in result]
-        return ''.join(response)
+
+    @staticmethod
+    def observe_usage(chunk):
+        # usage arrives with the last chunk of the stream, OctoAI has no prompt caching
+        usage = getattr(chunk, 'usage', None)
+        if usage is not None:
+            record_usage(input_tokens=usage.prompt_tokens, output_tokens=usage.completion_tokens)
+
+    def predict_single(self, text, prompt, fine_tune=False, no_labels=2, temperature=None, labels=None):
+        temperature = self.temperature if temperature is None else temperature
+        result = self.client.text_gen.create_chat_completion_stream(**self.request_params(text, prompt, temperature, labels))
+        # the stream is closed at the first label unless the answer is a batch of indexed labels
+        stream = LabelStream(stop=streaming_enabled(labels))
+        try:
+            for chunk in result:
+                self.observe_usage(chunk)
+                if stream.feed(chunk.choices[0].delta.content):
+                    break
+        finally:
+            result.close()
+        return stream.close(text, prompt, usage_recorded=not stream.stopped)
+
+    async def apredict_single(self, text, prompt, fine_tune=False, no_labels=2, temperature=None, labels=None):
+        temperature = self.temperature if temperature is None else temperature
+        result = self.async_client.text_gen.create_chat_completion_stream(
+            **self.request_params(text, prompt, temperature, labels))
+        stream = LabelStream(stop=streaming_enabled(labels))
+        try:
+            async for chunk in result:
+                self.observe_usage(chunk)
+                if stream.feed(chunk.choices[0].delta.content):
+                    break
+        finally:
+            await result.aclose()
+        return stream.close(text, prompt, usage_recorded=not stream.stopped)
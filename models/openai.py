@@ -1,12 +1,33 @@
 from .base_models import BaseModel
-from openai import OpenAI
+from .registry import http_client
+from helpers.usage import record_usage
+from helpers.streaming import LabelStream, streaming_enabled
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 class ChatGPTPrompt(BaseModel):
-    def __init__(self, model_name, api_key):
-        super().__init__(model_name=model_name, api_key=api_key)
-        self.client = OpenAI(api_key=api_key)
+    temperature = 0.8
+    supports_multi_sample = True
+    shares_async_client = True
+
+    def __init__(self, model_name, api_key, client=None, async_client_factory=None, **defaults):
+        super().__init__(model_name=model_name, api_key=api_key, async_client_factory=async_client_factory,
+                         **defaults)
+        self.client = client or self.build_client(api_key)
         self.product_name = 'chatgpt'
-    def predict_single(self, text, prompt, fine_tuned=False, no_labels=2, temperature=0.8):
-        completion = self.client.chat.completions.create(
+
+    @staticmethod
+    def build_client(api_key, http=None):
+        # retries are left to the shared resilience policy
+        return OpenAI(api_key=api_key, max_retries=0, http_client=http_client(http, DefaultHttpxClient))
+
+    @staticmethod
+    def build_async_client(api_key, http=None):
+        return AsyncOpenAI(api_key=api_key, max_retries=0, http_client=http_client(http, DefaultAsyncHttpxClient))
+
+    def create_async_client(self):
+        return self.build_async_client(self.api_key)
+
+    def request_params(self, text, prompt, temperature, labels=None):
+        params = dict(
             model=self.model_name,
             messages=[
                 {"role": "system", "content": prompt},
@@ -14,4 +35,98 @@ class ChatGPTPrompt(BaseModel):
             ],
             temperature=temperature
         )
+        if labels is not None:
+            # strict JSON schema output, the answer is {"label": <one of the labels>}
+            params['response_format'] = {
+                'type': 'json_schema',
+                'json_schema': {'name': f'{labels.name}_label', 'schema': labels.json_schema(), 'strict': True}
+            }
+            params['max_tokens'] = self.output_tokens(labels)
+        return params
+
+    @staticmethod
+    def observe_usage(completion):
+        # prompts of 1024+ tokens are cached automatically, the system prompt is the shared prefix
+        usage = getattr(completion, 'usage', None)
+        if usage is not None:
+            details = getattr(usage, 'prompt_tokens_details', None)
+            record_usage(
+                input_tokens=usage.prompt_tokens,
+                output_tokens=usage.completion_tokens,
+                cached_tokens=getattr(details, 'cached_tokens', 0) or 0
+            )
+
+    def batch_request(self, request_id, text, prompt, temperature=None, labels=None):
+        temperature = self.temperature if temperature is None else temperature
+        return {'custom_id': request_id, 'method': 'POST', 'url': '/v1/chat/completions',
+                'body': self.request_params(text, prompt, temperature, labels)}
+
+    def stream_params(self, text, prompt, temperature):
+        # the usage arrives in a last chunk without choices, unless the stream is closed before it
+        return dict(self.request_params(text, prompt, temperature), stream=True, stream_options={'include_usage': True})
+
+    def stream_chunk(self, chunk, stream):
+        """
+        Take in one streamed chunk, returns True once the stream can be closed.
+        """
+        if chunk.usage is not None:
+            self.observe_usage(chunk)
+        return bool(chunk.choices) and stream.feed(chunk.choices[0].delta.content)
+
+    def predict_stream(self, text, prompt, temperature):
+        raw = self.client.chat.completions.with_raw_response.create(**self.stream_params(text, prompt, temperature))
+        self.observe_rate_limit_headers(raw.headers)
+        chunks = raw.parse()
+        stream = LabelStream()
+        try:
+            for chunk in chunks:
+                if self.stream_chunk(chunk, stream):
+                    break
+        finally:
+            chunks.close()
+        return stream.close(text, prompt, usage_recorded=not stream.stopped)
+
+    async def apredict_stream(self, text, prompt, temperature):
+        raw = await self.async_client.chat.completions.with_raw_response.create(
+            **self.stream_params(text, prompt, temperature))
+        self.observe_rate_limit_headers(raw.headers)
+        chunks = raw.parse()
+        stream = LabelStream()
+        try:
+            async for chunk in chunks:
+                if self.stream_chunk(chunk, stream):
+                    break
+        finally:
+            await chunks.close()
+        return stream.close(text, prompt, usage_recorded=not stream.stopped)
+
+    def predict_single(self, text, prompt, fine_tuned=False, no_labels=2, temperature=None, labels=None):
+        temperature = self.temperature if temperature is None else temperature
+        if streaming_enabled(labels):
+            return self.predict_stream(text, prompt, temperature)
+        raw = self.client.chat.completions.with_raw_response.create(
+            **self.request_params(text, prompt, temperature, labels))
+        self.observe_rate_limit_headers(raw.headers)
+        completion = raw.parse()
+        self.observe_usage(completion)
         return completion.choices[0].message.content
+
+    async def apredict_single(self, text, prompt, fine_tuned=False, no_labels=2, temperature=None, labels=None):
+        temperature = self.temperature if temperature is None else temperature
+        if streaming_enabled(labels):
+            return await self.apredict_stream(text, prompt, temperature)
+        raw = await self.async_client.chat.completions.with_raw_response.create(
+            **self.request_params(text, prompt, temperature, labels))
+        self.observe_rate_limit_headers(raw.headers)
+        completion = raw.parse()
+        self.observe_usage(completion)
+        return completion.choices[0].message.content
+
+    async def apredict_samples(self, text, prompt, n, fine_tuned=False, temperature=None, labels=None):
+        temperature = self.temperature if temperature is None else temperature
+        raw = await self.async_client.chat.completions.with_raw_response.create(
+            n=n, **self.request_params(text, prompt, temperature, labels))
+        self.observe_rate_limit_headers(raw.headers)
+        completion = raw.parse()
+        self.observe_usage(completion)
+        return [choice.message.content for choice in sorted(completion.choices, key=lambda c: c.index)]
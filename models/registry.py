@@ -0,0 +1,128 @@
+import asyncio
+import importlib
+import os
+import threading
+import weakref
+
+from helpers import config
+
+# provider -> (wrapper module, wrapper class, API key environment variable)
+PROVIDERS = {
+    'chatgpt': ('models.openai', 'ChatGPTPrompt', 'OPENAI_API_KEY'),
+    'gemini': ('models.gemini', 'Gemini', 'GEMINI_API_KEY'),
+    'claudeai': ('models.anthropic', 'ClaudeAI', 'ANTHROPIC_API_KEY'),
+    'octoai': ('models.octai', 'OctAI', 'OCTAI_API_KEY'),
+    # local stand-in for offline runs and benchmarks, needs no API key
+    'mock': ('models.mock', 'MockModel', None),
+}
+
+
+def http_client(settings, client_class):
+    """
+    Pooled HTTP client for an SDK client, None leaves the SDK's default client in place.
+
+    :param client_class: The HTTP client class the SDK accepts, e.g. its DefaultHttpxClient.
+    """
+    if not settings:
+        return None
+    # SDKs pin their own httpx flavour, the pool limits have to come from the same package
+    base = next(base for base in client_class.__mro__ if base.__name__ in ('Client', 'AsyncClient'))
+    package = importlib.import_module(base.__module__.split('.')[0])
+    limits = package.Limits(
+        max_connections=settings.get('max_connections', 100),
+        max_keepalive_connections=settings.get('max_keepalive_connections', 20),
+        keepalive_expiry=settings.get('keepalive_expiry', 30)
+    )
+    return client_class(limits=limits, timeout=settings.get('timeout', 60))
+
+
+class ModelRegistry:
+    """
+    Builds each provider's SDK client lazily, once per process, and hands out model wrappers that
+    share it.
+
+    The sync clients (and their connection pools) are shared by every wrapper and thread using the
+    provider; async clients are shared per event loop, since async connection pools cannot cross
+    loops. Wrappers are cached by provider, model name and default generation parameters, so asking
+    twice for the same configuration returns the same instance.
+    """
+
+    def __init__(self, http=None, api_keys=None):
+        """
+        :param http: Connection pool settings (max_connections, max_keepalive_connections,
+                     keepalive_expiry, timeout), defaults to http_clients in config.yml.
+        :param api_keys: Dictionary mapping providers to API keys, others are read from the environment.
+        """
+        self.http = http if http is not None else config.get('http_clients') or {}
+        self.api_keys = dict(api_keys or {})
+        self._lock = threading.RLock()
+        self._clients = {}
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._models = {}
+
+    def wrapper_class(self, provider):
+        if provider not in PROVIDERS:
+            raise ValueError(f"Unknown provider: {provider}")
+        module, class_name, _ = PROVIDERS[provider]
+        return getattr(importlib.import_module(module), class_name)
+
+    def api_key(self, provider):
+        with self._lock:
+            if provider not in self.api_keys:
+                variable = PROVIDERS[provider][2]
+                self.api_keys[provider] = os.environ[variable] if variable else None
+            return self.api_keys[provider]
+
+    def client(self, provider):
+        with self._lock:
+            if provider not in self._clients:
+                self._clients[provider] = self.wrapper_class(provider).build_client(self.api_key(provider), self.http)
+            return self._clients[provider]
+
+    def async_client(self, provider):
+        """
+        The provider's async client on the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            if provider not in clients:
+                clients[provider] = self.wrapper_class(provider).build_async_client(self.api_key(provider), self.http)
+            return clients[provider]
+
+    def model(self, provider, model_name, **defaults):
+        """
+        Return the wrapper of model_name on provider, built on first use.
+
+        :param defaults: Default generation parameters of the wrapper (temperature, max_tokens).
+        """
+        key = (provider, model_name, tuple(sorted(defaults.items())))
+        with self._lock:
+            if key not in self._models:
+                wrapper_class = self.wrapper_class(provider)
+                async_client_factory = None
+                if wrapper_class.shares_async_client:
+                    async_client_factory = lambda: self.async_client(provider)
+                self._models[key] = wrapper_class(
+                    model_name=model_name,
+                    api_key=self.api_key(provider),
+                    client=self.client(provider),
+                    async_client_factory=async_client_factory,
+                    **defaults
+                )
+            return self._models[key]
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    Return the process-wide model registry.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+        return _registry
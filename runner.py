@@ -1,15 +1,9 @@
 import time
 
-import yaml
-import os
 import logging
-import pandas as pd
 from datetime import datetime
 
-from models.openai import ChatGPTPrompt
-from models.gemini import Gemini
-from models.octai import OctAI
-from models.anthropic import ClaudeAI
+from models.registry import get_registry
 
 from helpers.helpers import *
 from helpers.result_logging import *
@@ -18,92 +12,136 @@ from data_preparation.data_loading import *
 from config_handler import ConfigHandler
 
 EXPERIMENTS_YAML = "experiments.yml"
-experiments = ConfigHandler.load_config(EXPERIMENTS_YAML)
-
-# Initialize models
-models = {
-    'chatgpt': ChatGPTPrompt(model_name=experiments['models']['chatgpt'], api_key=os.environ['OPENAI_API_KEY']),
-    'gemini': Gemini(model_name=experiments['models']['gemini'], api_key=os.environ['GEMINI_API_KEY']),
-    'claude': ClaudeAI(api_key=os.environ['ANTHROPIC_API_KEY'], model_name=experiments['models']['claudeai']),
-    'llama': OctAI(api_key=os.environ['OCTAI_API_KEY'], model_name=experiments['models']['llama']),
+experiments = ConfigHandler.get_config(EXPERIMENTS_YAML)
+
+# Models: name -> (provider, key of the model name in the models section of experiments.yml)
+models_spec = {
+    'chatgpt': ('chatgpt', 'chatgpt'),
+    'gemini': ('gemini', 'gemini'),
+    'claude': ('claudeai', 'claudeai'),
+    'llama': ('octoai', 'llama'),
 }
 
-rate_limit_timeout = {
-    'chatgpt': 0.5,
-    'gemini': 0.5,
-    'octoai': 1,
-    'claudeai': 1.2
-}
+
+def get_models(providers=None):
+    """
+    Get the model wrappers from the shared registry, only building the clients of `providers` (all by default).
+    """
+    registry = get_registry()
+    return {
+        name: registry.model(provider, experiments['models'][model_key])
+        for name, (provider, model_key) in models_spec.items()
+        if providers is None or provider in providers
+    }
 
 def load_experiments_config(yaml_file):
-    with open(yaml_file, 'r') as file:
-        return yaml.safe_load(file)
+    return ConfigHandler.get_config(yaml_file)
 
 
 def run_experiment(params,model):
     # Placeholder function: implement the actual experiment run here
-    # Call the model's `run_experiment` method with the provided parameters
-    sleep_time = rate_limit_timeout[model.product_name]
-    results = model.run_experiment(params,sleep_time=sleep_time)
+    # Call the model's `run_experiment` method with the provided parameters,
+    # throttling is handled by the provider's shared rate limiter (rate_limits in config.yml)
+    results = model.run_experiment(params)
     return results
 
 
 import concurrent.futures
 from datetime import datetime
 
-
-def run_batch_experiments(articles, anns, models, batch_config):
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        tasks = []
+from helpers.scheduler import ProviderScheduler
+from models.batch_jobs import BatchJobRunner
+from models.experiments import experiment_job
+from helpers.sentences import sentence_params, sentence_prompt, sentences_per_request
+from helpers.telemetry import get_telemetry
+
+
+def detection_data(articles, anns, sentences, batch_config):
+    """
+    Experiment parameters of each detection type in the batch section, sentences is the
+    (articles, sentence labels, phrases) tuple of get_sentence_data.
+    """
+    data = {}
+    for detection_type in batch_config.get('detection_types', ['article']):
+        if detection_type == 'sentence':
+            data['sentence'] = sentence_params(*sentences, sentences_per_request(batch_config))
+        else:
+            data['article'] = {'texts': articles, 'ground_truths': anns, 'detection_type': 'article'}
+    return data
+
+
+def batch_experiment_params(articles, anns, models, batch_config, sentences=None):
+    """
+    Expand the batch section of experiments.yml into (model, params) pairs.
+    """
+    experiments = []
+    for detection_type, data in detection_data(articles, anns, sentences, batch_config).items():
         for prompt_type in batch_config['prompt_types']:
             for prompt_role in batch_config['prompt_roles']:
                 for response_type in batch_config['response_types']:
                     for model_name, model in models.items():
                         for fine_tuned in [False]:
-                            if model.product_name != 'octoai': continue
+                            if model.product_name not in batch_config.get('providers', [model.product_name]): continue
                             # Create params for the experiment
-                            experiment_name = generate_experiment_name(prompt_type, 'article', prompt_role, response_type)
+                            experiment_name = generate_experiment_name(prompt_type, detection_type, prompt_role, response_type)
                             prompt = prepare_prompt(prompt_type,prompt_role,response_type)
+                            if detection_type == 'sentence':
+                                prompt = sentence_prompt(prompt)
                             params = {
                                 'experiment_name': experiment_name,
                                 'prompt': prompt,
                                 'prompt_type': prompt_type,
                                 'prompt_role': prompt_role,
-                                'texts': articles,
-                                'ground_truths': anns,
-                                'detection_type': 'article',
                                 'num_runs': batch_config.get('num_runs', 3),
+                                'multi_sample': batch_config.get('multi_sample', False),
+                                'structured_output': batch_config.get('structured_output'),
+                                'pack_tokens': batch_config.get('pack_tokens'),
                                 'fine_tuned': fine_tuned,
-                                'classification_type': response_type
+                                'classification_type': response_type,
+                                **data
                             }
+                            experiments.append((model, params))
+    return experiments
 
-                            # Submit the experiment to be run in a separate thread
-                            task = executor.submit(run_experiment, params, model)
-                            tasks.append(task)
 
-        # Process the results as they complete
-        for task in concurrent.futures.as_completed(tasks):
-            try:
-                results = task.result()
-                log_overall_results( {
-                                        'Experiment': results['Experiment'],
-                                        'Run': results['Run'],
-                                        'Model': results['Model'],
-                                        'Prompt_Type': results['Prompt_Type'],
-                                        'Prompt_Role': results['Prompt_Role'],
-                                        'Prompt': results['Prompt'],
-                                        'Fine_Tuned': results['Fine_Tuned'],
-                                        'Classification_Type': results['Classification_Type'],
-                                        'Detection_Type': results['Detection_Type'],
-                                        'Accuracy': results['Accuracy'],
-                                        'Precision': results['Precision'],
-                                        'Recall': results['Recall'],
-                                        'F1-Score': results['F1-Score'],
-                                        'No_Runs': results['No_Runs'],
-                                    })
-            except Exception as e:
-                logging.error(f"Error running batch experiment: {e}")
+def log_experiment(job, results):
+    # Log the overall results of an experiment as soon as it completes
+    if isinstance(results, Exception):
+        logging.error(f"Error running batch experiment {job.name}: {results}")
+        return
+    log_batch_results(results)
+
+
+def log_batch_results(results):
+    log_overall_results(overall_row(results))
+
+
+def run_batch_experiments(articles, anns, models, batch_config, sentences=None):
+    # Every experiment is broken into individual requests that are queued per provider, so all
+    # providers run in parallel and experiments on the same provider share its capacity fairly
+    scheduler = ProviderScheduler()
+    for model, params in batch_experiment_params(articles, anns, models, batch_config, sentences):
+        scheduler.add(experiment_job(model, params))
+    scheduler.run(on_complete=log_experiment)
+
+
+def run_batch_job_experiments(articles, anns, models, batch_config, sentences=None):
+    """
+    Run the batch grid through the providers' asynchronous batch endpoints. Experiments on providers
+    without a batch endpoint fall back to the online scheduler.
+    """
+    experiments = batch_experiment_params(articles, anns, models, batch_config, sentences)
+    batch_runner = BatchJobRunner(experiments)
+    batchable = {id(params) for _, _, params in batch_runner.batchable()}
+
+    scheduler = ProviderScheduler()
+    for model, params in experiments:
+        if id(params) not in batchable:
+            scheduler.add(experiment_job(model, params))
+    scheduler.run(on_complete=log_experiment)
+
+    for model, params, results in batch_runner.run():
+        log_batch_results(results)
 
 
 def run_specific_experiments(articles, anns, models, specific_config):
@@ -162,22 +200,42 @@ def run_specific_experiments(articles, anns, models, specific_config):
                 logging.error(f"Error running specific experiment: {e}")
 
 
+def load_batch_data(config, articles_path='../BASIL/articles', annotations_path='../BASIL/annotations'):
+    """
+    Articles and annotations of the experiments in config (experiments.yml), and the sentence data
+    when the batch section has sentence-level experiments.
+    """
+    articles, anns = get_data(articles_path, annotations_path, random_state=config.get('random_state'))
+    sentences = None
+    if 'sentence' in (config.get('batch') or {}).get('detection_types', ['article']):
+        sentences = get_sentence_data(articles_path, annotations_path, random_state=config.get('random_state'))
+    return articles, anns, sentences
+
+
 def main():
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
     config = load_experiments_config(EXPERIMENTS_YAML)
-    articles_path = '../BASIL/articles'
-    annotations_path = '../BASIL/annotations'
-    articles, anns = get_data(articles_path, annotations_path)
+    articles, anns, sentences = load_batch_data(config)
     if 'batch' in config:
-        logging.info('Running batch experiments...')
-        run_batch_experiments(articles, anns,models, config['batch'])
+        models = get_models(config['batch'].get('providers'))
+        if config['batch'].get('execution_mode', 'online') == 'batch':
+            logging.info('Running batch experiments through provider batch jobs...')
+            run_batch_job_experiments(articles, anns, models, config['batch'], sentences)
+        else:
+            logging.info('Running batch experiments...')
+            run_batch_experiments(articles, anns,models, config['batch'], sentences)
     # TODO: test this function
     if 'specific' in config:
         pass
     #     run_specific_experiments(articles, anns, models, config['specific'])
 
+    # write out every buffered result before exiting
+    get_result_sink().close()
+    if get_telemetry().enabled:
+        get_telemetry().export()
+
 
 if __name__ == "__main__":
     main()
@@ -1,46 +1,34 @@
 import random
 import os
 import csv
-import concurrent.futures
-import sys
-import time
+import json
+import math
 
-from sklearn.metrics import accuracy_score, precision_score
+import numpy as np
 
-from config_handler import ConfigHandler
-
-from models.openai import ChatGPTPrompt
-from models.octai import OctAI
-from models.gemini import Gemini
+from models.registry import get_registry
 
+from helpers import config
 from helpers.helpers import *
 from helpers.result_logging import *
+from helpers.scheduler import Job, ProviderScheduler
+from helpers.checkpoint import get_journal, experiment_key, text_hash
+from helpers.parsing import get_parser, log_parse_failures
+from helpers.metrics import classification_metrics, bootstrap_ci, metric_settings, paired_p_value
+from helpers.usage import get_usage_tracker, usage_scope
+from helpers.telemetry import get_telemetry, telemetry_scope
+from helpers.streaming import stream_labels
 
 from data_preparation.data_loading import *
-# Binary mapping
-binary2num = {
-    'biased': 1,
-    'nonbiased': 0,
-    'center': 0,
-    'left': 1,
-    'right': 1,
-    'none': 0
-}
-
 # Configuration
+# name -> (provider, model name), built once through the shared model registry
 models = {
-    'ChatGPTPrompt': lambda: ChatGPTPrompt(model_name='gpt-4o-mini', api_key=os.environ['OPENAI_API_KEY']),
-    'Llama_Qwen': lambda: OctAI(model_name='qwen2-7b-instruct', api_key=os.environ['OCTAI_API_KEY']),
-    'Llama_Meta': lambda: OctAI(model_name='meta-llama-3.1-70b-instruct', api_key=os.environ['OCTAI_API_KEY']),
-    'Gemini': lambda: Gemini(api_key=os.environ['GEMINI_API_KEY'], model_name='gemini-1.5-flash')
+    'ChatGPTPrompt': ('chatgpt', 'gpt-4o-mini'),
+    'Llama_Qwen': ('octoai', 'qwen2-7b-instruct'),
+    'Llama_Meta': ('octoai', 'meta-llama-3.1-70b-instruct'),
+    'Gemini': ('gemini', 'gemini-1.5-flash')
 }
 
-rate_limit_timeout = {
-    'ChatGPTPrompt': 2,
-    'Llama_Qwen': 2,
-    'Llama_Meta': 2,
-    'Gemini': 2
-}
 temperatures = [0.0, 0.25, 0.5, 0.75, 1.0]
 
 # Output directory setup
@@ -49,75 +37,255 @@ os.makedirs(base_dir, exist_ok=True)
 
 
 # Execution function
-def execute_model(model_name, temperature, run_idx, texts, annotations, prompt):
-    model = models[model_name]()
-    sampled_indices = random.sample(range(len(texts)), 100)
-    sampled_texts = [texts[i] for i in sampled_indices]
-    sampled_annotations = [annotations[i] for i in sampled_indices]
+def sweep_settings():
+    """
+    The temperature_sweep section of config.yml: 'fixed' sampling scores sample_size items per cell,
+    'sequential' sampling scores chunks of items until the cell's result is clear.
+    """
+    settings = {'sampling': 'fixed', 'seed': 42, 'sample_size': 100, 'chunk_size': 20, 'min_items': 40,
+                'max_items': 300, 'ci_width': 0.1, 'alpha': 0.05, 'reference_temperature': 0.0}
+    settings.update(config.get('temperature_sweep') or {})
+    return settings
+
+
+def sample_manifest(texts, run_idx, seed):
+    """
+    The order in which run `run_idx` samples the items, shared by every temperature and model so
+    their cells are scored on the same items. The manifest is written to base_dir/manifests and
+    reused while the seed and the items it lists are unchanged.
+
+    :return: List of item indices into texts.
+    """
+    manifest_file = os.path.join(base_dir, 'manifests', f'run_{run_idx}.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        if manifest['seed'] == seed and all(
+                index < len(texts) and text_hash(texts[index]) == item_hash
+                for index, item_hash in zip(manifest['items'], manifest['text_hashes'])):
+            return manifest['items']
+        logging.warning(f'{manifest_file} does not match the seed or the data, sampling a new manifest')
+
+    items = random.Random(f'{seed}-{run_idx}').sample(range(len(texts)), len(texts))
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    with open(manifest_file, 'w') as f:
+        json.dump({'seed': seed, 'run': run_idx, 'items': items,
+                   'text_hashes': [text_hash(texts[index]) for index in items]}, f)
+    return items
 
+
+def stored_predictions(output_file, texts):
+    """
+    Predictions of a cell's results file, by position in the manifest, for the rows whose text is
+    still the manifest's item at that position.
+    """
+    if not os.path.exists(output_file):
+        return {}
+    with open(output_file, 'r') as f:
+        rows = list(csv.DictReader(f))
+    # rows of failed requests have no prediction, they are sent again
+    return {position: int(row['Prediction']) for position, row in enumerate(rows)
+            if position < len(texts) and row['Text'] == texts[position] and row['Prediction'] != ''}
+
+
+def sweep_job(model, model_name, run_idx, texts, annotations, prompt, temperatures=temperatures, settings=None):
+    """
+    Build the scheduler job for one run of one model over every temperature. All temperatures
+    score the items of the run's manifest in the same order.
+
+    With fixed sampling each temperature's cell scores the first sample_size items. With
+    sequential sampling every cell starts with min_items and takes chunk_size more until its
+    accuracy's confidence interval is at most ci_width wide, its accuracy differs significantly
+    from the reference temperature's on the same items (exact McNemar test), or it reaches
+    max_items. The significance level is alpha divided by the number of looks a cell can take,
+    so stopping at the first significant look keeps the false positive rate at alpha. The
+    reference temperature keeps sampling while another cell needs it for the comparison.
+
+    Items with a prediction in the cell's results file or a response in the request journal are
+    not sent again.
+    """
+    settings = settings or sweep_settings()
+    sequential = settings['sampling'] == 'sequential'
+    order = sample_manifest(texts, run_idx, settings['seed'])
+    limit = min(len(order), settings['max_items'] if sequential else settings['sample_size'])
+    item_texts = [texts[index] for index in order[:limit]]
+    item_annotations = [annotations[index] for index in order[:limit]]
+    first = min(limit, settings['min_items'] if sequential else settings['sample_size'])
+    looks = max(1, math.ceil((limit - first) / settings['chunk_size']) + 1)
+    alpha = settings['alpha'] / looks
+    reference = settings['reference_temperature'] if settings['reference_temperature'] in temperatures else None
+
+    parser = get_parser('binary')
+    journal = get_journal()
+    # the whole manifest, so entries past this sweep's limit still match their items
+    manifest_texts = [texts[index] for index in order]
     model_dir = os.path.join(base_dir, model_name)
-    output_file_name = f"{model_name}_temp_{temperature}_run_{run_idx}.csv"
-    output_file = os.path.join(model_dir, output_file_name)
-
-    predictions = []
-    progress = 1
-    run_completed = False
-    if os.path.exists(output_file):
-        with open(output_file, 'r') as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
-            total_rows = len(rows)
-            if total_rows == 100:
-                logging.info(f'{output_file_name} already exists, fetching predictions')
-                run_completed = True
-                for row in rows:
-                    pred = int(row['Prediction'])
-                    predictions.append(pred)
+    cells = {}
+    for temperature in temperatures:
+        output_file_name = f"{model_name}_temp_{temperature}_run_{run_idx}.csv"
+        # runs sample different items, so each run is its own experiment in the journal
+        journal_key = experiment_key({'experiment_name': f'temperature_{temperature}_run_{run_idx}', 'prompt': prompt})
+        completed = {}
+        if journal is not None:
+            completed = {index: response for (run, index), response
+                         in journal.completed(journal_key, model.model_name, manifest_texts).items()
+                         if run == run_idx and index < limit}
+        cells[temperature] = {
+            'output_file_name': output_file_name,
+            'output_file': os.path.join(model_dir, output_file_name),
+            'journal_key': journal_key,
+            'usage_key': (journal_key, model.model_name, run_idx),
+            'completed': completed,
+            # position -> prediction, None for failed requests
+            'predictions': stored_predictions(os.path.join(model_dir, output_file_name), item_texts),
+            'parse_failures': 0,
+            'evaluated': 0,
+            'stop': None,
+            'p_value': np.nan
+        }
+
+    def request(temperature, index, text):
+        cell = cells[temperature]
+
+        async def send():
+            with usage_scope(cell['usage_key']), telemetry_scope(provider=model.product_name, model=model.model_name,
+                                                                 experiment=f'temperature_{temperature}'), \
+                    stream_labels(parser):
+                result, _ = await model.acached_predict(text, prompt, temperature=temperature, sample=run_idx)
+            if journal is not None and result:
+                journal.record(cell['journal_key'], model.model_name, run_idx, index, text, result)
+            return {(temperature, index): result}
+        return send
+
+    def absorb(responses):
+        # parse the responses of the requests sent since the last round
+        for temperature, cell in cells.items():
+            new = {index: response for (t, index), response in responses.items()
+                   if t == temperature and index not in cell['predictions']}
+            new.update({index: response for index, response in cell['completed'].items()
+                        if index < cell['evaluated'] and index not in cell['predictions']})
+            if not new:
+                continue
+            labels = parser.parse_many(list(new.values()))
+            values, _ = parser.to_values(labels)
+            for (index, response), label, value in zip(new.items(), labels, values):
+                # failed requests are left out of the scores instead of counting as failure_value predictions
+                cell['predictions'][index] = None if response is None else value
+                cell['parse_failures'] += label is None and response is not None
+
+    def scored(temperature, positions):
+        predictions = cells[temperature]['predictions']
+        return [index for index in positions if predictions.get(index) is not None]
+
+    def correct(temperature, positions):
+        predictions = cells[temperature]['predictions']
+        return np.array([predictions[index] == item_annotations[index] for index in positions], dtype=bool)
+
+    def compare(temperature):
+        # p-value of the cell's accuracy against the reference's on the items both scored
+        cell = cells[temperature]
+        common = scored(reference, scored(temperature, range(cell['evaluated'])))
+        return paired_p_value(correct(temperature, common), correct(reference, common)) if common else np.nan
+
+    def decide(temperature):
+        cell = cells[temperature]
+        if not sequential:
+            return 'fixed'
+        if cell['evaluated'] >= limit:
+            return 'max_items'
+        items = scored(temperature, range(cell['evaluated']))
+        if items:
+            low, high = bootstrap_ci([item_annotations[index] for index in items],
+                                     [cells[temperature]['predictions'][index] for index in items],
+                                     **metric_settings())['accuracy']
+            if high - low <= settings['ci_width']:
+                return 'ci_width'
+        if reference is not None and temperature != reference:
+            cell['p_value'] = compare(temperature)
+            if cell['p_value'] < alpha:
+                return 'significant'
+        return None
+
+    def next_requests(responses):
+        """
+        Score the round that just completed, stop the cells whose result is clear and return the
+        requests of the next round, if any.
+        """
+        while True:
+            absorb(responses)
+            # cells that have scored a round, or have nothing to score
+            active = [temperature for temperature, cell in cells.items()
+                      if (cell['evaluated'] > 0 or limit == 0) and cell['stop'] is None]
+            for temperature in active:
+                if temperature != reference:
+                    cells[temperature]['stop'] = decide(temperature)
+            if reference in active:
+                others = any(cell['stop'] is None for temperature, cell in cells.items() if temperature != reference)
+                if not others or cells[reference]['evaluated'] >= limit:
+                    cells[reference]['stop'] = decide(reference)
+
+            active = [temperature for temperature, cell in cells.items() if cell['stop'] is None]
+            if not active:
+                return []
+            if all(cell['evaluated'] == 0 for cell in cells.values()):
+                target = first
             else:
-                run_completed = False
-
-    if not run_completed:
-        print(f"Model:{output_file_name} being executed")
-        for text in sampled_texts:
-            # if we need to slow down to prevent api hit limits then sleep
-            time.sleep(rate_limit_timeout[model_name])
-
-            result = model.predict_single(text, prompt=prompt, temperature=temperature)
-            word = extract_single_word(result)
-            predictions.append(int(binary2num.get(word, 0)))
-            logging.info(f'{model_name} Run {run_idx}: {progress}/100 ')
-            progress += 1
-
-    try:
-        accuracy = accuracy_score(sampled_annotations, predictions)
-        precision = precision_score(sampled_annotations, predictions)
-    except ValueError:
-        logging.error(f'{model_name} Run {run_idx}: Accuracy score is incorrect')
-        logging.info(f"Preds: {predictions}, anns:{sampled_annotations}")
-        sys.exit(1)
-    # Save individual results
-
-    os.makedirs(model_dir, exist_ok=True)
-    with open(output_file, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['Text', 'Annotation', 'Prediction'])
-        writer.writerows(zip(sampled_texts, sampled_annotations, predictions))
+                target = min(limit, max(cells[temperature]['evaluated'] for temperature in active)
+                             + settings['chunk_size'])
+            requests = []
+            for temperature in active:
+                cell = cells[temperature]
+                # the reference scores at least the items of every cell still compared to it
+                start, cell['evaluated'] = cell['evaluated'], target
+                requests.extend(request(temperature, index, item_texts[index]) for index in range(start, target)
+                                if index not in cell['predictions'] and index not in cell['completed'])
+            if requests:
+                if target > first:
+                    logging.info(f"{model_name} run {run_idx}: sampling up to {target} items at "
+                                 f"temperatures {', '.join(str(temperature) for temperature in active)}")
+                return requests
+            responses = {}
+
+    def finalize(responses):
+        absorb(responses)
+        os.makedirs(model_dir, exist_ok=True)
+        rows = []
+        for temperature, cell in cells.items():
+            positions = range(cell['evaluated'])
+            predictions = [cell['predictions'].get(index) for index in positions]
+            log_parse_failures(cell['output_file_name'], model.model_name, cell['parse_failures'],
+                               sum(prediction is not None for prediction in predictions))
+            items = scored(temperature, positions)
+            failed = cell['evaluated'] - len(items)
+            if failed:
+                logging.warning(f"{cell['output_file_name']}: {failed} failed requests left out of the scores")
+            scored_annotations = [item_annotations[index] for index in items]
+            scored_predictions = [cell['predictions'][index] for index in items]
+            scores = classification_metrics(scored_annotations, scored_predictions)
+            accuracy_ci = bootstrap_ci(scored_annotations, scored_predictions, **metric_settings())['accuracy']
+            if reference is not None and temperature != reference:
+                cell['p_value'] = compare(temperature)
+
+            # Save individual results
+            with open(cell['output_file'], mode='w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(['Text', 'Annotation', 'Prediction'])
+                writer.writerows(zip(item_texts, item_annotations, predictions))
 
-    return model_name, temperature, run_idx, accuracy, precision
+            usage = get_usage_tracker().pop(cell['usage_key'])
+            rows.append((model_name, temperature, run_idx, scores['accuracy'], scores['precision'], *accuracy_ci,
+                         usage.input_tokens, usage.cached_tokens, failed, cell['evaluated'], cell['stop'],
+                         cell['p_value']))
+        return rows
+
+    print(f"Model:{model_name} run {run_idx} being executed")
+    return Job(name=f"{model_name}_run_{run_idx}", provider=model.product_name, requests=next_requests({}),
+               finalize=finalize, extend=next_requests)
 
 if __name__ == '__main__':
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
 
-    try:
-        config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'media-bias-llm/config.yml')
-        config = ConfigHandler.load_config(config_path)
-    except FileNotFoundError:
-        print("'config.yml' not found")
-        sys.exit(1)
-    except Exception as e:
-        print(e)
-
     # Main execution loop
     articles_path = '../BASIL/articles'
     annotations_path = '../BASIL/annotations'
@@ -126,19 +294,29 @@ if __name__ == '__main__':
     role = config['variables']['prompt']['roles'][0]
     prompt = prepare_prompt('role', role, 'binary')
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for temperature in temperatures:
-            for run_idx in range(1, 4):  # Run 3 times per temperature
-                for model_name in models:
-                    futures.append(executor.submit(execute_model, model_name, temperature, run_idx, articles, annotations, prompt))
+    # One model instance per configuration, sharing one client per provider. Every cell is queued on
+    # its provider so the providers run in parallel and the cells of one provider share its capacity
+    registry = get_registry()
+    instances = {model_name: registry.model(provider, name) for model_name, (provider, name) in models.items()}
+    scheduler = ProviderScheduler()
+    settings = sweep_settings()
+    for run_idx in range(1, 4):  # Run 3 times per temperature
+        for model_name, model in instances.items():
+            scheduler.add(sweep_job(model, model_name, run_idx, articles, annotations, prompt, settings=settings))
 
-        for future in concurrent.futures.as_completed(futures):
-            performance_metrics.append(future.result())
+    for job, result in scheduler.run():
+        if isinstance(result, Exception):
+            raise result
+        performance_metrics.extend(result)
 
     # Save performance metrics
     metrics_file = os.path.join(base_dir, "performance_metrics.csv")
     with open(metrics_file, mode='w', newline='') as file:
         writer = csv.writer(file)
-        writer.writerow(['Model Name', 'Temperature', 'Run Index', 'Accuracy', 'Precision'])
+        writer.writerow(['Model Name', 'Temperature', 'Run Index', 'Accuracy', 'Precision', 'Accuracy_CI_Low',
+                         'Accuracy_CI_High', 'Input_Tokens', 'Cached_Input_Tokens', 'Failed_Items', 'Items',
+                         'Stop_Reason', 'Reference_P_Value'])
         writer.writerows(performance_metrics)
+
+    if get_telemetry().enabled:
+        get_telemetry().export()
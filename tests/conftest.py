@@ -0,0 +1,65 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+# the packages are imported from the repository root, as runner.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers import config
+
+
+@pytest.fixture(autouse=True)
+def no_persistent_caches(monkeypatch):
+    # tests never read or write the response cache and request journal under .cache
+    monkeypatch.setitem(config, 'response_cache', {'enabled': False})
+    monkeypatch.setitem(config, 'checkpoint', {'enabled': False})
+
+
+@pytest.fixture
+def mock_model():
+    from models.mock import MockModel
+    return MockModel('mock-model', settings={'latency_distribution': 'constant', 'latency_ms': 0, 'stream_chunks': 1})
+
+
+@pytest.fixture
+def send_requests():
+    """
+    Send the requests of an experiment (coroutine functions as built by experiment_requests).
+
+    :return: Function merging the responses of the requests into one dictionary.
+    """
+    def send(requests):
+        async def gather():
+            return await asyncio.gather(*(request() for request in requests))
+        responses = {}
+        for result in asyncio.run(gather()):
+            responses.update(result)
+        return responses
+    return send
+
+
+@pytest.fixture
+def basil_tree(tmp_path):
+    """
+    Small BASIL-shaped corpus: 2 years of 4 events with 3 articles each (one per provider).
+
+    :return: Tuple of the articles and annotations paths.
+    """
+    stances = ['Left', 'Center', 'Right']
+    for year in ('2010', '2011'):
+        for event in range(4):
+            for number, source in enumerate(['HPO', 'NYT', 'FOX']):
+                name = f'{year}_{event}_{number}'
+                article = {'source': source, 'title': f'T {name}',
+                           'body-paragraphs': [[f'S{name} a.', f'S{name} b.'], [f'S{name} c.']]}
+                annotation = {'article-level-annotations': {'relative_stance': stances[(event + number) % 3]},
+                              'phrase-level-annotations': [{'txt': f'S{name} b', 'bias': 'Lex'}] if number else []}
+                for kind, content, file_name in (('articles', article, f'{name}.json'),
+                                                 ('annotations', annotation, f'{name}_ann.json')):
+                    folder = tmp_path / kind / year
+                    folder.mkdir(parents=True, exist_ok=True)
+                    (folder / file_name).write_text(json.dumps(content))
+    return str(tmp_path / 'articles'), str(tmp_path / 'annotations')
@@ -0,0 +1,58 @@
+import logging
+
+import pytest
+
+from models.batch_jobs import BatchJobRunner, LocalBatchBackend, custom_id, parse_custom_id
+
+TEXTS = [f'article {index}' for index in range(10)]
+
+
+def experiment(name='s_a_w_b', texts=TEXTS, **params):
+    return dict({'experiment_name': name, 'prompt': 'Is it biased?', 'prompt_type': 'simple',
+                 'prompt_role': 'News article writer', 'classification_type': 'binary', 'texts': texts,
+                 'ground_truths': [1, 0] * (len(texts) // 2), 'num_runs': 2}, **params)
+
+
+@pytest.fixture
+def finalized(monkeypatch):
+    # experiments finalized, without writing their individual results
+    names = []
+    monkeypatch.setattr('models.experiments.save_results', lambda results, *args: names.append(results[0]['Experiment']))
+    return names
+
+
+@pytest.fixture
+def make_runner(tmp_path, mock_model):
+    backend = LocalBatchBackend(str(tmp_path / 'backend'))
+
+    def make(experiments):
+        return BatchJobRunner([(mock_model, params) for params in experiments], directory=str(tmp_path / 'jobs'),
+                              backend_factory=lambda model: backend, poll_interval=0)
+    return make
+
+
+def test_custom_ids_round_trip():
+    assert parse_custom_id(custom_id(3, 2, 17)) == (3, 2, 17)
+
+
+def test_batch_results_are_finalized_once(make_runner, finalized):
+    results = make_runner([experiment()]).run()
+    assert len(results) == 1 and results[0][2]['No_Runs'] == 2
+    # a second run of the same grid finds the experiment in the manifest
+    assert make_runner([experiment()]).run() == []
+    assert finalized == ['s_a_w_b']
+
+
+def test_grid_directory_follows_the_texts(make_runner):
+    first = make_runner([experiment()])
+    assert make_runner([experiment()]).directory == first.directory
+    # same number of items, different texts
+    assert make_runner([experiment(texts=[text + '.' for text in TEXTS])]).directory != first.directory
+
+
+def test_online_only_options_are_reported(make_runner, finalized, caplog):
+    with caplog.at_level(logging.WARNING):
+        results = make_runner([experiment(pack_tokens=2000, multi_sample=True)]).run()
+    assert 'ignoring multi_sample, pack_tokens' in caplog.text
+    # one request per item and run nevertheless
+    assert results[0][2]['Failed_Items'] == 0
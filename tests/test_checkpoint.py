@@ -0,0 +1,52 @@
+import pytest
+
+from helpers import checkpoint, config
+from helpers.checkpoint import RequestJournal, experiment_key
+from models.experiments import completed_responses, experiment_requests
+
+TEXTS = ['first article', 'second article', 'third article']
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    journal = RequestJournal(str(tmp_path / 'journal.sqlite'))
+    monkeypatch.setitem(config, 'checkpoint', {'enabled': True})
+    monkeypatch.setattr(checkpoint, '_journal', journal)
+    yield journal
+    journal.close()
+
+
+def params(**overrides):
+    return {'experiment_name': 'journal test', 'prompt': 'Is it biased?', 'texts': TEXTS, 'num_runs': 2,
+            'classification_type': 'binary', **overrides}
+
+
+def test_completed_ignores_entries_of_changed_texts(journal):
+    journal.record('exp', 'model', 1, 0, 'first article', 'biased')
+    journal.record('exp', 'model', 1, 1, 'second article', 'nonbiased')
+    journal.record('exp', 'model', 2, 5, 'sixth article', 'biased')
+    completed = journal.completed('exp', 'model', ['first article', 'edited second article'])
+    assert completed == {(1, 0): 'biased'}
+    assert journal.completed('exp', 'other model', TEXTS) == {}
+
+
+def test_edited_prompts_get_a_new_experiment_key():
+    assert experiment_key(params()) == experiment_key(params())
+    assert experiment_key(params()) != experiment_key(params(prompt='Is it slanted?'))
+    assert experiment_key(params()) != experiment_key(params(fine_tuned=True))
+
+
+def test_resume_sends_only_the_missing_requests(journal, mock_model, send_requests):
+    first = send_requests(experiment_requests(mock_model, params())[:4])
+    assert len(first) == 4 and mock_model.calls == 4
+
+    completed = completed_responses(mock_model, params())
+    assert completed == first
+    remaining = experiment_requests(mock_model, params(), completed)
+    assert len(remaining) == 2
+    send_requests(remaining)
+    assert mock_model.calls == 6
+    assert len(completed_responses(mock_model, params())) == 6
+
+    # the journal of an edited prompt doesn't count
+    assert completed_responses(mock_model, params(prompt='Is it slanted?')) == {}
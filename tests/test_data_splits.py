@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import pytest
+
+from data_preparation.corpus_cache import CorpusCache
+from data_preparation.data_loading import load_split, get_data, get_sentence_data
+from data_preparation.data_splits import event_groups, event_kfold, evaluate_folds, split_event_non_overlapping
+
+
+def fold_summary(corpus, fold, train, test):
+    # module level, so it can be sent to the fold worker processes
+    return fold, len(train), len(test), sorted(set(corpus.event[test].tolist()) & set(corpus.event[train].tolist()))
+
+
+def test_event_kfold_keeps_events_on_one_side(basil_tree):
+    corpus, _ = load_split(*basil_tree, random_state=0, use_cache=False)
+    groups = event_groups(corpus)
+    folds = event_kfold(corpus, n_splits=4, random_state=0)
+    tested = np.concatenate([test for _, test in folds])
+    assert sorted(tested.tolist()) == list(range(len(corpus)))
+    for train, test in folds:
+        assert not set(groups[train]) & set(groups[test])
+    with pytest.raises(ValueError):
+        event_kfold(corpus, n_splits=9)
+
+
+def test_event_kfold_shuffles_events_like_the_event_split(basil_tree):
+    corpus, _ = load_split(*basil_tree, random_state=0, use_cache=False)
+    groups = event_groups(corpus)
+    for seed in (0, 7):
+        # with as many folds as the event split has test events, the first fold tests the same events
+        _, test = split_event_non_overlapping(corpus, random_state=seed, test_size=0.25)
+        folds = event_kfold(corpus, n_splits=4, random_state=seed)
+        assert set(groups[folds[0][1]]) == set(groups[test])
+        assert [fold.tolist() for _, fold in folds] == \
+            [fold.tolist() for _, fold in event_kfold(corpus, n_splits=4, random_state=seed)]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_evaluate_folds_with_an_uncached_corpus(basil_tree, workers):
+    corpus, rows = load_split(*basil_tree, random_state=0, use_cache=False)
+    assert len(corpus) == 24 and sorted(rows.tolist()) == list(range(24))
+    directory = corpus.directory
+    assert os.path.isdir(directory)
+
+    folds = event_kfold(corpus, n_splits=4, random_state=0)
+    results = evaluate_folds(corpus, folds, fold_summary, workers=workers)
+    assert [fold for fold, *_ in results] == [0, 1, 2, 3]
+    assert all(train + test == 24 for _, train, test, _ in results)
+
+    # the temporary corpus is compiled once per process
+    again, _ = load_split(*basil_tree, random_state=1, use_cache=False)
+    assert again is corpus and os.path.isdir(directory)
+
+
+def test_data_loaders_share_one_compiled_corpus(basil_tree, monkeypatch):
+    builds = []
+    build = CorpusCache.build
+
+    def counted_build(self, *args, **kwargs):
+        builds.append(1)
+        return build(self, *args, **kwargs)
+
+    monkeypatch.setattr(CorpusCache, 'build', counted_build)
+    articles, annotations = get_data(*basil_tree, random_state=0, use_cache=False)
+    sentences, labels, _ = get_sentence_data(*basil_tree, random_state=0, use_cache=False)
+    assert len(builds) == 1
+    assert len(articles) == len(sentences) == 24
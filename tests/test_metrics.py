@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from helpers import config
+from helpers.metrics import classification_metrics, majority_vote
+from helpers.result_logging import overall_row
+
+sklearn_metrics = pytest.importorskip('sklearn.metrics')
+
+
+def test_majority_vote():
+    matrix = np.array([[1, 0, 2, 0],
+                       [1, 1, 2, 1],
+                       [0, 1, 1, 2]])
+    assert majority_vote(matrix).tolist() == [1, 1, 2, 0]
+
+
+def test_majority_vote_ties_go_to_the_first_prediction():
+    matrix = np.array([[0, 1],
+                       [1, 0]])
+    assert majority_vote(matrix).tolist() == [0, 1]
+    # several experiments at once
+    assert majority_vote(np.stack([matrix, matrix[::-1]])).tolist() == [[0, 1], [1, 0]]
+
+
+@pytest.mark.parametrize('average', ['binary', 'macro'])
+def test_classification_metrics_match_sklearn(average):
+    rng = np.random.default_rng(0)
+    classes = 2 if average == 'binary' else 3
+    for _ in range(20):
+        y_true = rng.integers(0, classes, 50)
+        y_pred = rng.integers(0, classes, 50)
+        metrics = classification_metrics(y_true, y_pred, average=average)
+        assert metrics['accuracy'] == pytest.approx(sklearn_metrics.accuracy_score(y_true, y_pred))
+        for name, score in (('precision', sklearn_metrics.precision_score), ('recall', sklearn_metrics.recall_score),
+                            ('f1', sklearn_metrics.f1_score)):
+            assert metrics[name] == pytest.approx(score(y_true, y_pred, average=average, zero_division=0))
+
+
+def test_classification_metrics_undefined_scores_are_zero():
+    metrics = classification_metrics([0, 0, 0], [0, 0, 0])
+    assert metrics == {'accuracy': 1.0, 'precision': 0.0, 'recall': 0.0, 'f1': 0.0}
+
+
+def test_classification_metrics_over_leading_axes():
+    rng = np.random.default_rng(1)
+    y_true = rng.integers(0, 2, 40)
+    y_pred = rng.integers(0, 2, (3, 40))
+    metrics = classification_metrics(y_true, y_pred)
+    for row, f1 in zip(y_pred, metrics['f1']):
+        assert f1 == pytest.approx(sklearn_metrics.f1_score(y_true, row, zero_division=0))
+
+
+def test_overall_row_follows_the_configured_columns():
+    row = overall_row({'Output_Tokens': 7, 'Accuracy': 0.5, 'Experiment': 'e', 'Unlisted': 1})
+    assert list(row) == config['return_files']['overall_return_file_columns']
+    assert row['Accuracy'] == 0.5 and row['Output_Tokens'] == 7 and row['Run_Agreement'] is None
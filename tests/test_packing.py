@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+from helpers.packing import pack_texts, packed_parser, packed_prompt, packing_drift, format_pack
+from helpers.parsing import get_parser, structured_max_tokens
+from helpers.rate_limiting import estimate_tokens
+from models.experiments import experiment_requests, parse_run
+from models.mock import MockModel
+
+TEXTS = [f'article number {index} ' * 5 for index in range(6)]
+SETTINGS = {'latency_distribution': 'constant', 'latency_ms': 0, 'stream_chunks': 1}
+
+
+class DroppingMock(MockModel):
+    """
+    Mock provider whose packed answers leave out the given item numbers, or are not parseable at all.
+    """
+    def __init__(self, drop=(), garbled=False):
+        super().__init__('mock-model', settings=SETTINGS)
+        self.drop = set(drop)
+        self.garbled = garbled
+        self.texts = []
+
+    def respond(self, text, prompt, temperature, labels=None):
+        self.texts.append(text)
+        response = super().respond(text, prompt, temperature, labels)
+        if labels is None or not labels.indexed:
+            return response
+        if self.garbled:
+            return 'I cannot label these articles.'
+        entries = json.loads(response)['labels']
+        return json.dumps({'labels': [entry for entry in entries if entry['index'] not in self.drop]})
+
+
+def packed_params(**params):
+    return dict({'experiment_name': 'packed', 'prompt': 'Is the article biased?', 'texts': TEXTS,
+                 'num_runs': 1, 'pack_tokens': 10000, 'pack_max_items': 4}, **params)
+
+
+def test_packs_respect_budget_and_max_items():
+    prompt = 'Is the article biased?'
+    overhead = estimate_tokens(packed_prompt(prompt), max_tokens=0)
+    per_text = estimate_tokens(TEXTS[0], max_tokens=0) + 2
+    assert pack_texts(TEXTS, prompt, 10000, max_items=4) == [[0, 1, 2, 3], [4, 5]]
+    assert pack_texts(TEXTS, prompt, overhead + 2 * per_text, max_items=20) == [[0, 1], [2, 3], [4, 5]]
+    # a text over budget gets a request of its own
+    assert pack_texts(['x' * 4000] + TEXTS[:2], prompt, overhead + 2 * per_text) == [[0], [1, 2]]
+    assert pack_texts([], prompt, 10000) == []
+
+
+def test_packed_parser_reads_one_label_per_article():
+    parser = packed_parser(packed_params())
+    assert parser.max_tokens == 4 * parser.tokens_per_item + structured_max_tokens()
+    assert parser.parse('[1] biased\n[2] nonbiased', 3) == ['biased', 'nonbiased', None]
+    # line breaks inside an article would shift the numbering
+    assert format_pack(['one\ntwo', 'three'], [1, 0]) == '[1] three\n[2] one two'
+
+
+def test_packed_answers_cover_every_text(send_requests):
+    model = DroppingMock()
+    responses = send_requests(experiment_requests(model, packed_params()))
+    assert len(model.texts) == 2
+    assert None not in parse_run(packed_params(), responses, 1)
+    assert not any(key[0] == 'single' for key in responses if len(key) == 3)
+
+
+def test_texts_missing_from_a_packed_answer_are_sent_on_their_own(send_requests):
+    model = DroppingMock(drop={2})
+    responses = send_requests(experiment_requests(model, packed_params()))
+    # item 2 of both packs: texts 1 and 5
+    assert set(model.texts[2:]) == {TEXTS[1], TEXTS[5]}
+    assert {key for key in responses if len(key) == 3} == {('single', 1, 1), ('single', 1, 5)}
+    assert None not in parse_run(packed_params(), responses, 1)
+
+
+def test_unparseable_packed_answer_falls_back_to_single_requests(send_requests):
+    model = DroppingMock(garbled=True)
+    responses = send_requests(experiment_requests(model, packed_params()))
+    assert len(model.texts) == 2 + len(TEXTS)
+    assert parse_run(packed_params(), responses, 1) == get_parser('binary').parse_many(
+        [MockModel('mock-model', settings=SETTINGS).respond(text, '', 0) for text in TEXTS])
+
+
+def test_drift_sample_is_also_classified_unpacked(send_requests):
+    params = packed_params(pack_drift_sample=3)
+    responses = send_requests(experiment_requests(DroppingMock(), params))
+    unpacked = [key for key in responses if len(key) == 3 and key[0] == 'unpacked']
+    assert len(unpacked) == 3
+    # the mock labels a text the same way packed or not
+    assert packing_drift(responses, [1] * len(TEXTS), get_parser('binary'), 1) == pytest.approx(0.0)
+    assert packing_drift({(1, 0): 'biased'}, [1], get_parser('binary'), 1) is None
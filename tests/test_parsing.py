@@ -0,0 +1,68 @@
+import pytest
+
+from helpers.helpers import extract_single_word
+from helpers.parsing import LabelParser, get_parser
+
+
+@pytest.fixture
+def binary():
+    return get_parser('binary')
+
+
+def test_free_text_takes_the_first_label_mentioned(binary):
+    assert binary.parse('The article is biased.') == 'biased'
+    assert binary.parse('Non-biased, although some might call it biased') == 'nonbiased'
+    assert binary.parse('NON BIASED') == 'nonbiased'
+    # whole words only
+    assert binary.parse('unbiasedness') is None
+    assert binary.parse('') is None
+    assert binary.parse(None) is None
+
+
+def test_aliases_map_onto_canonical_labels(binary):
+    assert binary.parse('It leans conservative') == 'biased'
+    assert binary.parse('center') == 'nonbiased'
+    multiclass = get_parser('multiclass')
+    assert multiclass.parse('liberal') == 'left'
+    assert multiclass.parse('Conservative.') == 'right'
+
+
+def test_structured_responses_are_matched_exactly(binary):
+    assert binary.parse('{"label": "nonbiased"}') == 'nonbiased'
+    assert binary.parse('  "biased"  ') == 'biased'
+    # malformed JSON falls back to the free-text search
+    assert binary.parse('{"label": "biased"') == 'biased'
+    assert binary.parse('{"label": "maybe"}') is None
+
+
+def test_values_count_parse_failures(binary):
+    labels = binary.parse_many(['biased', 'no idea', 'nonbiased', 'biased'])
+    assert labels == ['biased', None, 'nonbiased', 'biased']
+    assert binary.to_values(labels) == ([1, 0, 0, 1], 1)
+
+
+def test_multiclass_scores_binary_answers_like_the_original_parser():
+    multiclass = get_parser('multiclass')
+    labels = multiclass.parse_many(['Biased.', 'Non Biased', 'left', 'right', 'center'])
+    assert labels == ['biased', 'nonbiased', 'left', 'right', 'center']
+    assert multiclass.to_values(labels) == ([1, 0, 1, 1, 0], 0)
+    # structured output stays constrained to the multiclass labels
+    assert multiclass.json_schema()['properties']['label']['enum'] == ['center', 'left', 'right']
+
+
+def test_unknown_classification_type_is_rejected():
+    with pytest.raises(ValueError):
+        get_parser('ternary')
+
+
+def test_legacy_wrapper_keeps_the_original_vocabulary():
+    assert extract_single_word('I would say liberal') == 'left'
+    assert extract_single_word('NonBiased.') == 'nonbiased'
+    assert extract_single_word('nothing here') == 'none'
+
+
+def test_longer_aliases_win_at_the_same_position():
+    parser = LabelParser('test', ['yes', 'no'], aliases={'no way': 'no', 'way': 'yes'}, values={'yes': 1, 'no': 0})
+    assert parser.parse('no way') == 'no'
+    assert parser.parse('the way') == 'yes'
+
@@ -0,0 +1,116 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from helpers import config
+from helpers.usage import get_usage_tracker, usage_scope
+from models.anthropic import ClaudeAI
+from models.gemini import Gemini
+from models.openai import ChatGPTPrompt
+
+
+@pytest.fixture
+def caching(monkeypatch):
+    def configure(**settings):
+        monkeypatch.setitem(config, 'prompt_caching', {'enabled': True, **settings})
+    configure()
+    return configure
+
+
+def test_anthropic_marks_the_system_prompt_for_caching(caching):
+    model = ClaudeAI('key', 'claude-test', client=object())
+    params = model.request_params('the article', 'the prompt', 0)
+    assert params['system'] == [{'type': 'text', 'text': 'the prompt', 'cache_control': {'type': 'ephemeral'}}]
+    assert params['messages'][0]['content'] == [{'type': 'text', 'text': 'the article'}]
+
+    caching(enabled=False)
+    assert model.request_params('the article', 'the prompt', 0)['system'] == [{'type': 'text', 'text': 'the prompt'}]
+
+
+def test_openai_sends_the_prompt_as_system_message():
+    model = ChatGPTPrompt('gpt-test', 'key', client=object())
+    params = model.request_params('the article', 'the prompt', 0)
+    assert params['messages'] == [{'role': 'system', 'content': 'the prompt'},
+                                  {'role': 'user', 'content': 'the article'}]
+
+
+def test_cached_tokens_are_counted_per_experiment():
+    anthropic_usage = SimpleNamespace(input_tokens=10, output_tokens=3, cache_read_input_tokens=900,
+                                      cache_creation_input_tokens=100)
+    openai_usage = SimpleNamespace(prompt_tokens=1500, completion_tokens=2,
+                                   prompt_tokens_details=SimpleNamespace(cached_tokens=1024))
+    with usage_scope('caching test'):
+        ClaudeAI.observe_usage(SimpleNamespace(usage=anthropic_usage))
+        ChatGPTPrompt.observe_usage(SimpleNamespace(usage=openai_usage))
+    usage = get_usage_tracker().pop('caching test')
+    # Anthropic reports the uncached part as input_tokens, the whole prompt is counted
+    assert usage.as_dict() == {'requests': 2, 'input_tokens': 2510, 'cached_tokens': 1924,
+                               'cache_write_tokens': 100, 'output_tokens': 5}
+
+
+class FakeCache:
+    def __init__(self, fail_update=False):
+        self.fail_update = fail_update
+        self.updates = 0
+
+    def update(self, ttl):
+        if self.fail_update:
+            raise RuntimeError('cache expired')
+        self.updates += 1
+
+
+class FakeGenai:
+    fail_update = False
+
+    class caching:
+        class CachedContent:
+            @staticmethod
+            def create(model, system_instruction, ttl):
+                return FakeCache(FakeGenai.fail_update)
+
+    class GenerativeModel:
+        def __init__(self, model_name, system_instruction=None):
+            self.system_instruction = system_instruction
+            self.cache = None
+
+        @classmethod
+        def from_cached_content(cls, cache):
+            model = cls('gemini-test')
+            model.cache = cache
+            return model
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [time.monotonic()]
+    monkeypatch.setattr('models.gemini.time.monotonic', lambda: now[0])
+    return now
+
+
+def test_gemini_short_prompts_are_system_instructions(caching):
+    model = Gemini('key', 'gemini-test', client=FakeGenai)
+    prompt_model = model.prompt_model('the prompt', {})
+    assert prompt_model.system_instruction == 'the prompt' and prompt_model.cache is None
+
+
+def test_gemini_context_cache_is_refreshed_before_it_expires(caching, clock):
+    caching(gemini_min_tokens=1, gemini_ttl=100)
+    FakeGenai.fail_update = False
+    model, models = Gemini('key', 'gemini-test', client=FakeGenai), {}
+    first = model.prompt_model('the prompt', models)
+    assert first.cache is not None
+    clock[0] += 50
+    assert model.prompt_model('the prompt', models) is first and first.cache.updates == 0
+    clock[0] += 45
+    assert model.prompt_model('the prompt', models) is first and first.cache.updates == 1
+
+
+def test_gemini_context_cache_is_recreated_when_it_cannot_be_extended(caching, clock):
+    caching(gemini_min_tokens=1, gemini_ttl=100)
+    FakeGenai.fail_update = True
+    model, models = Gemini('key', 'gemini-test', client=FakeGenai), {}
+    first = model.prompt_model('the prompt', models)
+    clock[0] += 95
+    second = model.prompt_model('the prompt', models)
+    assert second is not first and second.cache is not first.cache
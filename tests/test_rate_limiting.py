@@ -0,0 +1,52 @@
+import time
+
+from helpers.rate_limiting import AdaptiveRateLimiter, TokenBucket
+
+
+def test_token_bucket_starts_below_capacity():
+    bucket = TokenBucket(600, initial_share=0.1)
+    now = bucket.updated
+    assert all(bucket.reserve(1, now) == 0 for _ in range(60))
+    # the 61st request waits for the bucket to refill at 10 per second
+    assert abs(bucket.reserve(1, now) - 0.1) < 1e-9
+
+
+def test_rate_limit_burst_cuts_the_rate_once():
+    limiter = AdaptiveRateLimiter('test', 600, cut_interval=60)
+    sent_at = time.monotonic()
+    for _ in range(10):
+        limiter.on_rate_limited(sent_at=sent_at)
+    assert limiter.factor == 0.5
+    assert limiter._requests.per_minute == 300
+
+
+def test_requests_sent_before_the_last_cut_only_pause():
+    limiter = AdaptiveRateLimiter('test', 600, cut_interval=0)
+    sent_at = time.monotonic()
+    limiter.on_rate_limited(sent_at=sent_at)
+    limiter.on_rate_limited(retry_after=5, sent_at=sent_at)
+    assert limiter.factor == 0.5
+    assert limiter.reserve() >= 4.9
+    # a request sent after the cut that is rate limited again cuts further
+    limiter.on_rate_limited(sent_at=time.monotonic())
+    assert limiter.factor == 0.25
+
+
+def test_rate_is_cut_down_to_min_factor_and_recovers():
+    limiter = AdaptiveRateLimiter('test', 600, min_factor=0.1, recovery_step=0.05, recovery_every=2,
+                                  cut_interval=0)
+    for _ in range(10):
+        limiter.on_rate_limited()
+    assert limiter.factor == 0.1
+    for _ in range(4):
+        limiter.on_success()
+    assert abs(limiter.factor - 0.2) < 1e-9
+    assert abs(limiter._requests.per_minute - 120) < 1e-6
+
+
+def test_headers_replace_the_configured_limits():
+    limiter = AdaptiveRateLimiter('test', 600, tokens_per_minute=1000)
+    limiter.update_from_headers({'x-ratelimit-limit-requests': '60', 'x-ratelimit-remaining-requests': '0',
+                                 'x-ratelimit-reset-requests': '2s'})
+    assert limiter.requests_per_minute == 60
+    assert limiter.reserve() >= 1.9
@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+from helpers.resilience import CircuitBreaker, CircuitOpenError, RequestFailed
+from models.mock import MockError, MockModel
+
+
+class RecordingLimiter:
+    def __init__(self):
+        self.calls = []
+
+    def on_rate_limited(self, retry_after=None, sent_at=None):
+        self.calls.append((retry_after, sent_at))
+
+
+SETTINGS = {'backoff_base': 1, 'backoff_max': 30}
+
+
+@pytest.fixture
+def model():
+    return MockModel('mock-model')
+
+
+def test_retry_delay_backs_off_on_429_without_retry_after(model, monkeypatch):
+    monkeypatch.setattr('models.base_models.backoff_delay', lambda attempt, base, cap: 2.0)
+    limiter = RecordingLimiter()
+    delay = model.retry_delay(MockError('busy', 429), 0, 5, SETTINGS, limiter, CircuitBreaker('mock'), sent_at=1.0)
+    assert delay == 2.0
+    assert limiter.calls == [(None, 1.0)]
+
+
+def test_retry_delay_takes_the_longer_of_retry_after_and_backoff(model, monkeypatch):
+    monkeypatch.setattr('models.base_models.backoff_delay', lambda attempt, base, cap: 2.0)
+    breaker = CircuitBreaker('mock')
+    assert model.retry_delay(MockError('busy', 429, retry_after=7), 0, 5, SETTINGS, None, breaker) == 7
+    assert model.retry_delay(MockError('busy', 429, retry_after=1), 0, 5, SETTINGS, None, breaker) == 2.0
+    # 429s don't count towards opening the circuit
+    assert breaker.failures == 0
+
+
+def test_retry_delay_counts_server_errors_and_gives_up(model):
+    breaker = CircuitBreaker('mock')
+    assert model.retry_delay(MockError('down', 503), 0, 2, SETTINGS, None, breaker) >= 0
+    assert breaker.failures == 1
+    with pytest.raises(RequestFailed):
+        model.retry_delay(MockError('down', 503), 2, 2, SETTINGS, None, breaker)
+    with pytest.raises(RequestFailed):
+        model.retry_delay(MockError('rejected', 400), 0, 2, SETTINGS, None, breaker)
+
+
+def test_retry_delay_reraises_errors_that_are_not_provider_errors(model):
+    with pytest.raises(KeyError):
+        model.retry_delay(KeyError('bug'), 0, 5, SETTINGS, None, CircuitBreaker('mock'))
+
+
+def test_circuit_opens_after_threshold_and_lets_one_probe_through():
+    breaker = CircuitBreaker('mock', failure_threshold=3, reset_timeout=0.05, max_reset_timeout=1)
+    for _ in range(2):
+        breaker.on_failure()
+    assert not breaker.is_open
+    breaker.on_failure()
+    assert breaker.is_open
+    assert breaker.before_call() > 0
+
+    time.sleep(0.06)
+    assert breaker.before_call() == 0
+    # everybody else waits for the probe
+    assert breaker.before_call() > 0
+    breaker.on_success()
+    assert not breaker.is_open
+    assert breaker.before_call() == 0
+
+
+def test_failed_probe_doubles_the_reset_timeout():
+    breaker = CircuitBreaker('mock', failure_threshold=1, reset_timeout=0.05, max_reset_timeout=0.08)
+    breaker.on_failure()
+    # a call in flight when the circuit opened fails without extending the pause
+    breaker.on_failure()
+    assert breaker.reset_timeout == 0.05
+    time.sleep(0.06)
+    assert breaker.before_call() == 0
+    breaker.on_failure()
+    assert breaker.reset_timeout == 0.08
+    assert breaker.is_open
+
+
+def test_circuit_gives_up_after_outage():
+    breaker = CircuitBreaker('mock', failure_threshold=1, reset_timeout=10, give_up_after=0)
+    breaker.on_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    assert breaker.remaining() == 0
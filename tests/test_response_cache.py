@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+from helpers.response_cache import ResponseCache
+from models.mock import MockModel
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'responses.sqlite'))
+    yield cache
+    cache.close()
+
+
+def test_keys_are_stable_and_cover_the_whole_request(cache):
+    assert ResponseCache.make_key(text='t', prompt='p') == ResponseCache.make_key(prompt='p', text='t')
+    model = MockModel('mock-model')
+    key = model.cache_key(cache, 'text', 'prompt', False, 0, 0)
+    assert key == ResponseCache.make_key(provider='mock', model='mock-model', prompt='prompt', text='text',
+                                         temperature=0, max_tokens=model.max_tokens, fine_tuned=False, sample=0)
+    assert key != model.cache_key(cache, 'text', 'other prompt', False, 0, 0)
+    # separate runs are separate samples only when sampling is random
+    assert model.cache_key(cache, 'text', 'prompt', False, 0, 2) == key
+    assert model.cache_key(cache, 'text', 'prompt', False, 0.7, 1) != model.cache_key(cache, 'text', 'prompt', False, 0.7, 2)
+
+
+def test_get_or_compute_calls_once_and_skips_empty_responses(cache):
+    calls = []
+    compute = lambda: calls.append(1) or 'biased'
+    assert cache.get_or_compute('key', 'model', compute) == ('biased', False)
+    assert cache.get_or_compute('key', 'model', compute) == ('biased', True)
+    assert len(calls) == 1
+    assert cache.get_or_compute('empty', 'model', lambda: '') == ('', False)
+    assert cache.get('empty') is None
+
+
+def test_concurrent_identical_requests_are_merged(cache):
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'biased'
+
+    results = []
+    owner = threading.Thread(target=lambda: results.append(cache.get_or_compute('key', 'model', compute)))
+    owner.start()
+    started.wait(5)
+    waiter = threading.Thread(target=lambda: results.append(cache.get_or_compute('key', 'model', compute)))
+    waiter.start()
+    time.sleep(0.05)
+    release.set()
+    owner.join()
+    waiter.join()
+    assert len(calls) == 1
+    assert sorted(results) == [('biased', False), ('biased', True)]
+
+
+def test_entries_older_than_max_age_are_misses(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path / 'responses.sqlite'), max_age_days=1)
+    cache.put('key', 'model', 'biased')
+    now = time.time()
+    monkeypatch.setattr('helpers.response_cache.time.time', lambda: now + 2 * 86400)
+    assert cache.get('key') is None
+    cache.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('helpers.response_cache.time.time', lambda: clock[0])
+    cache = ResponseCache(str(tmp_path / 'responses.sqlite'), max_entries=2, evict_every=1)
+    for key in ('a', 'b'):
+        clock[0] += 1
+        cache.put(key, 'model', key)
+    clock[0] += 1
+    cache.get('a')
+    clock[0] += 1
+    cache.put('c', 'model', 'c')
+    assert [cache.get(key) for key in ('a', 'b', 'c')] == ['a', None, 'c']
+    cache.close()
+
+
+def test_deterministic_only_skips_sampled_calls(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'responses.sqlite'), deterministic_only=True)
+    assert cache.cacheable(0) and not cache.cacheable(0.7)
+    calls = []
+    for _ in range(2):
+        cache.get_or_compute('key', 'model', lambda: calls.append(1) or 'biased', cacheable=cache.cacheable(0.7))
+    assert len(calls) == 2 and cache.get('key') is None
+    cache.close()
@@ -0,0 +1,103 @@
+import csv
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from helpers import config, result_sink
+from helpers.result_sink import ResultSink, get_result_sink
+
+COLUMNS = ['Experiment', 'Run', 'Prediction']
+
+
+def read_csv(path):
+    with open(path, newline='') as f:
+        return list(csv.reader(f))
+
+
+def test_csv_rows_of_concurrent_producers_are_all_written(tmp_path):
+    sink = ResultSink(buffer_rows=7, flush_interval=60)
+    destination = str(tmp_path / 'results' / 'individual.csv')
+
+    def produce(experiment):
+        for run in range(50):
+            sink.write(destination, [{'Experiment': experiment, 'Run': run, 'Prediction': 1}], COLUMNS)
+
+    threads = [threading.Thread(target=produce, args=(f'e{number}',)) for number in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sink.close()
+    rows = read_csv(destination)
+    assert rows[0] == COLUMNS
+    assert len(rows) == 201
+    assert {row[0] for row in rows[1:]} == {'e0', 'e1', 'e2', 'e3'}
+    assert not sink.errors
+
+
+def test_flush_writes_buffered_rows(tmp_path):
+    sink = ResultSink(buffer_rows=1000, flush_interval=60)
+    destination = str(tmp_path / 'overall.csv')
+    sink.write(destination, [{'Experiment': 'e', 'Run': 1, 'Prediction': None}])
+    sink.flush()
+    assert read_csv(destination) == [COLUMNS, ['e', '1', '']]
+    sink.close()
+    with pytest.raises(RuntimeError):
+        sink.write(destination, [{'Experiment': 'e'}])
+
+
+def test_csv_with_other_columns_is_moved_aside(tmp_path):
+    destination = str(tmp_path / 'individual.csv')
+    with open(destination, 'w', newline='') as f:
+        csv.writer(f).writerows([['Experiment', 'Run'], ['old', '1']])
+    sink = ResultSink()
+    sink.write(destination, [{'Experiment': 'new', 'Run': 1, 'Prediction': 0}], COLUMNS)
+    sink.close()
+    assert read_csv(destination) == [COLUMNS, ['new', '1', '0']]
+    rotated = [name for name in os.listdir(tmp_path) if name != 'individual.csv']
+    assert len(rotated) == 1 and read_csv(tmp_path / rotated[0]) == [['Experiment', 'Run'], ['old', '1']]
+
+
+def test_csv_with_the_same_columns_is_appended_to(tmp_path):
+    destination = str(tmp_path / 'individual.csv')
+    for experiment in ('first', 'second'):
+        sink = ResultSink()
+        sink.write(destination, [{'Experiment': experiment, 'Run': 1, 'Prediction': 1}], COLUMNS)
+        sink.close()
+    assert [row[0] for row in read_csv(destination)] == ['Experiment', 'first', 'second']
+
+
+def test_sqlite_tables_are_named_after_the_destination(tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+    sink = ResultSink(format='sqlite', sqlite_path=path)
+    sink.write('individual_results/gpt/binary.csv', [{'Experiment': 'e', 'Run': 1, 'Prediction': 0.5}], COLUMNS)
+    sink.close()
+    with sqlite3.connect(path) as conn:
+        assert conn.execute('SELECT * FROM individual_results_gpt_binary').fetchall() == [('e', 1, 0.5)]
+
+
+def test_parquet_appends_a_row_group_per_flush(tmp_path):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    sink = ResultSink(format='parquet')
+    destination = str(tmp_path / 'individual.csv')
+    for run in (1, 2):
+        sink.write(destination, [{'Experiment': 'e', 'Run': run, 'Prediction': 1}], COLUMNS)
+        sink.flush()
+    sink.close()
+    table = parquet.read_table(str(tmp_path / 'individual.parquet'))
+    assert table.column('Run').to_pylist() == ['1', '2']
+
+
+def test_closed_sink_is_replaced(tmp_path, monkeypatch):
+    monkeypatch.setitem(config, 'result_sink', {'format': 'csv'})
+    monkeypatch.setattr(result_sink, '_result_sink', None)
+    sink = get_result_sink()
+    assert get_result_sink() is sink
+    sink.close()
+    replacement = get_result_sink()
+    assert replacement is not sink
+    replacement.write(str(tmp_path / 'overall.csv'), [{'Experiment': 'e'}])
+    replacement.close()
+    assert read_csv(tmp_path / 'overall.csv') == [['Experiment'], ['e']]
@@ -0,0 +1,74 @@
+import csv
+import sqlite3
+
+import pytest
+
+from helpers.result_store import ResultStore
+
+
+def entry(run, text='An article.', failed=False, **overrides):
+    return {'Experiment': 'exp', 'Run': run, 'Model': 'mock-model', 'Prompt_Type': 'simple', 'Prompt_Role': 'none',
+            'Prompt': 'Is it biased?', 'Text': text, 'FineTuned': False, 'Prediction': None if failed else 1,
+            'Failed': failed, 'Ground_Truth': 1, 'Detection_Type': 'article', 'Classification_Type': 'binary',
+            **overrides}
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ResultStore(str(tmp_path / 'store.sqlite'))
+    yield store
+    store.close()
+
+
+def test_texts_and_prompts_are_stored_once(store):
+    store.add([entry(run) for run in (1, 2, 3)] + [entry(1, text='Another article.')])
+    assert store.conn.execute('SELECT COUNT(*) FROM texts').fetchone()[0] == 2
+    assert store.conn.execute('SELECT COUNT(*) FROM prompts').fetchone()[0] == 1
+    rows = store.predictions('exp', with_content=True)
+    assert len(rows) == 4
+    assert [row['text'] for row in rows] == ['An article.'] * 3 + ['Another article.']
+
+
+def test_failed_requests_are_told_apart_from_predictions(store):
+    store.add([entry(1), entry(2, failed=True)])
+    assert [(row['prediction'], row['failed']) for row in store.predictions()] == [(1, 0), (None, 1)]
+
+
+def test_csv_imports_keep_the_failed_flag(store, tmp_path):
+    directory = tmp_path / 'individual_results'
+    directory.mkdir()
+    columns = list(entry(1))
+    with open(directory / 'new.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows([entry(1), entry(2, failed=True)])
+    with open(directory / 'old.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, [column for column in columns if column != 'Failed'], extrasaction='ignore')
+        writer.writeheader()
+        writer.writerow(entry(3))
+    assert store.import_individual_results(str(directory)) == 3
+    assert [(row['run'], row['failed']) for row in store.predictions()] == [(1, 0), (2, 1), (3, None)]
+
+
+def test_stores_without_the_failed_column_are_migrated(tmp_path):
+    path = str(tmp_path / 'store.sqlite')
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            'CREATE TABLE predictions (experiment TEXT, run INTEGER, model TEXT, prompt_type TEXT, prompt_role TEXT, '
+            'prompt_id TEXT, text_id TEXT, fine_tuned INTEGER, prediction INTEGER, ground_truth INTEGER, '
+            'timestamp TEXT, detection_type TEXT, classification_type TEXT)'
+        )
+        conn.execute("INSERT INTO predictions (experiment, run) VALUES ('old', 1)")
+    store = ResultStore(path)
+    store.add([entry(1, failed=True)])
+    assert [(row['experiment'], row['failed']) for row in store.predictions()] == [('old', None), ('exp', 1)]
+    store.close()
+
+
+def test_rolled_back_texts_are_inserted_again(store):
+    with pytest.raises(sqlite3.Error):
+        # the text is referenced before the unsupported Run value fails the insert
+        store.add([entry(object(), text='Rolled back article.')])
+    assert store.conn.execute('SELECT COUNT(*) FROM texts').fetchone()[0] == 0
+    store.add([entry(1, text='Rolled back article.')])
+    assert store.predictions(with_content=True)[0]['text'] == 'Rolled back article.'
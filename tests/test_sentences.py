@@ -0,0 +1,62 @@
+from helpers.parsing import IndexedLabelParser, get_parser
+from helpers.sentences import batch_sentences, sentence_params, parse_sentence_batches, phrase_recall
+from models.experiments import experiment_requests, parse_run, failed_items
+
+ARTICLES = [[f'a{index}.' for index in range(5)], ['b0.', 'b1.']]
+
+
+def test_batches_split_articles_evenly_and_never_mix_them():
+    assert batch_sentences(ARTICLES, 2) == [(0, 0, 2), (0, 2, 1), (0, 3, 2), (1, 0, 2)]
+    assert batch_sentences(ARTICLES, 3) == [(0, 0, 2), (0, 2, 3), (1, 0, 2)]
+    assert batch_sentences([[], ['c0.']], 3) == [(1, 0, 1)]
+
+
+def test_indexed_parser_reads_json_and_numbered_lines():
+    indexed = IndexedLabelParser(get_parser('binary'), max_items=3)
+    assert indexed.parse('{"labels": [{"index": 2, "label": "biased"}, {"index": 1, "label": "nonbiased"}]}', 3) == \
+        ['nonbiased', 'biased', None]
+    assert indexed.parse('[1] biased\n2. non-biased\n[3] liberal', 3) == ['biased', 'nonbiased', 'biased']
+    # out of range and repeated indices are ignored, the first answer per item counts
+    assert indexed.parse('[0] biased\n[2] biased\n[2] nonbiased\n[4] biased', 3) == [None, 'biased', None]
+    assert indexed.parse('', 2) == [None, None]
+
+
+def test_batch_responses_are_mapped_back_to_sentences():
+    indexed = IndexedLabelParser(get_parser('binary'), max_items=3)
+    batches = [(0, 0, 2), (0, 2, 3)]
+    labels = parse_sentence_batches(indexed, batches, ['[1] biased\n[2] nonbiased', '[3] biased'])
+    assert labels == ['biased', 'nonbiased', None, None, 'biased']
+
+
+def test_sentence_params_number_sentences_across_articles():
+    params = sentence_params(ARTICLES, [[0, 1, 0, 0, 1], [1, 0]], [[[1], [3, 4]], [[0]]], 3)
+    assert params['texts'][0] == '[1] a0.\n[2] a1.'
+    assert params['texts'][2] == '[1] b0.\n[2] b1.'
+    assert params['sentences'] == ARTICLES[0] + ARTICLES[1]
+    assert params['phrase_sentences'] == [[1], [3, 4], [5]]
+    assert len(params['ground_truths']) == 7
+
+
+def test_failed_batch_fails_all_of_its_sentences():
+    params = dict(sentence_params(ARTICLES, [[0] * 5, [0] * 2], [[], []], 3), num_runs=1)
+    responses = {(1, 0): '[1] biased\n[2] biased', (1, 1): None, (1, 2): '[2] nonbiased'}
+    assert parse_run(params, responses, 1) == ['biased', 'biased', None, None, None, None, 'nonbiased']
+    assert failed_items(params, responses).tolist() == [[False, False, True, True, True, False, False]]
+
+
+def test_mock_model_labels_every_sentence_of_a_batch(mock_model, send_requests):
+    params = dict(sentence_params(ARTICLES, [[0] * 5, [0] * 2], [[], []], 3), num_runs=2, prompt='Is it biased?',
+                  experiment_name='sentences', classification_type='binary')
+    requests = experiment_requests(mock_model, params)
+    # one request per batch and run
+    assert len(requests) == 6
+    responses = send_requests(requests)
+    for run in (1, 2):
+        labels = parse_run(params, responses, run)
+        assert len(labels) == 7 and None not in labels
+    assert not failed_items(params, responses).any()
+
+
+def test_phrase_recall_counts_phrases_in_biased_sentences():
+    assert phrase_recall([1, 0, 0, 1], [[0], [1, 2], [2, 3]]) == 2 / 3
+    assert phrase_recall([1, 0], []) is None
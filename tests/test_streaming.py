@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from helpers import config
+from helpers.parsing import get_parser
+from helpers.streaming import LabelStream, stream_labels
+from helpers.usage import get_usage_tracker, usage_scope
+from models.mock import MockModel
+
+
+@pytest.fixture
+def streaming(monkeypatch):
+    monkeypatch.setitem(config, 'streaming', {'enabled': True, 'early_stop': True})
+
+
+@pytest.fixture
+def chatty_model():
+    return MockModel('mock-model', settings={'latency_distribution': 'constant', 'latency_ms': 0,
+                                             'stream_chunks': 40, 'explanation_words': 30})
+
+
+def feed(stream, chunks):
+    for number, chunk in enumerate(chunks, start=1):
+        if stream.feed(chunk):
+            return number
+    return None
+
+
+def predict(model, text='some article', prompt='Is it biased?'):
+    async def call():
+        with stream_labels(get_parser('binary')), usage_scope('stream test'):
+            return await model.apredict_single(text, prompt)
+    get_usage_tracker().pop('stream test')
+    response = asyncio.run(call())
+    return response, get_usage_tracker().pop('stream test')
+
+
+def test_stream_stops_once_a_label_is_complete(streaming):
+    with stream_labels(get_parser('multiclass')):
+        stream = LabelStream()
+    # 'left' only counts once the next character shows it is not 'leftist'
+    assert feed(stream, ['The article is ', 'lef', 't', 'ist', ' and right', '-leaning, because']) == 6
+    assert stream.label == 'right' and stream.stopped
+    assert get_parser('multiclass').parse(stream.text) == 'right'
+
+
+def test_json_and_unscoped_streams_are_read_to_the_end(streaming):
+    with stream_labels(get_parser('binary')):
+        json_stream = LabelStream()
+        unstopped = LabelStream(stop=False)
+    assert feed(json_stream, ['{"label": ', '"biased"', '}']) is None
+    assert feed(unstopped, ['biased ', 'because']) is None
+    # outside stream_labels there is no parser to stop at
+    assert feed(LabelStream(), ['biased ', 'because']) is None
+
+
+def test_early_stop_cuts_the_explanation(streaming, chatty_model):
+    response, usage = predict(chatty_model)
+    full = chatty_model.respond('some article', 'Is it biased?', 0)
+    assert len(response) < len(full)
+    assert full.startswith(response)
+    assert get_parser('binary').parse(response) == get_parser('binary').parse(full)
+    # a stream closed early is charged one output token per chunk
+    assert usage.requests == 1 and usage.output_tokens < 40
+
+
+@pytest.mark.parametrize('streaming_config', [{'enabled': False, 'early_stop': True},
+                                              {'enabled': True, 'early_stop': False}])
+def test_full_response_without_early_stop(monkeypatch, chatty_model, streaming_config):
+    monkeypatch.setitem(config, 'streaming', streaming_config)
+    response, _ = predict(chatty_model)
+    assert response == chatty_model.respond('some article', 'Is it biased?', 0)
+
+
+def test_streaming_is_off_by_default():
+    assert not config['streaming']['enabled']
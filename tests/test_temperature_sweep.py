@@ -0,0 +1,88 @@
+import hashlib
+
+import pytest
+
+import temperature_experiment_runner as sweep
+from helpers.scheduler import ProviderScheduler
+from models.mock import MockModel
+
+TEXTS = [f'article {index}' for index in range(200)]
+ANNOTATIONS = [int(hashlib.sha1(text.encode()).hexdigest(), 16) % 2 for text in TEXTS]
+TRUTH = dict(zip(TEXTS, ANNOTATIONS))
+
+
+class AccuracyMock(MockModel):
+    """
+    Mock provider answering correctly on a fixed share of the items at each temperature.
+    """
+    def __init__(self, accuracy):
+        super().__init__('mock-model', settings={'latency_distribution': 'constant', 'latency_ms': 0})
+        self.accuracy = accuracy
+        self.requests = 0
+
+    async def acached_predict(self, text, prompt, fine_tuned=False, temperature=None, sample=0, labels=None):
+        self.requests += 1
+        draw = int(hashlib.sha1(f'{text}:{temperature}'.encode()).hexdigest(), 16) % 1000 / 1000
+        label = TRUTH[text] if draw < self.accuracy[temperature] else 1 - TRUTH[text]
+        return ('biased' if label else 'nonbiased'), False
+
+
+@pytest.fixture(autouse=True)
+def sweep_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(sweep, 'base_dir', str(tmp_path))
+
+
+def run_sweep(model, temperatures, **settings):
+    settings = {**sweep.sweep_settings(), 'sampling': 'sequential', 'min_items': 40, 'chunk_size': 20,
+                'max_items': 200, 'ci_width': 0.1, **settings}
+    scheduler = ProviderScheduler()
+    scheduler.add(sweep.sweep_job(model, 'mock', 1, TEXTS, ANNOTATIONS, 'Is it biased?', temperatures, settings))
+    rows = []
+    for _, result in scheduler.run():
+        if isinstance(result, Exception):
+            raise result
+        rows.extend(result)
+    # temperature -> (items scored, stop reason, p-value against the reference)
+    return {row[1]: (row[10], row[11], row[12]) for row in rows}
+
+
+def test_fixed_sampling_scores_sample_size_items_by_default():
+    assert sweep.sweep_settings()['sampling'] == 'fixed'
+    model = AccuracyMock({0.0: 0.9, 1.0: 0.6})
+    cells = run_sweep(model, [0.0, 1.0], sampling='fixed', sample_size=50)
+    assert {temperature: cell[:2] for temperature, cell in cells.items()} == {0.0: (50, 'fixed'), 1.0: (50, 'fixed')}
+    assert model.requests == 100
+
+
+def test_cell_stops_once_its_accuracy_differs_from_the_reference():
+    model = AccuracyMock({0.0: 1.0, 1.0: 0.3})
+    cells = run_sweep(model, [0.0, 1.0], ci_width=0.0)
+    items, stop, p_value = cells[1.0]
+    assert stop == 'significant'
+    assert items < 200 and p_value < 0.05
+    # the reference stops with the last cell compared to it
+    assert cells[0.0][0] == items
+    assert model.requests == 2 * items
+
+
+def test_cell_stops_once_its_confidence_interval_is_narrow():
+    # a cell right on every item has a zero-width interval after the first look
+    cells = run_sweep(AccuracyMock({0.0: 1.0, 0.5: 1.0}), [0.0, 0.5])
+    assert cells[0.5][:2] == (40, 'ci_width')
+    assert cells[0.0][:2] == (40, 'ci_width')
+
+
+def test_undecided_cell_samples_up_to_max_items():
+    model = AccuracyMock({0.0: 0.7, 1.0: 0.7})
+    cells = run_sweep(model, [0.0, 1.0], ci_width=0.01, max_items=120)
+    assert cells[1.0][:2] == (120, 'max_items')
+    assert cells[0.0][:2] == (120, 'max_items')
+    assert model.requests == 240
+
+
+def test_rerun_reuses_the_results_files():
+    run_sweep(AccuracyMock({0.0: 1.0, 1.0: 0.3}), [0.0, 1.0], ci_width=0.0)
+    model = AccuracyMock({0.0: 1.0, 1.0: 0.3})
+    cells = run_sweep(model, [0.0, 1.0], ci_width=0.0)
+    assert cells[1.0][1] == 'significant'
+    assert model.requests == 0
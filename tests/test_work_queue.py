@@ -0,0 +1,113 @@
+import time
+
+import pytest
+
+from helpers.usage import get_usage_tracker
+from helpers.work_queue import WorkQueue
+from models.experiments import experiment_requests
+from models.mock import MockModel
+
+EXPERIMENTS = {('exp', 'model')}
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.db'), lease_seconds=60, max_attempts=2)
+    queue.submit('exp', 'model', 'mock', ['a', 'b', 'c'], runs=1, chunk_size=2)
+    yield queue
+    queue.close()
+
+
+def expire_leases(queue):
+    with queue._transaction() as conn:
+        conn.execute("UPDATE units SET lease_until = ? WHERE state = 'leased'", (time.time() - 1,))
+
+
+def test_claim_leases_each_unit_once(queue):
+    first = queue.claim('w1', 'mock', EXPERIMENTS)
+    second = queue.claim('w2', 'mock', EXPERIMENTS)
+    assert (first.start, first.stop) == (0, 2)
+    assert (second.start, second.stop) == (2, 3)
+    assert queue.claim('w3', 'mock', EXPERIMENTS) is None
+    assert queue.claim('w3', 'other', EXPERIMENTS) is None
+    assert queue.claim('w3', 'mock', {('exp', 'other model')}) is None
+
+
+def test_fail_releases_the_unit_until_max_attempts(queue):
+    unit = queue.claim('w1', 'mock', EXPERIMENTS)
+    queue.fail('w1', unit, 'boom')
+    again = queue.claim('w2', 'mock', EXPERIMENTS)
+    assert again.id == unit.id and again.attempts == 2
+    queue.fail('w2', again, 'boom')
+    assert queue.status()[0]['failed'] == 1
+    # only the other unit is left
+    assert queue.claim('w3', 'mock', EXPERIMENTS).id != unit.id
+
+
+def test_expired_lease_is_claimed_again(queue):
+    unit = queue.claim('w1', 'mock', EXPERIMENTS)
+    queue.claim('w1', 'mock', EXPERIMENTS)
+    assert queue.claim('w2', 'mock', EXPERIMENTS) is None
+    expire_leases(queue)
+    again = queue.claim('w2', 'mock', EXPERIMENTS)
+    assert again.id == unit.id and again.attempts == 2
+
+    # the first worker lost the lease, it can no longer fail the unit
+    queue.fail('w1', unit, 'late')
+    assert queue.status()[0]['leased'] == 2
+
+
+def test_unit_leased_too_often_is_given_up(queue):
+    unit = queue.claim('w1', 'mock', EXPERIMENTS)
+    expire_leases(queue)
+    assert queue.claim('w2', 'mock', EXPERIMENTS).id == unit.id
+    expire_leases(queue)
+    # its workers keep dying on it, the next claim skips to the other unit
+    assert queue.claim('w3', 'mock', EXPERIMENTS).id != unit.id
+    assert queue.status()[0]['failed'] == 1
+
+
+def test_complete_stores_responses(queue):
+    unit = queue.claim('w1', 'mock', EXPERIMENTS)
+    queue.complete('w1', unit, {(1, 0): '1', (1, 1): '0'})
+    assert queue.responses('exp', 'model') == {(1, 0): '1', (1, 1): '0'}
+    assert queue.unfinished(EXPERIMENTS) == 1
+    assert not queue.claim_collection('w1', 'exp', 'model')
+
+
+class Usage:
+    def __init__(self, requests):
+        self.requests = requests
+
+    def as_dict(self):
+        return {'requests': self.requests, 'input_tokens': 10 * self.requests}
+
+
+def test_late_copy_of_a_reclaimed_unit_is_dropped(queue):
+    unit = queue.claim('w1', 'mock', EXPERIMENTS)
+    expire_leases(queue)
+    again = queue.claim('w2', 'mock', EXPERIMENTS)
+    assert queue.complete('w2', again, {(1, 0): '1'}, Usage(2))
+    assert not queue.complete('w1', unit, {(1, 0): '0'}, Usage(2))
+    assert queue.responses('exp', 'model') == {(1, 0): '1'}
+    assert queue.usage('exp', 'model')['requests'] == 2
+
+
+def test_failed_unit_cannot_be_completed(queue):
+    unit = queue.claim('w1', 'mock', EXPERIMENTS)
+    queue.fail('w1', unit, 'boom')
+    assert not queue.complete('w1', unit, {(1, 0): '1'}, Usage(1))
+    assert queue.status()[0]['done'] == 0
+    assert queue.responses('exp', 'model') == {}
+
+
+
+def test_units_running_side_by_side_record_their_own_usage(queue, send_requests):
+    model = MockModel('model', settings={'latency_distribution': 'constant', 'latency_ms': 20, 'stream_chunks': 1})
+    params = {'experiment_name': 'exp', 'prompt': 'Is it biased?', 'texts': ['a', 'b', 'c'], 'num_runs': 1}
+    units = [queue.claim('w1', 'mock', EXPERIMENTS), queue.claim('w1', 'mock', EXPERIMENTS)]
+    # the requests of both units in flight at once, as in worker.py
+    requests = [request for unit in units for request in experiment_requests(model, params, {}, unit.items, unit.id)]
+    assert set(send_requests(requests)) == {(1, 0), (1, 1), (1, 2)}
+    for unit in units:
+        assert get_usage_tracker().pop(unit.id).requests == len(unit.items)
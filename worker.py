@@ -0,0 +1,234 @@
+"""
+Distributed experiment workers: split the batch grid of experiments.yml across several processes,
+on one or several machines with their own API keys and quotas, through a shared work queue
+(helpers/work_queue.py, work_queue in config.yml).
+
+    python worker.py submit [--providers chatgpt claudeai]
+    python worker.py work [--providers chatgpt claudeai] [--worker-id NAME] [--no-collect]
+    python worker.py collect [--providers ...]
+    python worker.py status
+
+Every experiment is queued as (run, chunk of items) units. Workers claim the units of the
+providers they have keys for, run them through the same request path as runner.py (rate limiter,
+resilience policy, response cache) and store the responses in the queue. `work` queues its own grid
+first, so starting workers is enough, and collects the finished experiments when the queue is
+empty. Collecting finalizes an experiment once all of its units are done: parsing, scoring and
+writing its results through the collecting process's result sink, so with several machines run
+the workers with --no-collect and `collect` once on one of them to get a single result store.
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import socket
+
+import runner
+from helpers import config
+from helpers.checkpoint import experiment_key
+from helpers.result_sink import get_result_sink
+from helpers.telemetry import get_telemetry
+from helpers.usage import get_usage_tracker
+from helpers.work_queue import get_work_queue, work_queue_config, data_hash
+from models.experiments import provider_semaphore, completed_responses, experiment_requests, finalize_experiment
+from models.experiments import usage_key
+from models.registry import PROVIDERS
+
+
+def available_providers(providers=None):
+    """
+    Providers of the batch grid this process can call, restricted to `providers` if given.
+    """
+    batch = runner.experiments['batch']
+    available = []
+    for provider in batch.get('providers', list(PROVIDERS)):
+        if providers is not None and provider not in providers:
+            continue
+        variable = PROVIDERS[provider][2]
+        if variable is not None and variable not in os.environ:
+            logging.warning(f"Skipping {provider}, {variable} is not set")
+            continue
+        available.append(provider)
+    return available
+
+
+def experiment_grid(providers):
+    """
+    The (model, params) pairs of the batch grid on `providers`, built like runner.py builds them.
+    """
+    articles, anns, sentences = runner.load_batch_data(runner.experiments)
+    batch = dict(runner.experiments['batch'], providers=providers)
+    return runner.batch_experiment_params(articles, anns, runner.get_models(providers), batch, sentences)
+
+
+def submit(queue, grid):
+    """
+    Queue the units of every experiment in grid, experiments already queued are left as they are.
+    """
+    chunk_size = work_queue_config().get('chunk_size', 25)
+    for model, params in grid:
+        try:
+            units = queue.submit(experiment_key(params), model.model_name, model.product_name, params['texts'],
+                                 params.get('num_runs', 1), chunk_size)
+        except ValueError as e:
+            logging.error(f"Not queueing {params.get('experiment_name')} ({model.model_name}): {e}")
+            continue
+        if units:
+            logging.info(f"Queued {units} units of {params.get('experiment_name')} ({model.model_name})")
+
+
+def queued_experiments(queue, grid):
+    """
+    The experiments of grid in the queue, keyed by (experiment, model). Experiments queued for other
+    data than this process loaded are left out, their item indices would not match.
+    """
+    experiments = {}
+    for model, params in grid:
+        key = (experiment_key(params), model.model_name)
+        queued_hash = queue.data_hash(*key)
+        if queued_hash is None:
+            continue
+        if queued_hash != data_hash(params['texts']):
+            logging.error(f"{params.get('experiment_name')} ({model.model_name}) is queued for different data, "
+                          f"skipping it")
+            continue
+        experiments[key] = (model, params)
+    return experiments
+
+
+async def run_unit(unit, model, params, usage=None):
+    """
+    Send the requests of one unit, those of its items already in the local request journal excepted.
+
+    :param usage: Usage key the unit's tokens are recorded under, see request_scope.
+    :return: Dictionary mapping the unit's response keys to raw responses.
+    """
+    items = unit.items
+    responses = {key: response for key, response in completed_responses(model, params).items() if key in items}
+    semaphore = provider_semaphore(unit.provider)
+
+    async def send(request):
+        async with semaphore:
+            return await request()
+
+    for result in await asyncio.gather(*(send(request) for request in experiment_requests(model, params, responses, items, usage))):
+        responses.update(result)
+    return responses
+
+
+async def awork(queue, experiments, worker_id):
+    """
+    Claim and run units of `experiments` until none are pending or leased. Each provider keeps
+    enough units in flight to fill its concurrency limit (concurrency in config.yml).
+    """
+    chunk_size = work_queue_config().get('chunk_size', 25)
+    poll_interval = work_queue_config().get('poll_interval', 10)
+    limits = config.get('concurrency') or {}
+    leased = set()
+
+    async def renew():
+        while True:
+            await asyncio.sleep(queue.lease_seconds / 3)
+            await asyncio.to_thread(queue.renew, worker_id, list(leased))
+
+    async def slot(provider):
+        while True:
+            unit = await asyncio.to_thread(queue.claim, worker_id, provider, experiments)
+            if unit is None:
+                # units leased by other workers come back if their lease runs out
+                if not await asyncio.to_thread(queue.unfinished, experiments):
+                    return
+                await asyncio.sleep(poll_interval)
+                continue
+            leased.add(unit.id)
+            model, params = experiments[(unit.experiment, unit.model)]
+            # units of one experiment run side by side, each records its usage under its own key
+            unit_usage = (*usage_key(model, params), unit.id)
+            try:
+                responses = await run_unit(unit, model, params, unit_usage)
+            except Exception as e:
+                logging.error(f"Unit {unit} failed: {e}")
+                # the failed attempt's usage is dropped, the unit is charged once an attempt completes it
+                get_usage_tracker().pop(unit_usage)
+                await asyncio.to_thread(queue.fail, worker_id, unit, e)
+            else:
+                usage = get_usage_tracker().pop(unit_usage)
+                if await asyncio.to_thread(queue.complete, worker_id, unit, responses, usage):
+                    logging.info(f"Completed {unit}")
+            finally:
+                leased.discard(unit.id)
+
+    providers = sorted({model.product_name for model, _ in experiments.values()})
+    renewer = asyncio.create_task(renew())
+    try:
+        await asyncio.gather(*(
+            slot(provider)
+            for provider in providers
+            for _ in range(math.ceil(limits.get(provider, limits.get('default', 8)) / chunk_size) + 1)
+        ))
+    finally:
+        renewer.cancel()
+
+
+def collect(queue, experiments, worker_id):
+    """
+    Finalize the experiments whose units are all finished and that nobody collected yet, logging
+    their results through this process's result sink.
+
+    :return: Number of collected experiments.
+    """
+    collected = 0
+    for (experiment, model_name), (model, params) in experiments.items():
+        if not queue.claim_collection(worker_id, experiment, model_name):
+            continue
+        try:
+            get_usage_tracker().merge(usage_key(model, params), **queue.usage(experiment, model_name))
+            results = finalize_experiment(model, params, queue.responses(experiment, model_name))
+        except Exception as e:
+            logging.error(f"Cannot collect {params.get('experiment_name')} ({model_name}): {e}")
+            queue.release_collection(experiment, model_name)
+            continue
+        runner.log_batch_results(results)
+        collected += 1
+    return collected
+
+
+def print_status(queue):
+    rows = queue.status()
+    print(f"{'experiment':45} {'model':30} {'pending':>8} {'leased':>8} {'done':>8} {'failed':>8}  collected by")
+    for row in rows:
+        print(f"{row['experiment']:45} {row['model']:30} {row['pending']:>8} {row['leased']:>8} {row['done']:>8} "
+              f"{row['failed']:>8}  {row['collected_by'] or ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['submit', 'work', 'collect', 'status'])
+    parser.add_argument('--providers', nargs='+', help='providers to work on, by default all with an API key')
+    parser.add_argument('--worker-id', default=f'{socket.gethostname()}-{os.getpid()}')
+    parser.add_argument('--no-collect', action='store_true', help='leave collecting the results to another process')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+
+    queue = get_work_queue()
+    if args.command == 'status':
+        print_status(queue)
+        return
+
+    grid = experiment_grid(available_providers(args.providers))
+    if args.command in ('submit', 'work'):
+        submit(queue, grid)
+    experiments = queued_experiments(queue, grid)
+    if args.command == 'work':
+        asyncio.run(awork(queue, experiments, args.worker_id))
+    if args.command == 'collect' or (args.command == 'work' and not args.no_collect):
+        logging.info(f"Collected {collect(queue, experiments, args.worker_id)} experiments")
+
+    get_result_sink().close()
+    if get_telemetry().enabled:
+        get_telemetry().export()
+    queue.close()
+
+
+if __name__ == '__main__':
+    main()